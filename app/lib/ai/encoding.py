@@ -0,0 +1,114 @@
+import numpy
+from pathlib import Path
+from typing import List, Optional, Tuple
+from app import settings
+from app.lib.calc.loadables.depotpark import DEPOTPARK
+from app.lib.calc.loadables.vehicles import VEHICLES
+from app.lib.utils.logger import logger
+
+
+# Sizes of the one-hot fields of the model input, as the depot and vehicle files give them now.
+# A trained model keeps the sizes it was trained with, see export_weights
+DEPOTS_QTY = max(depot.id for depot in DEPOTPARK.filter_by(None)) + 1
+VEHICLES_QTY = max(vehicle.id for vehicle in VEHICLES) + 1
+
+
+def field_sizes(inputs: int, vehicles_qty: int = VEHICLES_QTY) -> Tuple[int, int]:
+    """
+    Field sizes of a model taking `inputs` values, for a .keras model that does not record them.
+    The width alone does not tell the fields apart: the vehicle field is taken as the vehicle file
+    gives it now (vehicles are hardly ever added), the rest are the two depot fields
+    :param inputs: input width of the model's first layer
+    :param vehicles_qty: size of the vehicle field
+    :return: (depots_qty, vehicles_qty)
+    :raise ValueError: the width does not fit a vehicle field of vehicles_qty
+    """
+    depots_qty, odd = divmod(inputs - vehicles_qty, 2)
+    if odd or depots_qty < 1:
+        raise ValueError(f'A model of {inputs} inputs does not fit {vehicles_qty} vehicle ids')
+    return depots_qty, vehicles_qty
+
+
+def vectorize_input(_from: int, _to: int, _veh: int) -> List[float]:
+    """
+    The model accepting linear array of 0.0 or 1.0. For example 00001000..00010000..0100
+    First DEPOTS_QTY (182) values represents field of possible starting Depots
+    Second DEPOTS_QTY values is for ending Depots
+    And then there is VEHICLES_QTY (7) values to choose a vehicle
+    Total 182+182+7=371. That is the input of the model. The values are binary: 0 or 1
+    :param _from: ID of Starting Depot
+    :param _to: ID of Ending Depot
+    :param _veh: ID of Vehicle
+    :return: model_input_vector
+    """
+    return encode([_from], [_to], [_veh])[0].tolist()
+
+
+def encode_indices(dpt_from_ids, dpt_to_ids, vehicle_ids,
+                   depots_qty: int = DEPOTS_QTY, vehicles_qty: int = VEHICLES_QTY) -> numpy.ndarray:
+    """
+    Sparse form of the model input: positions of the three ones of every one-hot row
+    :param dpt_from_ids: array-like of Starting Depot ids
+    :param dpt_to_ids: array-like of Ending Depot ids
+    :param vehicle_ids: array-like of Vehicle ids
+    :return: int array of shape (n, 3)
+    """
+    columns = numpy.column_stack((numpy.asarray(dpt_from_ids, dtype=numpy.intp),
+                                  numpy.asarray(dpt_to_ids, dtype=numpy.intp),
+                                  numpy.asarray(vehicle_ids, dtype=numpy.intp)))
+    columns += numpy.array([0, depots_qty, 2 * depots_qty], dtype=numpy.intp)
+    return columns
+
+
+def encode(dpt_from_ids, dpt_to_ids, vehicle_ids,
+           depots_qty: int = DEPOTS_QTY, vehicles_qty: int = VEHICLES_QTY) -> numpy.ndarray:
+    """
+    Dense form of the model input, see vectorize_input
+    :param dpt_from_ids: array-like of Starting Depot ids
+    :param dpt_to_ids: array-like of Ending Depot ids
+    :param vehicle_ids: array-like of Vehicle ids
+    :return: float32 one-hot matrix of shape (n, 2 * depots_qty + vehicles_qty)
+    """
+    columns = encode_indices(dpt_from_ids, dpt_to_ids, vehicle_ids, depots_qty, vehicles_qty)
+    x = numpy.zeros((len(columns), 2 * depots_qty + vehicles_qty), dtype=numpy.float32)
+    x[numpy.arange(len(columns))[:, None], columns] = 1.0
+    return x
+
+
+def export_weights(model_loc: str = settings.AI_MODEL_LOC, weights_loc: str = settings.AI_WEIGHTS_LOC,
+                   depots_qty: Optional[int] = None, vehicles_qty: int = VEHICLES_QTY) -> None:
+    """
+    Pulls the dense layers' weights out of a .keras model into a small .npz file for NumpyPricePredictor,
+    with the sizes of the one-hot fields the model was trained with.
+    This is the only place here that needs keras, it is imported lazily. The module builds nothing else
+    at import time (serving builds ML_MODEL), so the first weights can be exported before any exist.
+    :param model_loc: .keras model file
+    :param weights_loc: .npz file to write
+    :param depots_qty: number of depot ids the model was trained with, see field_sizes by default
+    :param vehicles_qty: number of vehicle ids the model was trained with
+    :return: None
+    :raise ValueError: the input width of the model does not match the field sizes
+    """
+    from keras.api.models import load_model
+
+    model = load_model(model_loc)
+    inputs = model.layers[0].get_weights()[0].shape[0]
+    if depots_qty is None:
+        depots_qty, vehicles_qty = field_sizes(inputs, vehicles_qty)
+    if inputs != 2 * depots_qty + vehicles_qty:
+        raise ValueError(f'{model_loc} takes {inputs} inputs, not {2 * depots_qty + vehicles_qty} '
+                         f'of {depots_qty} depot and {vehicles_qty} vehicle ids')
+    arrays = {'depots_qty': numpy.array(depots_qty), 'vehicles_qty': numpy.array(vehicles_qty)}
+    activations = []
+    for i, layer in enumerate(model.layers):
+        kernel, bias = layer.get_weights()
+        arrays[f'kernel_{i}'] = kernel.astype(numpy.float32)
+        arrays[f'bias_{i}'] = bias.astype(numpy.float32)
+        activations.append(layer.get_config()['activation'])
+    arrays['activations'] = numpy.array(activations)
+
+    Path(weights_loc).parent.mkdir(parents=True, exist_ok=True)
+    tmp_loc = Path(weights_loc).with_suffix('.tmp.npz')
+    numpy.savez(tmp_loc, **arrays)
+    tmp_loc.replace(weights_loc)
+    logger.info(f'Exported {len(activations)} layers of {model_loc} to {weights_loc}')
@@ -1,9 +1,7 @@
 
 from app.lib.calc.loadables.vehicles import VEHICLES
 from app.lib.calc.loadables.depotpark import DEPOTPARK
-import app.lib.calc.calc_itself as calc_itself
-import sqlite3
-import json
+import math
 from random import SystemRandom
 import numpy
 from keras.api.utils import Sequence
@@ -13,108 +11,51 @@ from keras.api.optimizers import Adam
 from keras.api.models import load_model
 # import seaborn as sns
 from app import settings
-from app.lib.calc.loadables.depotpark import Depot
-from app.lib.calc.loadables.vehicles import Vehicle
+from app.lib.ai import encoding
+from app.lib.ai.samples import SampleSpace
+from app.lib.ai.querylog_source import QueryLogSource
 
 
 class BatchGenerator(Sequence):
-    def __init__(self, batch_size=1500, batches_qty=30, **kwargs):
+
+    """
+    Feeds the model with random (depot, depot, vehicle) samples priced by the conventional method
+    over the road distances of the depot matrix (haversine for the pairs it misses).
+    A batch is generated with array math (see samples.SampleSpace), so generation takes about
+    a millisecond per batch. To fan it out over processes pass keras' workers=N and
+    use_multiprocessing=True, every batch draws from its own random generator.
+    """
+
+    def __init__(self, batch_size=1500, batches_qty=30, seed=None,
+                 depots_qty=encoding.DEPOTS_QTY, vehicles_qty=encoding.VEHICLES_QTY, **kwargs):
+        """
+        :param batch_size: Number of samples in a batch
+        :param batches_qty: Number of batches in an epoch
+        :param seed: Makes batches reproducible (batch idx is mixed in). Fresh OS entropy per batch by default
+        :param depots_qty: Size of the depot fields of the trained model
+        :param vehicles_qty: Size of the vehicle field of the trained model
+        :param kwargs: keras.utils.PyDataset arguments (workers, use_multiprocessing, max_queue_size)
+        """
         super().__init__(**kwargs)
         self.batch_size = batch_size
         self.batches_qty = batches_qty
-        self.rnd = SystemRandom()
+        self.seed = seed
+        self.space = SampleSpace(DEPOTPARK.filter_by(None), VEHICLES.as_list,
+                                 depots_qty=depots_qty, vehicles_qty=vehicles_qty)
 
     def __len__(self):
         # Return number of batches.
         return self.batches_qty
 
     def __getitem__(self, idx):
-        self._gen_batch(DEPOTPARK.park, DEPOTPARK.park, VEHICLES, self.batch_size)
-        batch_x, batch_y = self._gen_batch(DEPOTPARK.park, DEPOTPARK.park, VEHICLES, self.batch_size)
-        return numpy.array(batch_x), numpy.array(batch_y)
+        rng = numpy.random.default_rng(None if self.seed is None else (self.seed, idx))
+        return self.space.sample(self.batch_size, rng)
 
     def get_one_case(self):
         """Makes a batch with one sample inside for testing purposes
         :return: Single sample batch
         """
-        batch_x, batch_y = self._gen_batch(DEPOTPARK.park, DEPOTPARK.park, VEHICLES, 1)
-        return numpy.array(batch_x), numpy.array(batch_y)
-
-    def _gen_batch(self, _from_list, _to_list, _vehicles, batch_size):
-        """Generates mini-batches for model training randomizing the lists of the available Depots and Vehicles
-        :param _from_list: Starting Depots list
-        :param _to_list: Ending Depots list
-        :param _vehicles: Vehicles list
-        :param batch_size: Number of samples in a batch
-        :return: x and y corresponding values in a lists
-        """
-        x_arr = []
-        y_arr = []
-        for i in range(batch_size):
-            depot_from = self.rnd.choice(_from_list)
-            depot_to = self.rnd.choice(_to_list)
-            vehicle = self.rnd.choice(_vehicles)
-            x, y = self._evaluate(depot_from, depot_to, vehicle)
-            x_arr.append(x)
-            y_arr.append(y)
-            # self._store(depot_from.id, depot_to.id, vehicle.id, y)
-        return x_arr, y_arr
-
-    def _evaluate(self, _from: Depot, _to: Depot, _vehicle: Vehicle):
-        """Evaluates route cost to produce x, y pair where x is an input to the model and
-        y is a desired output out of the model
-        :param _from: Starting Depot
-        :param _to: Ending Depot
-        :param _vehicle: Chosen Vehicle
-        :return: x is a list of 371 elements, y is a desired float
-        """
-        x = PricePredictor.vectorize_input(_from.id, _to.id, _vehicle.id)
-        request = self.craft_request(_from, _to, _vehicle)
-        calculation = calc_itself.calculate_route_reduced(request)
-        y = calculation['price'] * calculation['currency_rate']
-        return x, y
-
-    @staticmethod
-    def craft_request(_from: Depot, _to: Depot, _veh: Vehicle):
-        """Internal method to exploit internal analitycal calculator needed to generate bulk of data.
-        It makes a json-like request (dict) that calculator can process to avoid refactoring calculator itself.
-        param _from: Starting Depot obj
-        param _to: Ending Depot obj
-        param _veh: Chosen Vehicle obj
-        :return: crafted dict that is ready to be processed by the calc
-        """
-
-        return {'intent':   'acquire',
-                'from':     {'name_short': None,
-                             'name_long': None,
-                             'lat': _from.lat,
-                             'lng': _from.lng,
-                             'countrycode': _from.state.iso_code},
-                'to':       {'name_short': None,
-                             'name_long': None,
-                             'lat': _to.lat,
-                             'lng': _to.lng,
-                             'countrycode':  _to.state.iso_code},
-                'transport_id': _veh.id,
-                'phone_number': None,
-                'locale': None,
-                'url': None,
-                'ip': None}
-
-    @staticmethod
-    def __extract_sqlite_data():
-        """This method should be used in future for fine tune on real calculation data"""
-        cx = sqlite3.connect("/home/oliver/Projects/TF_Experiments/data/QueryLog.sqlite")
-        cu = cx.cursor()
-        counter = 0
-        for row in cu.execute('select "query" from "queries"'):
-            try:
-                obj = json.loads(row[0])
-                # calc_itself.calculate_route()
-                counter += 1
-            except json.decoder.JSONDecodeError:
-                pass
-        print(f'Total: {counter}')
+        return self.space.sample(1, numpy.random.default_rng())
 
 
 class PricePredictor:
@@ -123,6 +64,19 @@ class PricePredictor:
         self.model_loc = model
         self.model = load_model(self.model_loc)
 
+    @property
+    def depots_qty(self) -> int:
+        return encoding.field_sizes(self.model.input_shape[-1])[0]
+
+    @property
+    def vehicles_qty(self) -> int:
+        return encoding.field_sizes(self.model.input_shape[-1])[1]
+
+    def _check_source(self, source: QueryLogSource) -> None:
+        if (source.depots_qty, source.vehicles_qty) != (self.depots_qty, self.vehicles_qty):
+            raise ValueError(f'QueryLog source is encoded for {source.depots_qty} depot and {source.vehicles_qty} '
+                             f'vehicle ids, the model takes {self.depots_qty} and {self.vehicles_qty}')
+
     def __create(self):
         """
         This is a place the model were born at
@@ -156,36 +110,13 @@ class PricePredictor:
     @classmethod
     def vectorize_input(cls, _from, _to, _veh):
         """
-        The model accepting linear array of 0.0 or 1.0. For example 00001000..00010000..0100
-        First 182 values represents field of possible starting Depots
-        Second 182 values is for ending Depots
-        And then there is 7 values to choose a vehicle
-        Total 182+182+7=371. That is the input of the model. The values are binary: 0 or 1
-        :param _from: ID of Starting Depot
-        :param _to: ID of Ending Depot
-        :param _veh: ID of Vehicle
-        :return: model_input_vector
-        """
-        array = []
-        for i in range(0, 182):
-            if _from == i:
-                array.append(1.0)
-            else:
-                array.append(0.0)
-        for i in range(0, 182):
-            if _to == i:
-                array.append(1.0)
-            else:
-                array.append(0.0)
-        for i in range(0, 7):
-            if _veh == i:
-                array.append(1.0)
-            else:
-                array.append(0.0)
-        return array
+        See encoding.vectorize_input
+        """
+        return encoding.vectorize_input(_from, _to, _veh)
 
     def train(self, x_batch, y_batch):
-        history = self.model.fit(BatchGenerator(), epochs=40)
+        generator = BatchGenerator(depots_qty=self.depots_qty, vehicles_qty=self.vehicles_qty)
+        history = self.model.fit(generator, epochs=40)
 
         # def plot(_history, title='Loss func'):
         #     plt.plot(_history.history['loss'], label='Loss')
@@ -197,7 +128,50 @@ class PricePredictor:
         #     plt.show()
 
         # plot(history)
-        self.model.save(self.model_loc)
+        self.save()
+
+    def fine_tune(self, source: QueryLogSource, epochs=5, batch_size=1500):
+        """
+        Tunes the model on the real quotes of the QueryLog. The log is streamed in chunks
+        (see querylog_source.QueryLogSource), so it never has to fit into memory.
+        The tuned model is not saved, see save()
+        :param source: QueryLog source, usually its 'train' part, encoded with the field sizes of the model
+        :param epochs: passes over the log
+        :param batch_size: samples per batch
+        :return: keras History
+        :raise ValueError: the source is empty or encoded with other field sizes
+        """
+        self._check_source(source)
+        steps = math.ceil(source.count() / batch_size)
+        if steps < 1:
+            raise ValueError(f'QueryLog {source.location} is empty')
+        return self.model.fit(source.batches(batch_size, repeat=True), steps_per_epoch=steps, epochs=epochs)
+
+    def evaluate(self, source: QueryLogSource, batch_size=1500) -> float:
+        """
+        :param source: QueryLog source, usually its 'holdout' part, encoded with the field sizes of the model
+        :param batch_size: samples per model call
+        :return: mean absolute error of the price per km over the source
+        :raise ValueError: the source has no usable rows or is encoded with other field sizes
+        """
+        self._check_source(source)
+        total, count = 0.0, 0
+        for x, y in source.batches(batch_size):
+            total += float(numpy.abs(self.model.predict(x, verbose=0)[:, 0] - y).sum())
+            count += len(y)
+        if not count:
+            raise ValueError(f'No usable rows in {source.location}')
+        return total / count
+
+    def save(self, model_loc=None, weights_loc=settings.AI_WEIGHTS_LOC):
+        """
+        Saves the model and exports its weights for serving
+        :param model_loc: .keras file, the one the model was loaded from by default
+        :param weights_loc: .npz file
+        """
+        model_loc = model_loc or self.model_loc
+        self.model.save(model_loc)
+        encoding.export_weights(model_loc, weights_loc, self.depots_qty, self.vehicles_qty)
 
     def predict(self, dpt_from_id: int, dpt_to_id: int, vehicle_id: int) -> float:
         """
@@ -207,20 +181,26 @@ class PricePredictor:
         param vehicle: Chosen Vehicle id
         :return: Approx price of 1 kilometer of the route
         """
-        x = numpy.array([self.vectorize_input(dpt_from_id, dpt_to_id, vehicle_id)])
-        y = self.model.predict(x)
-        return float(y[0][0])
-
+        return float(self.predict_many([dpt_from_id], [dpt_to_id], [vehicle_id])[0])
 
-ML_MODEL = PricePredictor()
+    def predict_many(self, dpt_from_ids, dpt_to_ids, vehicle_ids) -> numpy.ndarray:
+        """
+        Makes predictions on route cost for many (from, to, vehicle) triples in one model call.
+        :param dpt_from_ids: array-like of Starting Depot ids
+        :param dpt_to_ids: array-like of Ending Depot ids
+        :param vehicle_ids: array-like of Vehicle ids
+        :return: array of approx prices of 1 kilometer of the routes
+        """
+        x = encoding.encode(dpt_from_ids, dpt_to_ids, vehicle_ids, self.depots_qty, self.vehicles_qty)
+        return self.model.predict(x, verbose=0)[:, 0]
 
 
 def test():
     rnd = SystemRandom()
-    dpt_from = rnd.choice(DEPOTPARK.park)
-    dpt_to = rnd.choice(DEPOTPARK.park)
-    vehicle = rnd.choice(VEHICLES)
-    value = ML_MODEL.predict(dpt_from, dpt_to, vehicle)
+    dpt_from = rnd.choice(DEPOTPARK.filter_by(None))
+    dpt_to = rnd.choice(DEPOTPARK.filter_by(None))
+    vehicle = rnd.choice(VEHICLES.as_list)
+    value = PricePredictor().predict(dpt_from.id, dpt_to.id, vehicle.id)
     if isinstance(value, float):
         print(f'TEST OK Value is float and equal {value}')
     else:
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy
+from pathlib import Path
+from typing import Dict, Optional
+from app import settings
+from app.lib.ai import encoding
+from app.lib.ai.serving import ML_MODEL, NumpyPricePredictor
+from app.lib.utils.logger import logger
+
+
+PRICE_TABLE_PATH = Path(settings.AI_PRICE_TABLE_LOC)
+
+
+def _file_digest(location: str) -> Optional[str]:
+    """
+    The source files are small (weights are a few KB), hashing them is cheaper than trusting mtimes
+    """
+    try:
+        with open(location, mode='rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class PriceTable:
+
+    """
+    Every output of the price model precomputed into a (depots, depots, vehicles) float32 array.
+
+    The model has no inputs but (dpt_from_id, dpt_to_id, vehicle_id), so the whole space
+    (182 x 182 x 7 values) is evaluated once in vectorized batches and then served by index.
+    The table is a .npy file (memory-mapped on load) with a JSON file next to it recording
+    the model pointer, model, weights and vehicles files it was built from.
+
+    predict() matches the predictor interface. When one of the source files changes (a retrained
+    model published with versions.publish included) the table is rebuilt in a background thread
+    and swapped in atomically, lookups keep using the old table until then. Ids outside of the table
+    go to the predictor.
+    """
+
+    def __init__(self, predictor: NumpyPricePredictor = ML_MODEL,
+                 location: Path = PRICE_TABLE_PATH,
+                 vehicles_loc: str = settings.VEHICLES_LOC,
+                 depots_qty: Optional[int] = None,
+                 vehicles_qty: Optional[int] = None,
+                 check_interval: float = settings.AI_PRICE_TABLE_CHECK_INTERVAL):
+        """
+        :param predictor: model to evaluate
+        :param location: .npy file of the table
+        :param vehicles_loc: vehicles file the table depends on
+        :param depots_qty: number of depot ids, the one the predictor's model was trained with by default
+        :param vehicles_qty: number of vehicle ids, the one the predictor's model was trained with by default
+        :param check_interval: seconds between checks of the source files, 0 checks on every lookup
+        """
+        self.predictor = predictor
+        self.location = Path(location)
+        self.meta_location = self.location.with_suffix('.json')
+        self.vehicles_loc = vehicles_loc
+        self._depots_qty = depots_qty
+        self._vehicles_qty = vehicles_qty
+        self.check_interval = check_interval
+        self.data: Optional[numpy.ndarray] = None
+        self._checked_at = 0.0
+        self._rebuilding = threading.Lock()
+
+    @property
+    def depots_qty(self) -> int:
+        return self._depots_qty or self.predictor.depots_qty
+
+    @property
+    def vehicles_qty(self) -> int:
+        return self._vehicles_qty or self.predictor.vehicles_qty
+
+    def fingerprint(self) -> Dict:
+        """
+        :return: digests of the files the table is computed from, with the table shape
+        """
+        return {'pointer': _file_digest(self.predictor.pointer_loc) if self.predictor.pointer_loc else None,
+                'model': _file_digest(self.predictor.model_loc),
+                'weights': _file_digest(self.predictor.weights_loc),
+                'vehicles': _file_digest(self.vehicles_loc),
+                'shape': [self.depots_qty, self.depots_qty, self.vehicles_qty]}
+
+    def _saved_fingerprint(self) -> Optional[Dict]:
+        try:
+            with open(self.meta_location, mode='r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_stale(self) -> bool:
+        return not self.location.exists() or self._saved_fingerprint() != self.fingerprint()
+
+    def load(self):
+        """
+        Memory-maps the table, building it first if it is missing or stale
+        :return: self
+        """
+        if self.is_stale():
+            self.rebuild()
+        self.data = numpy.load(self.location, mmap_mode='r')
+        self._checked_at = time.monotonic()
+        logger.info(f'Price table loaded: {self.data.shape}')
+        return self
+
+    def compute(self) -> numpy.ndarray:
+        """
+        Evaluates the model over every triple, one batch of (to, vehicle) pairs per starting depot
+        :return: float32 array of shape (depots, depots, vehicles)
+        :raise ValueError: the table shape does not match the field sizes of the model
+        """
+        depots, vehicles = self.depots_qty, self.vehicles_qty
+        if (depots, vehicles) != (self.predictor.depots_qty, self.predictor.vehicles_qty):
+            raise ValueError(f'Price table of {depots} depots and {vehicles} vehicles does not match the model of '
+                             f'{self.predictor.depots_qty} depots and {self.predictor.vehicles_qty} vehicles')
+        dpt_to_ids, vehicle_ids = numpy.divmod(numpy.arange(depots * vehicles), vehicles)
+        table = numpy.empty((depots, depots, vehicles), dtype=numpy.float32)
+        for dpt_from_id in range(depots):
+            columns = encoding.encode_indices(numpy.full(depots * vehicles, dpt_from_id), dpt_to_ids, vehicle_ids,
+                                              depots, vehicles)
+            table[dpt_from_id] = self.predictor.forward_indices(columns).reshape(depots, vehicles)
+        return table
+
+    def rebuild(self) -> None:
+        """
+        Reloads the model weights, computes the table and swaps the files in
+        """
+        started = time.perf_counter()
+        self.predictor.reload()
+        fingerprint = self.fingerprint()
+        table = self.compute()
+
+        self.location.parent.mkdir(parents=True, exist_ok=True)
+        # Every worker process may rebuild at the same time, each one writes its own temporary files
+        tmp_table = self.location.with_name(f'{self.location.stem}.{os.getpid()}.tmp.npy')
+        tmp_meta = self.meta_location.with_name(f'{self.meta_location.stem}.{os.getpid()}.tmp.json')
+        numpy.save(tmp_table, table)
+        with open(tmp_meta, mode='w', encoding='utf-8') as f:
+            json.dump(fingerprint, f)
+        os.replace(tmp_table, self.location)
+        os.replace(tmp_meta, self.meta_location)
+        logger.info(f'Price table of {table.size} values built in {time.perf_counter() - started:.2f} s')
+
+    @staticmethod
+    def _touch(data: numpy.ndarray) -> None:
+        # Reads the whole memory-mapped table, so no lookup waits for a page to come from disk
+        data.sum(dtype=numpy.float64)
+
+    def warm_up(self) -> None:
+        """
+        Pages the table in and runs the predictor once. Meant for a background thread at start
+        """
+        started = time.perf_counter()
+        if self.data is not None:
+            self._touch(self.data)
+        self.predictor.warm_up()
+        logger.info(f'Price table warmed up in {time.perf_counter() - started:.3f} s')
+
+    def _rebuild_and_swap(self) -> None:
+        try:
+            self.rebuild()
+            data = numpy.load(self.location, mmap_mode='r')
+            self._touch(data)
+            self.data = data
+        except Exception as e:
+            logger.error(f'Price table rebuild failed: {e}')
+        finally:
+            self._rebuilding.release()
+
+    def refresh(self, wait: bool = False) -> None:
+        """
+        Starts a background rebuild if the source files changed since the table was built.
+        Checks at most once per check_interval seconds
+        :param wait: rebuild in the calling thread instead
+        """
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if not self.is_stale() or not self._rebuilding.acquire(blocking=False):
+            return
+        logger.info('Price model or vehicles changed, rebuilding the price table')
+        if wait:
+            self._rebuild_and_swap()
+        else:
+            threading.Thread(target=self._rebuild_and_swap, name='price-table-rebuild', daemon=True).start()
+
+    def predict(self, dpt_from_id: int, dpt_to_id: int, vehicle_id: int) -> float:
+        """
+        Looks the model output up in the table.
+        param dpt_from: Starting Depot id
+        param dpt_to: Ending Depot id
+        param vehicle: Chosen Vehicle id
+        :return: Approx price of 1 kilometer of the route
+        """
+        self.refresh()
+        data = self.data
+        if data is None or not (dpt_from_id < data.shape[0] and dpt_to_id < data.shape[1]
+                                and vehicle_id < data.shape[2]):
+            return self.predictor.predict(dpt_from_id, dpt_to_id, vehicle_id)
+        return float(data[dpt_from_id, dpt_to_id, vehicle_id])
+
+    def predict_many(self, dpt_from_ids, dpt_to_ids, vehicle_ids) -> numpy.ndarray:
+        """
+        Looks the model outputs of many triples up in the table with one fancy index.
+        :param dpt_from_ids: array-like of Starting Depot ids
+        :param dpt_to_ids: array-like of Ending Depot ids
+        :param vehicle_ids: array-like of Vehicle ids
+        :return: float32 array of approx prices of 1 kilometer of the routes
+        """
+        self.refresh()
+        data = self.data
+        ids = (numpy.asarray(dpt_from_ids), numpy.asarray(dpt_to_ids), numpy.asarray(vehicle_ids))
+        if data is None:
+            return self.predictor.predict_many(*ids)
+        inside = (ids[0] < data.shape[0]) & (ids[1] < data.shape[1]) & (ids[2] < data.shape[2])
+        prices = numpy.empty(len(ids[0]), dtype=numpy.float32)
+        prices[inside] = data[ids[0][inside], ids[1][inside], ids[2][inside]]
+        if not inside.all():
+            outside = ~inside
+            prices[outside] = self.predictor.predict_many(ids[0][outside], ids[1][outside], ids[2][outside])
+        return prices
+
+
+PRICE_TABLE = PriceTable().load()
@@ -0,0 +1,167 @@
+import json
+import re
+import sqlite3
+import numpy
+from typing import Iterator, List, Optional, Sequence, Tuple
+from app import settings
+from app.lib.ai import encoding
+from app.lib.calc import haversine
+from app.lib.calc.loadables.depot import Depot
+from app.lib.utils.logger import logger
+
+
+# (a_lat, a_lng, a_countrycode, b_lat, b_lng, b_countrycode, vehicle_id, price per km in UAH)
+Quote = Tuple[float, float, Optional[str], float, float, Optional[str], int, float]
+
+PRICE_PER_KM = re.compile(r'\(([\d.]+) за км\)')
+CURRENCY_RATE = re.compile(r'Currency: ([\d.]+)')
+MAP_LINK = re.compile(r'/dir/(-?[\d.]+),(-?[\d.]+)/(-?[\d.]+),(-?[\d.]+)/')
+
+
+def parse_row(query: str, response: str) -> Optional[Quote]:
+    """
+    Extracts a training quote from a QueryLog row. Two kinds of rows are logged:
+    /calculate/ stores the RequestDTO as query and [telegram message, 'nosms'] as response,
+    /submit/ stores the CalculationDTO as query.
+    :param query: "query" column
+    :param response: "response" column
+    :return: Quote or None if the row is malformed or carries no price
+    """
+    try:
+        obj = json.loads(query)
+        if 'origin' in obj:
+            origin, destination = obj['origin'], obj['destination']
+            message = json.loads(response)[0]
+            price_per_km = float(PRICE_PER_KM.search(message).group(1))
+            rate = float(CURRENCY_RATE.search(message).group(1))
+            return (float(origin['lat']), float(origin['lng']), origin.get('countrycode'),
+                    float(destination['lat']), float(destination['lng']), destination.get('countrycode'),
+                    int(obj['vehicle']), price_per_km * rate)
+        a_lat, a_lng, b_lat, b_lng = map(float, MAP_LINK.search(obj['map_link']).groups())
+        return (a_lat, a_lng, None, b_lat, b_lng, None,
+                int(obj['transport_id']), float(obj['price_per_km']) * float(obj['currency_rate']))
+    except (TypeError, KeyError, IndexError, ValueError, AttributeError):
+        return None
+
+
+class QueryLogSource:
+
+    """
+    Streams training data for the price model out of the QueryLog.
+
+    Rows are read in chunks of `chunk_size` with fetchmany and parsed into (x, y) arrays: the
+    depots of a quote are not logged, so they are inferred as the straight-line closest depot of
+    each end (in the same country when the countrycode is known). Malformed rows are skipped.
+    Only one chunk is held in memory at a time, whatever the size of the log.
+
+    `part` selects a deterministic split of the log: every `holdout_every`-th row (by rowid)
+    is the 'holdout' part, the rest is the 'train' part. None reads the whole log.
+
+    Inputs are encoded with the field sizes of the model they are fed to (see PricePredictor.depots_qty):
+    depots and vehicles added after it was trained are left out.
+    """
+
+    PARTS = {None: '', 'train': 'WHERE rowid % ? != 0', 'holdout': 'WHERE rowid % ? = 0'}
+
+    def __init__(self, depots: Sequence[Depot], location: str = settings.QUERYLOG_DB_LOC, chunk_size: int = 10000,
+                 part: Optional[str] = None, holdout_every: int = settings.AI_RETRAIN_HOLDOUT_EVERY,
+                 depots_qty: int = encoding.DEPOTS_QTY, vehicles_qty: int = encoding.VEHICLES_QTY):
+        if part not in self.PARTS:
+            raise ValueError(f'Unknown part {part}, expected one of {list(self.PARTS)}')
+        self.depots_qty = depots_qty
+        self.vehicles_qty = vehicles_qty
+        depots = [depot for depot in depots if depot.id < depots_qty]
+        self.location = location
+        self.chunk_size = chunk_size
+        self.where = self.PARTS[part]
+        self.params = (holdout_every,) if part else ()
+        self.depot_ids = numpy.array([depot.id for depot in depots], dtype=numpy.intp)
+        self.depot_lats, self.depot_lngs = haversine.coordinates(depots)
+        self.depot_countries = numpy.array([depot.state.iso_code.upper() for depot in depots])
+        self.skipped = 0
+
+    def count(self) -> int:
+        """
+        :return: number of rows in the selected part of the log (parsable or not)
+        """
+        conn = sqlite3.connect(self.location)
+        try:
+            return conn.execute(f'SELECT count(*) FROM "queries" {self.where}', self.params).fetchone()[0]
+        finally:
+            conn.close()
+
+    def rows(self) -> Iterator[List[Tuple[str, str]]]:
+        """
+        :return: Iterator of chunks of (query, response) rows, in log order
+        """
+        # keras closes an abandoned generator from its own thread, the connection is closed there
+        conn = sqlite3.connect(self.location, check_same_thread=False)
+        try:
+            cursor = conn.execute(f'SELECT "query", "response" FROM "queries" {self.where} ORDER BY rowid', self.params)
+            while True:
+                chunk = cursor.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            conn.close()
+
+    def closest_depots(self, lats: numpy.ndarray, lngs: numpy.ndarray, countries: Sequence[Optional[str]]
+                       ) -> numpy.ndarray:
+        """
+        :return: ids of the straight-line closest depots, in-country where the country has depots
+        """
+        straight = haversine.haversine_matrix(lats, lngs, self.depot_lats, self.depot_lngs)
+        countries = numpy.array([(country or '').upper() for country in countries])
+        in_country = self.depot_countries[None, :] == countries[:, None]
+        straight = numpy.where(in_country | ~in_country.any(axis=1, keepdims=True), straight, numpy.inf)
+        return self.depot_ids[straight.argmin(axis=1)]
+
+    def arrays(self) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray]]:
+        """
+        :return: Iterator of (x, y) per chunk: model inputs (n, 2 * depots_qty + vehicles_qty)
+            and prices per km in UAH (n,), float32
+        """
+        for chunk in self.rows():
+            quotes = [quote for quote in (parse_row(query, response) for query, response in chunk)
+                      if quote is not None and quote[6] < self.vehicles_qty]
+            self.skipped += len(chunk) - len(quotes)
+            if not quotes:
+                continue
+            a_lat, a_lng, a_country, b_lat, b_lng, b_country, vehicle_ids, prices = zip(*quotes)
+            dpt_from_ids = self.closest_depots(numpy.array(a_lat), numpy.array(a_lng), a_country)
+            dpt_to_ids = self.closest_depots(numpy.array(b_lat), numpy.array(b_lng), b_country)
+            yield (encoding.encode(dpt_from_ids, dpt_to_ids, vehicle_ids, self.depots_qty, self.vehicles_qty),
+                   numpy.array(prices, dtype=numpy.float32))
+
+    def batches(self, batch_size: int, repeat: bool = False) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray]]:
+        """
+        Re-slices the chunks into batches for keras' fit
+        :param batch_size: samples per batch (the last batch of a pass may be smaller)
+        :param repeat: start over at the end of the log, for fit with steps_per_epoch
+        :return: Iterator of (x, y) batches
+        """
+        while True:
+            pending_x, pending_y = [], []
+            pending = 0
+            produced = False
+            for x, y in self.arrays():
+                produced = True
+                pending_x.append(x)
+                pending_y.append(y)
+                pending += len(y)
+                if pending < batch_size:
+                    continue
+                x, y = numpy.concatenate(pending_x), numpy.concatenate(pending_y)
+                for start in range(0, len(y) - batch_size + 1, batch_size):
+                    yield x[start:start + batch_size], y[start:start + batch_size]
+                tail = len(y) - len(y) % batch_size
+                pending_x, pending_y, pending = [x[tail:]], [y[tail:]], len(y) - tail
+            if pending:
+                yield numpy.concatenate(pending_x), numpy.concatenate(pending_y)
+            logger.info(f'QueryLog pass done, {self.skipped} rows skipped so far')
+            if not produced:
+                logger.warning(f'No usable rows in {self.location}')
+                return
+            if not repeat:
+                return
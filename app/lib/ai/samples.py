@@ -0,0 +1,90 @@
+import numpy
+from typing import Optional, Sequence, Tuple
+from app.lib.ai import encoding
+from app.lib.calc.calc_itself import DistanceResolvers, Predictors
+from app.lib.calc.depot_matrix import DEPOT_MATRIX, DepotMatrix
+from app.lib.calc.loadables.depot import Depot
+from app.lib.calc.loadables.vehicles import Vehicle
+from app.lib.utils.logger import logger
+
+
+def depot_distances(depots: Sequence[Depot], depot_matrix: Optional[DepotMatrix] = DEPOT_MATRIX) -> numpy.ndarray:
+    """
+    Depot x depot distances for training: road distances of the depot matrix,
+    haversine (see DistanceResolvers.haversine_array) for the pairs the matrix misses
+    :param depots: Depots, in the order of the rows and columns
+    :param depot_matrix: DepotMatrix, None for haversine only
+    :return: float64 array (len(depots), len(depots)) in meters
+    """
+    if depot_matrix is None:
+        return DistanceResolvers.haversine_array(depots, depots)
+    distances = depot_matrix.distances(depots)
+    missing = numpy.isnan(distances)
+    if missing.any():
+        distances[missing] = DistanceResolvers.haversine_array(depots, depots)[missing]
+        logger.info(f'{int(missing.sum())} of {missing.size} depot pairs are not in the depot matrix, '
+                    f'haversine is used for them')
+    return distances
+
+
+class SampleSpace:
+
+    """
+    Training samples of the price model as array math.
+
+    Everything the conventional price of a (depot, depot, vehicle) triple depends on is kept in
+    arrays: depot ratios, vehicle prices and the depot x depot distance matrix (taken once,
+    see depot_distances).
+    A batch is then index sampling, one encode call and one Predictors.conventional_many call.
+    Inputs are encoded with the field sizes of the model they train (see PricePredictor.depots_qty),
+    depots and vehicles added after it was built are not sampled.
+    """
+
+    def __init__(self, depots: Sequence[Depot], vehicles: Sequence[Vehicle],
+                 distances: Optional[numpy.ndarray] = None, depot_matrix: Optional[DepotMatrix] = DEPOT_MATRIX,
+                 depots_qty: int = encoding.DEPOTS_QTY, vehicles_qty: int = encoding.VEHICLES_QTY):
+        """
+        :param depots: Depots to sample from
+        :param vehicles: Vehicles to sample from
+        :param distances: depot x depot distances in m of all the depots, depot_distances of them by default
+        :param depot_matrix: DepotMatrix the default distances come from, None for haversine only
+        :param depots_qty: size of the depot fields of the model
+        :param vehicles_qty: size of the vehicle field of the model
+        """
+        self.depots_qty = depots_qty
+        self.vehicles_qty = vehicles_qty
+        known = [i for i, depot in enumerate(depots) if depot.id < depots_qty]
+        depots = [depots[i] for i in known]
+        vehicles = [vehicle for vehicle in vehicles if vehicle.id < vehicles_qty]
+        self.depot_ids = numpy.array([depot.id for depot in depots], dtype=numpy.intp)
+        self.departure_ratios = numpy.array([depot.departure_ratio for depot in depots], dtype=numpy.float64)
+        self.arrival_ratios = numpy.array([depot.arrival_ratio for depot in depots], dtype=numpy.float64)
+        self.vehicle_ids = numpy.array([vehicle.id for vehicle in vehicles], dtype=numpy.intp)
+        self.vehicle_prices = numpy.array([float(vehicle.price) for vehicle in vehicles], dtype=numpy.float64)
+        if distances is None:
+            self.distances = depot_distances(depots, depot_matrix)
+        else:
+            self.distances = distances[numpy.ix_(known, known)]
+
+    def evaluate(self, i: numpy.ndarray, j: numpy.ndarray, k: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :param i: positions of the starting depots
+        :param j: positions of the ending depots
+        :param k: positions of the vehicles
+        :return: x model inputs (n, 2 * depots_qty + vehicles_qty) and y conventional prices per km (n,), float32
+        """
+        x = encoding.encode(self.depot_ids[i], self.depot_ids[j], self.vehicle_ids[k],
+                            self.depots_qty, self.vehicles_qty)
+        y = Predictors.conventional_many(self.departure_ratios[i], self.arrival_ratios[j],
+                                         self.vehicle_prices[k], self.distances[i, j])
+        return x, y.astype(numpy.float32)
+
+    def sample(self, size: int, rng: numpy.random.Generator) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :param size: number of samples
+        :param rng: random generator the triples are drawn with
+        :return: x, y of random triples, see evaluate
+        """
+        return self.evaluate(rng.integers(0, len(self.depot_ids), size),
+                             rng.integers(0, len(self.depot_ids), size),
+                             rng.integers(0, len(self.vehicle_ids), size))
@@ -0,0 +1,166 @@
+import numpy
+from pathlib import Path
+from typing import List, Optional
+from app import settings
+from app.lib.ai import versions
+from app.lib.ai.encoding import DEPOTS_QTY, VEHICLES_QTY, encode_indices
+from app.lib.utils.logger import logger
+
+
+# Keras' leaky_relu default, the activation the hidden layers were trained with
+LEAKY_RELU_SLOPE = 0.2
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: numpy.maximum(x, 0),
+    'leaky_relu': lambda x: numpy.where(x >= 0, x, x * numpy.float32(LEAKY_RELU_SLOPE)),
+}
+
+
+def _within(ids, qty: int) -> bool:
+    ids = numpy.asarray(ids)
+    return ids.size == 0 or (ids.min() >= 0 and ids.max() < qty)
+
+
+class NumpyPricePredictor:
+
+    """
+    Serving counterpart of model.PricePredictor: runs the forward pass of the exported
+    dense network in NumPy (float32, like Keras), so serving does not import TensorFlow.
+
+    With a pointer file (see versions) the predictor serves the version the pointer names
+    and follows it on reload(), falling back to weights_loc / model_loc until one is published.
+
+    Ids are encoded with the field sizes saved with the weights, not with the current depot and
+    vehicle files: a depot added since training would shift every field after it.
+    """
+
+    def __init__(self, weights_loc: str = settings.AI_WEIGHTS_LOC, model_loc: str = settings.AI_MODEL_LOC,
+                 pointer_loc: Optional[str] = None):
+        """
+        :raise FileNotFoundError: the weights were not exported, see app.tools.export_model
+        """
+        self.weights_loc = weights_loc
+        self.model_loc = model_loc
+        self.pointer_loc = pointer_loc
+        self.version = None
+        self._follow_pointer()
+        if not Path(self.weights_loc).exists():
+            raise FileNotFoundError(f'{self.weights_loc} is not found. Export it from {self.model_loc} '
+                                    f'with python -m app.tools.export_model')
+        if versions.weights_outdated(self.model_loc, self.weights_loc):
+            logger.error(f'{self.weights_loc} is older than {self.model_loc}, it should be exported again')
+        self.load(self.weights_loc)
+
+    def _follow_pointer(self) -> None:
+        pointer = versions.read_pointer(self.pointer_loc) if self.pointer_loc else None
+        if pointer is not None:
+            self.version, self.model_loc, self.weights_loc = pointer.get('version'), pointer['model'], pointer['weights']
+
+    def reload(self) -> None:
+        """
+        Loads the weights again, from the version the pointer names now if there is a pointer.
+        Weights missing or older than their .keras model are refused, the loaded ones keep being served:
+        exporting is up to versions.publish and app.tools.export_model, serving never imports keras
+        """
+        self._follow_pointer()
+        if not Path(self.weights_loc).exists() or versions.weights_outdated(self.model_loc, self.weights_loc):
+            logger.error(f'Price model weights {self.weights_loc} are missing or older than {self.model_loc}, '
+                         f'keeping the loaded ones. Export them with python -m app.tools.export_model')
+            return
+        self.load(self.weights_loc)
+
+    @property
+    def layers(self) -> List:
+        return self._loaded[0]
+
+    @property
+    def depots_qty(self) -> int:
+        return self._loaded[1]
+
+    @property
+    def vehicles_qty(self) -> int:
+        return self._loaded[2]
+
+    def load(self, weights_loc: str) -> None:
+        """
+        :raise ValueError: the input width of the weights does not match their field sizes.
+            Weights exported without sizes must match the current depot and vehicle files
+        """
+        with numpy.load(weights_loc) as npz:
+            activations = [str(name) for name in npz['activations']]
+            layers = [(npz[f'kernel_{i}'], npz[f'bias_{i}'], ACTIVATIONS[name])
+                      for i, name in enumerate(activations)]
+            if 'depots_qty' in npz.files:
+                depots_qty, vehicles_qty = int(npz['depots_qty']), int(npz['vehicles_qty'])
+            else:
+                depots_qty, vehicles_qty = DEPOTS_QTY, VEHICLES_QTY
+        if layers[0][0].shape[0] != 2 * depots_qty + vehicles_qty:
+            raise ValueError(f'Price model {weights_loc} takes {layers[0][0].shape[0]} inputs, but is encoded with '
+                             f'{depots_qty} depot and {vehicles_qty} vehicle ids. The model should be retrained')
+        # Swapped in one assignment, concurrent forward passes see either set
+        self._loaded = (layers, depots_qty, vehicles_qty)
+        logger.info(f'Price model weights loaded from {weights_loc}: '
+                    f'{" -> ".join(str(kernel.shape) for kernel, _, _ in layers)}')
+
+    def forward(self, x: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param x: model inputs, shape (n, 371)
+        :return: model outputs, shape (n, 1)
+        """
+        h = numpy.asarray(x, dtype=numpy.float32)
+        for kernel, bias, activation in self.layers:
+            h = activation(h @ kernel + bias)
+        return h
+
+    def forward_indices(self, columns: numpy.ndarray) -> numpy.ndarray:
+        """
+        Same as forward, for inputs in the sparse form of encode_indices.
+        The first layer of a one-hot row is the sum of three kernel rows, no matrix product needed
+        :param columns: int array of shape (n, 3)
+        :return: model outputs, shape (n, 1)
+        """
+        return self._forward_indices(self.layers, columns)
+
+    @staticmethod
+    def _forward_indices(layers: List, columns: numpy.ndarray) -> numpy.ndarray:
+        kernel, bias, activation = layers[0]
+        h = activation(kernel[columns].sum(axis=1) + bias)
+        for kernel, bias, activation in layers[1:]:
+            h = activation(h @ kernel + bias)
+        return h
+
+    def warm_up(self) -> None:
+        """
+        Runs one forward pass, so the first request does not pay for NumPy's first-call setup
+        """
+        self.predict_many([0], [0], [0])
+
+    def predict_many(self, dpt_from_ids, dpt_to_ids, vehicle_ids) -> numpy.ndarray:
+        """
+        Makes predictions on route cost for many (from, to, vehicle) triples at once.
+        :param dpt_from_ids: array-like of Starting Depot ids
+        :param dpt_to_ids: array-like of Ending Depot ids
+        :param vehicle_ids: array-like of Vehicle ids
+        :return: float32 array of approx prices of 1 kilometer of the routes
+        :raise ValueError: an id the model was not trained with
+        """
+        layers, depots_qty, vehicles_qty = self._loaded
+        if not (_within(dpt_from_ids, depots_qty) and _within(dpt_to_ids, depots_qty)
+                and _within(vehicle_ids, vehicles_qty)):
+            raise ValueError(f'Price model knows depot ids below {depots_qty} and vehicle ids below {vehicles_qty}')
+        columns = encode_indices(dpt_from_ids, dpt_to_ids, vehicle_ids, depots_qty, vehicles_qty)
+        return self._forward_indices(layers, columns)[:, 0]
+
+    def predict(self, dpt_from_id: int, dpt_to_id: int, vehicle_id: int) -> float:
+        """
+        Makes predictions on route cost.
+        param dpt_from: Starting Depot id
+        param dpt_to: Ending Depot id
+        param vehicle: Chosen Vehicle id
+        :return: Approx price of 1 kilometer of the route
+        """
+        return float(self.predict_many([dpt_from_id], [dpt_to_id], [vehicle_id])[0])
+
+
+ML_MODEL = NumpyPricePredictor(pointer_loc=settings.AI_MODEL_POINTER_LOC)
@@ -0,0 +1,65 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from app import settings
+
+
+def read_pointer(pointer_loc: str = settings.AI_MODEL_POINTER_LOC) -> Optional[Dict]:
+    """
+    :param pointer_loc: pointer file
+    :return: the served version {'version', 'model', 'weights', ...} or None if nothing was published yet
+    """
+    try:
+        with open(pointer_loc, mode='r', encoding='utf-8') as f:
+            pointer = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if not isinstance(pointer, dict) or 'model' not in pointer or 'weights' not in pointer:
+        return None
+    return pointer
+
+
+def new_version(versions_dir: str = settings.AI_MODEL_VERSIONS_DIR) -> Tuple[str, str, str]:
+    """
+    :param versions_dir: directory of the versioned files
+    :return: (version, .keras location, .npz location) of a new version
+    """
+    version = time.strftime('%Y%m%d-%H%M%S')
+    directory = Path(versions_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    return version, str(directory / f'{version}.keras'), str(directory / f'{version}.npz')
+
+
+def weights_outdated(model_loc: str, weights_loc: str) -> bool:
+    """
+    :return: whether the .keras model was saved after its weights were exported
+    """
+    model, weights = Path(model_loc), Path(weights_loc)
+    return model.exists() and (not weights.exists() or model.stat().st_mtime_ns > weights.stat().st_mtime_ns)
+
+
+def publish(version: str, model_loc: str, weights_loc: str, pointer_loc: str = settings.AI_MODEL_POINTER_LOC,
+            **info) -> Dict:
+    """
+    Points the serving processes to a version. The weights are exported first if they are missing
+    or older than the model, serving refuses them otherwise. The pointer file is replaced atomically,
+    a reader sees either the old or the new one
+    :param version: version name
+    :param model_loc: .keras file of the version
+    :param weights_loc: .npz file of the version
+    :param pointer_loc: pointer file
+    :param info: anything else to record, e.g. validation results
+    :return: the written pointer
+    """
+    if weights_outdated(model_loc, weights_loc):
+        from app.lib.ai.encoding import export_weights  # Imports keras, publishing runs out of the serving process
+        export_weights(model_loc, weights_loc)
+    pointer = {'version': version, 'model': model_loc, 'weights': weights_loc, **info}
+    Path(pointer_loc).parent.mkdir(parents=True, exist_ok=True)
+    tmp_loc = f'{pointer_loc}.{os.getpid()}.tmp'
+    with open(tmp_loc, mode='w', encoding='utf-8') as f:
+        json.dump(pointer, f, indent=2)
+    os.replace(tmp_loc, pointer_loc)
+    return pointer
@@ -1,8 +1,14 @@
 
 from app import settings
 import requests
-from app.lib.calc.distance import Distance
-from typing import Iterable, Tuple, List, Set
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from app.lib.apis import matrix_planner
+from app.lib.calc.distance import Distance, PairKey, pair_key
+from typing import Hashable, Iterable, Tuple, List, Dict
 from app.lib.calc.place import LatLngAble, Place
 from json import JSONDecodeError
 from app.lib.utils.logger import logger
@@ -14,25 +20,172 @@ class GoogleApiRequestError(Exception):
     """
 
 
+class OverQueryLimitError(GoogleApiRequestError):
+    """
+    Raises when Google answers OVER_QUERY_LIMIT, i.e. we are sending elements too fast
+    """
+
+
+class AdaptiveLimit:
+
+    """
+    Concurrency limit for the chunk requests (AIMD): halves on OVER_QUERY_LIMIT,
+    grows back by one after each successful request, never above `maximum`.
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def success(self) -> None:
+        with self._cond:
+            if self.limit < self.maximum:
+                self.limit += 1
+                self._cond.notify_all()
+
+    def back_off(self) -> None:
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+
+
+class SingleFlight:
+
+    """
+    Coalesces concurrent lookups of the same keys. The first caller of a key leads its flight
+    and resolves it, callers asking for the key while it is in flight, or up to `linger` seconds
+    after it landed, join the flight and take its value instead of resolving the key again.
+    Flights that landed without a value are forgotten at once, the next caller leads a new one.
+    """
+
+    class Flight:
+
+        __slots__ = ('landed', 'value')
+
+        def __init__(self):
+            self.landed = threading.Event()
+            self.value = None
+
+    def __init__(self, linger: float):
+        self.linger = linger
+        self._flights: Dict[Hashable, SingleFlight.Flight] = {}
+        self._landed = deque()  # (landed at, key, flight) in landing order
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def _forget_landed(self, now: float) -> None:
+        # Called with the lock held
+        while self._landed and now - self._landed[0][0] > self.linger:
+            _, key, flight = self._landed.popleft()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[List[Hashable], Dict[Hashable, 'SingleFlight.Flight']]:
+        """
+        :param keys: keys the caller needs
+        :return: keys the caller leads and has to land, flights of the other keys to wait for
+        """
+        led, joined = {}, {}
+        with self._lock:
+            self._forget_landed(time.monotonic())
+            for key in keys:
+                if key in led or key in joined:
+                    continue
+                flight = self._flights.get(key)
+                if flight is None:
+                    led[key] = self._flights[key] = SingleFlight.Flight()
+                else:
+                    joined[key] = flight
+        return list(led), joined
+
+    def land(self, keys: Iterable[Hashable], values: Dict[Hashable, object]) -> None:
+        """
+        Publishes the values of the led keys and wakes up the callers that joined them
+        :param keys: keys led by the caller, see claim
+        :param values: resolved values, keys without one land empty
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                flight = self._flights[key]
+                flight.value = values.get(key)
+                if flight.value is None or self.linger <= 0:
+                    del self._flights[key]
+                else:
+                    self._landed.append((now, key, flight))
+                flight.landed.set()
+
+    @staticmethod
+    def wait(flights: Dict[Hashable, 'SingleFlight.Flight'], timeout: float) -> Dict[Hashable, object]:
+        """
+        :param flights: joined flights, see claim
+        :param timeout: seconds to wait for all of them
+        :return: values of the flights that landed with one
+        """
+        deadline = time.monotonic() + timeout
+        values = {}
+        for key, flight in flights.items():
+            if flight.landed.wait(max(0.0, deadline - time.monotonic())) and flight.value is not None:
+                values[key] = flight.value
+        return values
+
+
 class API:
 
     def __init__(self):
         self.apiadr = settings.GOOGLE_APIADR
         self.apikey = settings.GOOGLE_APIKEY
-
-    @staticmethod
-    def _chunks(lst, n):
-        """Yield successive n-sized chunks from lst."""
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
+        self.timeout = settings.GOOGLE_API_TIMEOUT
+        self.retries = settings.GOOGLE_API_RETRIES
+
+        # One pooled session keeps TCP+TLS connections alive between requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GOOGLE_API_MAX_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=settings.GOOGLE_API_MAX_WORKERS,
+                                           thread_name_prefix='gapi')
+        self.concurrency = AdaptiveLimit(settings.GOOGLE_API_MAX_WORKERS)
+        self.flights = SingleFlight(settings.GOOGLE_API_SINGLE_FLIGHT_LINGER)
+        self.single_flight_wait = settings.GOOGLE_API_SINGLE_FLIGHT_WAIT
+
+        self._counters_lock = threading.Lock()
+        self.requests = 0
+        self.elements = 0
+        self.over_query_limit = 0
+        self.coalesced = 0
+
+    def stats(self) -> dict:
+        return {'requests': self.requests,
+                'elements': self.elements,
+                'over_query_limit': self.over_query_limit,
+                'coalesced': self.coalesced,
+                'concurrency': self.concurrency.limit}
 
     @staticmethod
     def _parse_api_response(
             api_response: dict,
             origins: List[LatLngAble],
-            destinations: List[LatLngAble]) -> List[Distance]:
+            destinations: List[LatLngAble]) -> Dict[PairKey, float]:
         """
         Parses a Google Distance Matrix API response and extracts distance data between each origin-destination pair.
+        The result is keyed by the canonical coordinate pair (see distance.pair_key), so it can be matched
+        against Distances in O(1) each.
 
         :param api_response: Original response from API already in form of dict
         :param origins: List of origins the request was made
@@ -40,18 +193,17 @@ class API:
 
         It is very important to use exactly the same origins and destinations
         (and their order) that used in request
-        :return: List of Distances
+        :return: dict {pair key: distance in meters}
         """
-        extracted_distances = []
+        extracted_distances = {}
         try:
             for i, row in enumerate(api_response['rows']):
+                origin = origins[i]
                 for j, element in enumerate(row['elements']):
                     if element['status'] == 'OK':
-                        extracted_distances.append(Distance(
-                            place_from=Place(lat=origins[i].lat, lng=origins[i].lng),
-                            place_to=Place(lat=destinations[j].lat, lng=destinations[j].lng),
-                            distance=element['distance']['value']
-                        ))
+                        destination = destinations[j]
+                        key = pair_key(origin.lat, origin.lng, destination.lat, destination.lng)
+                        extracted_distances[key] = element['distance']['value']
         except (IndexError, KeyError) as e:
             logger.exception(f'Failed to process Google Matrix API response: {api_response}')
             raise GoogleApiRequestError(f'Failed to process API resp {e}')
@@ -65,10 +217,14 @@ class API:
                       'key': self.apikey}
 
         try:
-            raw_response = requests.get(self.apiadr, url_params)
+            raw_response = self.session.get(self.apiadr, params=url_params, timeout=self.timeout)
             dct_response = raw_response.json()
             if dct_response.get('status') == 'OK':
                 return dct_response
+            elif dct_response.get('status') == 'OVER_QUERY_LIMIT':
+                logger.warning('GAPI answered OVER_QUERY_LIMIT')
+                raise OverQueryLimitError(f'Status: OVER_QUERY_LIMIT, '
+                                          f'message: {dct_response.get("error_message")}')
             else:
                 logger.error(f'Unexpected GAPI response status: {dct_response.get("status")}')
                 raise GoogleApiRequestError(f'Status: {dct_response.get("status")}, '
@@ -92,72 +248,134 @@ class API:
         places_params = [f'{place.lat},{place.lng}' for place in places]
         return '|'.join(places_params)
 
-    @staticmethod
-    def _split_origins_destinations(
-            dists: Iterable[Distance]
-    ) -> Tuple[Set['LatLngAble'], Set['LatLngAble']]:
+    def _request_chunk(self, chunk_orig: List[LatLngAble], chunk_dest: List[LatLngAble]) -> Dict[PairKey, float]:
+        """
+        Requests one origins x destinations chunk under the adaptive concurrency limit.
+        OVER_QUERY_LIMIT lowers the limit and the chunk is retried with exponential backoff.
+        :param chunk_orig: origins of the chunk
+        :param chunk_dest: destinations of the chunk
+        :return: distances parsed from the response, see _parse_api_response
         """
-        Builds two sets of unique origin and destination places from a collection of Distance objects.
-        :param dists: Distances to resolve
-        :return: Two sets of LatLngAbles to further provide them to an API request
+        for attempt in range(self.retries + 1):
+            with self.concurrency:
+                try:
+                    api_response = self._make_api_request(
+                        self._make_places_url_param(chunk_orig),
+                        self._make_places_url_param(chunk_dest)
+                    )
+                except OverQueryLimitError:
+                    with self._counters_lock:
+                        self.over_query_limit += 1
+                    self.concurrency.back_off()
+                    if attempt == self.retries:
+                        raise
+                else:
+                    self.concurrency.success()
+                    with self._counters_lock:
+                        self.requests += 1
+                        self.elements += len(chunk_orig) * len(chunk_dest)
+                    return self._parse_api_response(api_response, chunk_orig, chunk_dest)
+            time.sleep(0.5 * 2 ** attempt)
+
+    def _request_chunks(self, chunks: List[Tuple[List[LatLngAble], List[LatLngAble]]]) -> Dict[PairKey, float]:
         """
-        origins = set()
-        destinations = set()
-        for distance in dists:
-            origins.add(distance.place_from)
-            destinations.add(distance.place_to)
-        return origins, destinations
+        Runs the chunk requests on the thread pool, so a multi-chunk matrix takes about one round trip.
+        Failed chunks are logged and skipped (their distances stay unresolved) unless all of them fail.
+        :param chunks: List of (origins, destinations) chunks
+        :return: distances acquired from all successful chunks, see _parse_api_response
+        """
+        if len(chunks) == 1:
+            return self._request_chunk(*chunks[0])
+
+        futures = [self.executor.submit(self._request_chunk, *chunk) for chunk in chunks]
+        acquired, errors = {}, []
+        for future in futures:
+            try:
+                acquired.update(future.result())
+            except GoogleApiRequestError as e:
+                errors.append(e)
+        if errors:
+            logger.error(f'{len(errors)} of {len(chunks)} GAPI chunk requests failed')
+            if len(errors) == len(chunks):
+                raise errors[0]
+        return acquired
 
     def resolve_distances(self, unresolved: List[Distance]) -> Tuple[List[Distance], List[Distance]]:
         """
         Resolves a list of unresolved Distance objects by querying the Distance Matrix API in chunks.
 
-        This method divides the provided origins and destinations into chunks that comply with the API's
-        request limits, sends requests for all origin-destination pairs, and collects the resulting distance data.
+        The origin-destination pairs of the Distances are grouped into the fewest requests and billed elements
+        that comply with the API's limits (see matrix_planner.plan), and the resulting distance data is collected.
 
-        Each unresolved Distance is matched against the acquired data. If a match is found (based on equality),
-        it is added to the resolved list and removed from the unresolved list.
+        Each unresolved Distance is matched against the acquired data by its canonical key (see Distance.key).
+        If a match is found, it is resolved and goes to the resolved list, otherwise to the unresolved one.
         :param unresolved: Distances to resolve.
         :return: List of Resolved distances, List of Unresolved distances (in case of errors or API reasons)
         """
+        return self.resolve_distance_groups([unresolved])
 
-        origins, destinations = self._split_origins_destinations(unresolved)
-
-        # Maximum of 25 origins or 25 destinations per request
-        # Maximum 100 elements per request.
-        chunk_size = 25 if len(origins) * len(destinations) <= 100 else 10
-        chunks_of_origins = [chunk for chunk in self._chunks(list(origins), chunk_size)]
-        chunks_of_destinations = [chunk for chunk in self._chunks(list(destinations), chunk_size)]
-
-        # Requesting each chunk and extending result with each response
-        acquired = []
-        for chunk_orig in chunks_of_origins:
-            for chunk_dest in chunks_of_destinations:
-                api_response = self._make_api_request(
-                    self._make_places_url_param(chunk_orig),
-                    self._make_places_url_param(chunk_dest)
-                )
-                acquired.extend(self._parse_api_response(api_response, chunk_orig, chunk_dest))
+    def resolve_distance_groups(self, groups: List[List[Distance]]) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Same as resolve_distances for several independent groups of Distances at once.
+        The pairs of all the groups are planned together (see matrix_planner.plan): unrelated lookups
+        do not multiply each other's elements, small ones share requests, and all the chunks are
+        requested concurrently.
+        Pairs another thread is requesting at the same time (or has just got) are not requested
+        again, their results are waited for and shared (see SingleFlight)
+        :param groups: Lists of Distances to resolve
+        :return: List of Resolved distances, List of Unresolved distances (in case of errors or API reasons)
+        """
+        led, joined = self.flights.claim(dist.key for group in groups for dist in group)
+        if joined:
+            with self._counters_lock:
+                self.coalesced += len(joined)
+
+        # Every led pair is requested once, within the first group it appears in
+        leading = set(led)
+        own_groups = []
+        for group in groups:
+            own_group = [dist for dist in group if dist.key in leading]
+            leading.difference_update(dist.key for dist in own_group)
+            if own_group:
+                own_groups.append(own_group)
+
+        acquired = {}
+        try:
+            if own_groups:
+                acquired = self._request_groups(own_groups)
+        finally:
+            self.flights.land(led, acquired)
+        acquired.update(self.flights.wait(joined, self.single_flight_wait))
+        return self._match([dist for group in groups for dist in group], acquired)
+
+    def _request_groups(self, groups: List[List[Distance]]) -> Dict[PairKey, float]:
+        """
+        Requests the pairs of all the groups as planned by matrix_planner.plan: the fewest billed elements
+        and requests within the API limits, never more requests than the cross products of the groups,
+        all of them concurrently
+        :param groups: Lists of Distances
+        :return: distances acquired from all successful chunks, see _parse_api_response
+        """
+        chunks = matrix_planner.plan([(dist.place_from, dist.place_to) for dist in group] for group in groups)
+        return self._request_chunks(chunks)
 
-        resolved = []
-        for distance_candidate in unresolved.copy():
-            try:
-                # Here we are making resolved list from unresolved using acquired as base
-                # Populating resolved while depopulating unresolved
-
-                # Looking for match between one of unresolved and all the acquired
-                index = acquired.index(distance_candidate)
-
-                # Removing from unresolved appending to resolved
-                distance_candidate.distance = acquired[index].distance  # Resolving distance
-                resolved.append(distance_candidate)  # Appending recently resolved distance to resolved list
-                unresolved.remove(distance_candidate)  # Removing recently resolved distance from unresolved list
-
-            except ValueError:
-                # List.index() Raises ValueError if the value is not present.
-                # In this case it means that candidate was not resolved and
-                # stays where it was. Do nothing
-                pass
+    @staticmethod
+    def _match(candidates: Iterable[Distance], acquired: Dict[PairKey, float]
+               ) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Resolves candidates from the acquired distances, O(1) per candidate
+        :param candidates: Distances to resolve
+        :param acquired: distances keyed by the canonical pair key
+        :return: List of Resolved distances, List of Unresolved distances
+        """
+        resolved, unresolved = [], []
+        for distance_candidate in candidates:
+            meters = acquired.get(distance_candidate.key)
+            if meters is None:
+                unresolved.append(distance_candidate)
+            else:
+                distance_candidate.distance = meters
+                resolved.append(distance_candidate)
         return resolved, unresolved
 
 
@@ -0,0 +1,190 @@
+import heapq
+import math
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+from app import settings
+from app.lib.calc.place import LatLngAble
+
+
+# Distance Matrix API limits per request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+PlaceKey = Tuple[float, float]
+Block = Tuple[FrozenSet[PlaceKey], FrozenSet[PlaceKey]]
+Request = Tuple[List[LatLngAble], List[LatLngAble]]
+Pair = Tuple[LatLngAble, LatLngAble]
+
+
+def place_key(place: LatLngAble) -> PlaceKey:
+    """
+    :return: coordinates rounded to 6 digits, like distance.pair_key
+    """
+    return round(place.lat, 6), round(place.lng, 6)
+
+
+def _blocks(rows: Dict[PlaceKey, set]) -> List[Block]:
+    """
+    Groups the rows with the same set of columns: every group is a complete block of needed pairs
+    :param rows: row key -> column keys
+    :return: (row keys, column keys) blocks
+    """
+    grouped = defaultdict(set)
+    for row, columns in rows.items():
+        grouped[frozenset(columns)].add(row)
+    return [(frozenset(rows_), columns) for columns, rows_ in grouped.items()]
+
+
+def cover(pairs: Iterable[Tuple[PlaceKey, PlaceKey]]) -> List[Block]:
+    """
+    Covers the pairs with complete (origins x destinations) blocks, each pair in exactly one of them,
+    so no element outside of the pairs is ever requested. Greedy: the largest block out of grouping
+    the origins by their destinations or the destinations by their origins is taken first, with every
+    other block of the same grouping that is at least as large as the best block of the other one
+    :param pairs: (origin key, destination key) pairs
+    :return: (origin keys, destination keys) blocks
+    """
+    remaining = set(pairs)
+    taken = []
+    while remaining:
+        by_origin, by_destination = defaultdict(set), defaultdict(set)
+        for origin, destination in remaining:
+            by_origin[origin].add(destination)
+            by_destination[destination].add(origin)
+        row_blocks = _blocks(by_origin)
+        column_blocks = [(origins, destinations) for destinations, origins in _blocks(by_destination)]
+        best_row = max(len(o) * len(d) for o, d in row_blocks)
+        best_column = max(len(o) * len(d) for o, d in column_blocks)
+        # Blocks of one grouping never share a pair, they can all be taken at once
+        if best_row >= best_column:
+            chosen = [(o, d) for o, d in row_blocks if len(o) * len(d) >= best_column]
+        else:
+            chosen = [(o, d) for o, d in column_blocks if len(o) * len(d) > best_row]
+        for origins, destinations in chosen:
+            remaining.difference_update((origin, destination) for origin in origins for destination in destinations)
+        taken.extend(chosen)
+    return taken
+
+
+def shape(origins_qty: int, destinations_qty: int) -> Tuple[int, int]:
+    """
+    Chunk shape splitting an origins x destinations block into the fewest requests within the limits
+    :return: number of origin parts, number of destination parts
+    """
+    best = None
+    for per_request in range(1, min(origins_qty, MAX_ORIGINS) + 1):
+        columns = min(MAX_DESTINATIONS, MAX_ELEMENTS // per_request)
+        parts = (math.ceil(origins_qty / per_request), math.ceil(destinations_qty / columns))
+        if best is None or parts[0] * parts[1] < best[0] * best[1]:
+            best = parts
+    return best
+
+
+def _split(items: List, parts: int) -> List[List]:
+    """
+    Splits items into `parts` slices of sizes differing by one at most
+    """
+    size, extra = divmod(len(items), parts)
+    slices, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(items[start:end])
+        start = end
+    return slices
+
+
+def _tile(origins: FrozenSet[PlaceKey], destinations: FrozenSet[PlaceKey]) -> List[Block]:
+    """
+    Splits a block into the fewest evenly sized requests within the limits, see shape
+    """
+    origins, destinations = sorted(origins), sorted(destinations)
+    origin_parts, destination_parts = shape(len(origins), len(destinations))
+    return [(frozenset(chunk_orig), frozenset(chunk_dest))
+            for chunk_orig in _split(origins, origin_parts)
+            for chunk_dest in _split(destinations, destination_parts)]
+
+
+def _fits(origins_qty: int, destinations_qty: int) -> bool:
+    return (origins_qty <= MAX_ORIGINS and destinations_qty <= MAX_DESTINATIONS
+            and origins_qty * destinations_qty <= MAX_ELEMENTS)
+
+
+def _elements(requests: List[Block]) -> int:
+    return sum(len(origins) * len(destinations) for origins, destinations in requests)
+
+
+def merge(requests: List[Block], weight: float, max_requests: int) -> List[Block]:
+    """
+    Greedily merges pairs of requests into one request of their united origins and destinations,
+    the merge billing the fewest extra elements first. Merges go on while they bill fewer than `weight`
+    extra elements, then while there are more than max_requests requests and a merge fits the limits
+    :param requests: (origin keys, destination keys) requests within the limits
+    :param weight: billed elements one request less is worth
+    :param max_requests: most requests wanted, whatever the merges bill
+    :return: (origin keys, destination keys) requests
+    """
+    alive = dict(enumerate(requests))
+    heap = []
+
+    def push(i: int, j: int) -> None:
+        (origins_i, destinations_i), (origins_j, destinations_j) = alive[i], alive[j]
+        origins_qty, destinations_qty = len(origins_i | origins_j), len(destinations_i | destinations_j)
+        if _fits(origins_qty, destinations_qty):
+            extra = (origins_qty * destinations_qty - len(origins_i) * len(destinations_i)
+                     - len(origins_j) * len(destinations_j))
+            heapq.heappush(heap, (extra, i, j))
+
+    for i in range(len(requests)):
+        for j in range(i + 1, len(requests)):
+            push(i, j)
+    next_id = len(requests)
+    while heap:
+        extra, i, j = heap[0]
+        if extra >= weight and len(alive) <= max_requests:
+            break
+        heapq.heappop(heap)
+        if i not in alive or j not in alive:
+            continue
+        (origins_i, destinations_i), (origins_j, destinations_j) = alive.pop(i), alive.pop(j)
+        alive[next_id] = (origins_i | origins_j, destinations_i | destinations_j)
+        for k in list(alive):
+            if k != next_id:
+                push(k, next_id)
+        next_id += 1
+    return list(alive.values())
+
+
+def plan(groups: Iterable[Iterable[Pair]], weight: float = settings.GOOGLE_API_REQUEST_WEIGHT) -> List[Request]:
+    """
+    Plans the Distance Matrix requests resolving the pairs of the groups within 25 origins,
+    25 destinations and 100 elements per request, for the fewest billed elements plus `weight`
+    elements per request. Two plans are weighed:
+     - the cross product of every group, each one tiled into the fewest requests (see shape),
+     - only the pairs themselves (see cover), tiled and then merged where a request less is worth
+       the extra elements, and further until there are no more requests than in the first plan (see merge).
+    The second one is never taken with more requests than the first one.
+    :param groups: (origin, destination) places of every group, duplicates are requested once
+    :param weight: billed elements one request less is worth
+    :return: (origins, destinations) of every request
+    """
+    places = {}
+    keyed_groups = []
+    for group in groups:
+        keys = set()
+        for origin, destination in group:
+            origin_key, destination_key = place_key(origin), place_key(destination)
+            places.setdefault(origin_key, origin)
+            places.setdefault(destination_key, destination)
+            keys.add((origin_key, destination_key))
+        if keys:
+            keyed_groups.append(keys)
+
+    crossed = [request for keys in keyed_groups
+               for request in _tile(frozenset(o for o, _ in keys), frozenset(d for _, d in keys))]
+    pairs = set().union(*keyed_groups)
+    covered = merge([request for block in cover(pairs) for request in _tile(*block)], weight, len(crossed))
+    candidates = [requests for requests in (covered, crossed) if len(requests) <= len(crossed)]
+    best = min(candidates, key=lambda requests: (weight * len(requests) + _elements(requests), len(requests)))
+    return [([places[key] for key in sorted(origins)], [places[key] for key in sorted(destinations)])
+            for origins, destinations in best]
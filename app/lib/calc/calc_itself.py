@@ -1,15 +1,20 @@
 
 import math
-from typing import Callable, Tuple, Iterable, List
+import numpy
+from typing import Callable, Dict, Iterator, Optional, Tuple, Iterable, List, Sequence, Union
 from typing import cast
-from app.lib.ai.model import ML_MODEL
+from app import settings
+from app.lib.ai.price_table import PRICE_TABLE
 from app.lib.apis import googleapi as googleapi
 from app.lib.apis.googleapi import GoogleApiRequestError
 from app.lib.calc.place import Place, LatLngAble
-from app.lib.calc.distance import Distance
+from app.lib.calc.distance import Distance, PairKey
 from app.lib.calc.loadables import depotpark
+from app.lib.calc import depot_matrix
+from app.lib.calc import haversine as haversine_kernel
+from app.lib.calc.route_cache import ROUTE_CACHE, RoutePlan, RoutePlanCache
 from app.lib.calc.loadables.statepark import Currency
-from app.lib.calc.loadables.vehicles import Vehicle
+from app.lib.calc.loadables.vehicles import Vehicle, VEHICLES
 from app.lib.calc.loadables.depotpark import Depot, NoDepots
 from app.lib.utils.DTOs import CalculationDTO
 from app.lib.utils.DTOs import RequestDTO
@@ -21,6 +26,10 @@ from app.lib.utils.logger import logger
 DEPOT_PARK = depotpark.DEPOTPARK
 CACHE = cache.CACHE
 GAPI = googleapi.GAPI
+DEPOT_MATRIX = depot_matrix.DEPOT_MATRIX
+
+
+Route = Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble]
 
 
 class ZeroDistanceResultsError(RuntimeError):
@@ -47,16 +56,41 @@ class DistanceResolvers:
         return product
 
     @staticmethod
-    def _resolve_distances_using_cache(dists: Iterable[Distance], cache_) -> Tuple[List[Distance], List[Distance]]:
+    def _resolve_distances_using_depot_matrix(dists: Iterable[Distance], dmatrix_
+                                              ) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Resolves depot to depot distances by index in the precomputed DepotMatrix
+        :param dists: Iterable of unresolved Distance objects
+        :param dmatrix_: DepotMatrix instance
+        :return: resolved and unresolved dists
+        """
         resolved = []
         unresolved = []
-
         for dist in dists:
-            meters: float = cache_.cache_look(
-                dist.place_from.lat,
-                dist.place_from.lng,
-                dist.place_to.lat,
-                dist.place_to.lng)
+            meters = dmatrix_.lookup(dist.place_from, dist.place_to)
+            if meters is not None:
+                dist.distance = meters
+                resolved.append(dist)
+            else:
+                unresolved.append(dist)
+        return resolved, unresolved
+
+    @staticmethod
+    def _resolve_distances_using_cache(dists: Iterable[Distance], cache_) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Resolves distances with a single bulk cache lookup
+        :param dists: Iterable of unresolved Distance objects
+        :param cache_: Cache instance
+        :return: resolved and unresolved dists
+        """
+        dists = list(dists)
+        pairs = [(dist.place_from.lat, dist.place_from.lng, dist.place_to.lat, dist.place_to.lng) for dist in dists]
+        hits, _ = cache_.cache_look_many(pairs)
+
+        resolved = []
+        unresolved = []
+        for dist, pair in zip(dists, pairs):
+            meters = hits.get(pair)
             if meters is not None and isinstance(meters, (int, float)):
                 dist.distance = meters
                 resolved.append(dist)
@@ -79,17 +113,88 @@ class DistanceResolvers:
             logger.exception(e)
             return [], [*dists]
 
+    @staticmethod
+    def _resolve_distance_groups_using_api(groups: List[List[Distance]], gapi_
+                                           ) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Same as _resolve_distances_using_api for several independent groups of dists
+        :param groups: Lists of unresolved Distance objects
+        :param gapi_: Google API object
+        :return: resolved and unresolved dists
+        """
+        try:
+            return gapi_.resolve_distance_groups(groups)
+        except GoogleApiRequestError as e:
+            logger.exception(e)
+            return [], [dist for group in groups for dist in group]
+
+    @staticmethod
+    def resolve_groups(groups: List[List[Distance]],
+                       cache_=CACHE, gapi_=GAPI, dmatrix_=DEPOT_MATRIX) -> Tuple[List[Distance], List[Distance]]:
+        """
+        Resolves the Distances of many independent lookups together. Every unique pair (see Distance.key)
+        is looked up once: in the depot matrix, in one bulk cache lookup and, for the misses, in one
+        concurrent set of Matrix API requests where each group is requested as the cross product of
+        its own origins and destinations. Duplicated pairs get the distance of their first occurrence.
+        Unlike matrix, nothing is raised when some or all of the Distances stay unresolved
+        :param groups: Lists of unresolved Distance objects, e.g. depots -> A of one route
+        :param cache_ Cache instance (defaults to global CACHE)
+        :param gapi_ Google Matrix API instance (defaults to global GAPI)
+        :param dmatrix_ DepotMatrix instance (defaults to global DEPOT_MATRIX)
+        :return: resolved and unresolved dists, duplicates included
+        """
+        unique = {}
+        for group in groups:
+            for dist in group:
+                unique.setdefault(dist.key, dist)
+
+        resolved, unresolved = DistanceResolvers._resolve_distances_using_depot_matrix(unique.values(), dmatrix_)
+        accum, unresolved = DistanceResolvers._resolve_distances_using_cache(unresolved, cache_)
+        resolved.extend(accum)
+
+        # Every missing pair is requested once, within the first group it appears in
+        missing = {dist.key for dist in unresolved}
+        api_groups = []
+        for group in groups:
+            api_group = [unique[dist.key] for dist in group if dist.key in missing]
+            missing.difference_update(dist.key for dist in api_group)
+            if api_group:
+                api_groups.append(api_group)
+        accum = DistanceResolvers._resolve_distance_groups_using_api(api_groups, gapi_)[0] if api_groups else []
+        for dist in accum:
+            cache_.cache_it(
+                dist.place_from.lat,
+                dist.place_from.lng,
+                dist.place_to.lat,
+                dist.place_to.lng,
+                dist.distance)
+        logger.debug(f'Grouped resolve of {len(unique)} unique pairs: '
+                     f'{len(resolved)} known, {len(accum)} from Matrix API')
+
+        resolved, unresolved = [], []
+        for group in groups:
+            for dist in group:
+                origin = unique[dist.key]
+                if origin.resolved:
+                    dist.distance = origin.distance
+                    resolved.append(dist)
+                else:
+                    unresolved.append(dist)
+        return resolved, unresolved
+
     @staticmethod
     def matrix(places_from: Iterable[LatLngAble], places_to: Iterable[LatLngAble],
-               cache_=CACHE, gapi_=GAPI) -> List[Distance]:
+               cache_=CACHE, gapi_=GAPI, dmatrix_=DEPOT_MATRIX) -> List[Distance]:
         """
-        Fetches distance between two Places with Google Matrix API or cache
+        Fetches distance between two Places with the depot matrix, cache or Google Matrix API
         :param places_from: Iterable of origin Places
         :param places_to: Iterable of destination Places
         :param cache_ Cache instance retrieving distances between
         geographic coordinates (defaults to global CACHE)
         :param gapi_ Google Matrix API instance retrieving distances
         with requests (defaults to global GAPI)
+        :param dmatrix_ DepotMatrix instance with precomputed depot to depot
+        distances (defaults to global DEPOT_MATRIX)
         :return: List of resolved Distance objects (sorted ascending)
         that containing .distance property or None if there is no land way existed
         :raises: ZeroDistanceResultsError in case any of the methods (Cache, API)
@@ -97,6 +202,9 @@ class DistanceResolvers:
         """
         resolved, unresolved = [], DistanceResolvers._produce_distances_from_places(places_from, places_to)
 
+        accum, unresolved = DistanceResolvers._resolve_distances_using_depot_matrix(unresolved, dmatrix_)
+        resolved.extend(accum)
+
         accum, unresolved = DistanceResolvers._resolve_distances_using_cache(unresolved, cache_)
         resolved.extend(accum)
         logger.debug(f'Cache resolved, unresolved: {len(resolved)}, {len(unresolved)}')
@@ -141,26 +249,93 @@ class DistanceResolvers:
         a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
-        return r * c * 1.33  # Add 33% to better fit matrix distance so both of them are +- the same
+        return r * c * haversine_kernel.ROAD_FACTOR  # Add 33% to better fit matrix distance
+
+    @staticmethod
+    def haversine_array(places_from: Sequence[LatLngAble], places_to: Sequence[LatLngAble]) -> numpy.ndarray:
+        """
+        Array-native counterpart of haversine: the whole origins x destinations matrix in one
+        broadcasted call, without Distance objects. Same values as self._haversine_step
+        :param places_from: (LatLngAble, ) Sequence of origins
+        :param places_to: (LatLngAble, ) Sequence of destinations
+        :return: distances in meters, shape (len(places_from), len(places_to))
+        """
+        return haversine_kernel.road_distance_matrix(places_from, places_to)
 
     @staticmethod
     def haversine(places_from: Iterable[LatLngAble], places_to: Iterable[LatLngAble]) -> List[Distance]:
         """
         Making a list of Distance's based on list of origins and list of destinations.
-        Uses Haversine method at self._haversine_step
+        Uses Haversine method, see self.haversine_array
         The reason we need this is that to train a ml model matrix method is too slow.
         :param places_from: (LatLngAble, ) Iterable of origins
         :param places_to: (LatLngAble, ) Iterable of destinations
         :return: List of calculated Distance objects (sorted ascending)
         """
-        distances = DistanceResolvers._produce_distances_from_places(places_from, places_to)
+        places_from, places_to = list(places_from), list(places_to)
+        meters = DistanceResolvers.haversine_array(places_from, places_to).tolist()
 
-        for dist in distances:
-            dist.distance = DistanceResolvers._haversine_step(dist.place_from, dist.place_to)
+        distances = [Distance(plc_from, plc_to, meters[i][j])
+                     for i, plc_from in enumerate(places_from)
+                     for j, plc_to in enumerate(places_to)
+                     if plc_from != plc_to]
         distances.sort()
         return distances
 
 
+class DistanceContext:
+
+    """
+    Request-scoped memo of distances. Every leg (see Distance.key) is resolved at most once per
+    request, whichever of plan_route, measure_route or calculate asks for it first, and legs that
+    could not be resolved are not asked for again. Legs known to be needed ahead of time are
+    resolved together with prefetch, in one grouped resolve (see DistanceResolvers.resolve_groups).
+    matrix() is a drop-in replacement of DistanceResolvers.matrix.
+    """
+
+    def __init__(self, resolver: Optional[Callable[[List[List[Distance]]], object]] = None):
+        """
+        :param resolver: DistanceResolvers.resolve_groups-like callable, resolving the Distances in place
+        """
+        self.resolver = resolver or DistanceResolvers.resolve_groups
+        self.known: Dict[PairKey, Optional[float]] = {}  # None for the legs that could not be resolved
+
+    def prefetch(self, groups: Iterable[List[Distance]]) -> None:
+        """
+        Resolves the legs of the groups that are not known yet, in one resolver call
+        :param groups: Lists of unresolved Distance objects
+        """
+        groups = [[dist for dist in group if dist.key not in self.known] for group in groups]
+        groups = [group for group in groups if group]
+        if not groups:
+            return
+        self.resolver(groups)
+        for group in groups:
+            for dist in group:
+                self.known[dist.key] = dist.distance if dist.resolved else None
+
+    def matrix(self, places_from: Iterable[LatLngAble], places_to: Iterable[LatLngAble]) -> List[Distance]:
+        """
+        Same as DistanceResolvers.matrix, the legs already known to the context are not resolved again
+        :param places_from: Iterable of origin Places
+        :param places_to: Iterable of destination Places
+        :return: List of resolved Distance objects (sorted ascending)
+        :raises: ZeroDistanceResultsError if none of the distances is resolved
+        """
+        dists = DistanceResolvers._produce_distances_from_places(places_from, places_to)
+        self.prefetch([dists])
+        resolved = []
+        for dist in dists:
+            dist.distance = self.known[dist.key]
+            if dist.resolved:
+                resolved.append(dist)
+        if len(resolved) < 1:
+            logger.error('No distances have been resolved')
+            raise ZeroDistanceResultsError
+        resolved.sort()
+        return resolved
+
+
 class Predictors:
 
     @staticmethod
@@ -201,8 +376,49 @@ class Predictors:
         ratio = starting_depot.departure_ratio * ending_depot.arrival_ratio * Predictors._distance_ratio(distance)
         return float(vehicle.price) * ratio
 
+    # _distance_ratio_many recomputes ratios this close to a rounding tie with the scalar method
+    ROUNDING_TIE_TOLERANCE = 1e-6
+
+    @staticmethod
+    def _distance_ratio_many(dists: numpy.ndarray) -> numpy.ndarray:
+        """
+        Array version of _distance_ratio, equal to it element by element.
+        numpy.log may differ from math.log in the last bit, which can only change the result
+        when the value is next to a rounding tie, those few values go through _distance_ratio
+        :param dists: distances in m, a scalar gives a scalar
+        :return: ratios
+        """
+        shape = numpy.shape(dists)
+        dists = numpy.atleast_1d(numpy.asarray(dists, dtype=numpy.float64))
+        kdist = dists / 1000.0
+        d, e, f, g, h = 0.900, 0.009, 0.870, 0.150, 0.700  # See _distance_ratio
+        value = d / (numpy.log(e * kdist + f) + g) + h
+
+        scaled = value * 1000.0
+        ratio = numpy.rint(scaled) / 1000.0
+        near_tie = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < Predictors.ROUNDING_TIE_TOLERANCE
+        for i in numpy.flatnonzero(near_tie):
+            ratio[i] = Predictors._distance_ratio(float(dists[i]))
+        return ratio.reshape(shape)[()]
+
+    @staticmethod
+    def conventional_many(departure_ratios, arrival_ratios, vehicle_prices, distances) -> numpy.ndarray:
+        """
+        Array version of conventional for many cases in one call, equal to it element by element
+        :param departure_ratios: array-like of origin Depots departure_ratio
+        :param arrival_ratios: array-like of destination Depots arrival_ratio
+        :param vehicle_prices: array-like of Vehicles price
+        :param distances: array-like of distances in m
+        :return: prices per km
+        """
+        # Cap minimum distance to 50 km like conventional does
+        distances = numpy.maximum(numpy.asarray(distances, dtype=numpy.float64), 50000.0)
+        ratio = numpy.asarray(departure_ratios, dtype=numpy.float64) * \
+            numpy.asarray(arrival_ratios, dtype=numpy.float64) * Predictors._distance_ratio_many(distances)
+        return numpy.asarray(vehicle_prices, dtype=numpy.float64) * ratio
+
     @staticmethod
-    def ml(starting_depot: Depot, ending_depot: Depot, vehicle: Vehicle, _distance: float, ml_model=ML_MODEL) -> float:
+    def ml(starting_depot: Depot, ending_depot: Depot, vehicle: Vehicle, _distance: float, ml_model=PRICE_TABLE) -> float:
         """
         Predicts price based on the ML model that was trained on the original method invented in 2021
         The model is dynamic and supposed to be finetuned from time to time, maybe in automatic manner
@@ -215,34 +431,167 @@ class Predictors:
         """
         return ml_model.predict(starting_depot.id, ending_depot.id, vehicle.id)
 
+    @staticmethod
+    def ml_many(starting_depot: Depot, ending_depot: Depot, vehicles: Sequence[Vehicle], _distance: float,
+                ml_model=PRICE_TABLE) -> List[float]:
+        """
+        Same as ml, for several vehicles on the same route in one predictor call
+        :param starting_depot: origin Depot
+        :param ending_depot: destination Depot
+        :param vehicles: Vehicles to price
+        :param _distance: float. Not used. It is needed just to match attributes.
+        :param ml_model: Optional parameter to replace model with mock
+        :return: prices per km on a given route, in the order of vehicles
+        """
+        size = len(vehicles)
+        return Predictors.ml_batch([starting_depot] * size, [ending_depot] * size, vehicles, [_distance] * size,
+                                   ml_model=ml_model)
+
+    @staticmethod
+    def ml_batch(starting_depots: Sequence[Depot], ending_depots: Sequence[Depot], vehicles: Sequence[Vehicle],
+                 _distances: Sequence[float], ml_model=PRICE_TABLE) -> List[float]:
+        """
+        Same as ml, for many routes in one predictor call. Arguments are paired by position
+        :param starting_depots: origin Depots
+        :param ending_depots: destination Depots
+        :param vehicles: Vehicles
+        :param _distances: Not used. It is needed just to match attributes.
+        :param ml_model: Optional parameter to replace model with mock
+        :return: prices per km, one per route
+        """
+        prices = ml_model.predict_many(numpy.array([depot.id for depot in starting_depots], dtype=int),
+                                       numpy.array([depot.id for depot in ending_depots], dtype=int),
+                                       numpy.array([vehicle.id for vehicle in vehicles], dtype=int))
+        return [float(price) for price in prices]
+
+
+def closest_candidates(depots: Sequence[Depot], place: LatLngAble,
+                       k: int = settings.DEPOT_CANDIDATES,
+                       radius: float = settings.DEPOT_CANDIDATES_RADIUS) -> List[Depot]:
+    """
+    Pre-filters depots before asking road distances for them. Ranks depots by straight-line
+    distance to the place and keeps the k closest plus any depot that is within `radius`
+    meters of the closest one (road distances can reorder near ties)
+    :param depots: Sequence of candidate Depots
+    :param place: the place the depot should be close to
+    :param k: number of closest depots to keep. 0 or less keeps every depot
+    :param radius: safety radius in meters around the closest straight-line distance
+    :return: List of candidate Depots ordered by straight-line distance
+    """
+    if k <= 0 or len(depots) <= k:
+        return list(depots)
+    lats, lngs = haversine_kernel.coordinates(depots)
+    straight = haversine_kernel.haversine_matrix(lats, lngs, numpy.array([place.lat]), numpy.array([place.lng]))[:, 0]
+    order = numpy.argsort(straight, kind='stable')
+    keep = max(k, int(numpy.searchsorted(straight[order], straight[order[0]] + radius, side='right')))
+    return [depots[i] for i in order[:keep]]
 
-def plan_route(place_a: Place, place_b: Place, dptpark=DEPOT_PARK
+
+def plan_route(place_a: Place, place_b: Place, dptpark=DEPOT_PARK, context: Optional[DistanceContext] = None
                ) -> Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble]:
     """
-    Makes a complete route a vehicle should pass to complete an order
+    Makes a complete route a vehicle should pass to complete an order.
+    Depot candidates of both ends and the A -> B leg are resolved in one grouped resolve,
+    measuring the route with the same context does not resolve them again
     :param place_a: Place from
     :param place_b: Place to
     :param dptpark: Depotpark or None for default
+    :param context: DistanceContext of the request, a new one by default
     :return: planned route
     """
-    dist_resolver = DistanceResolvers.matrix
+    context = context or DistanceContext()
+    dist_resolver = context.matrix
+    produce = DistanceResolvers._produce_distances_from_places
     try:
-        # Acquiring distances from every filtered depots to our place, choosing the closest one
-        in_country_depots = dptpark.filter_by(place_a.countrycode)
-        starting_depot = dist_resolver(in_country_depots, [place_a])[0].place_from
-
-        # Acquiring distances from our place to every filtered depots, choosing the closest one
-        in_country_depots = dptpark.filter_by(place_b.countrycode)
-        ending_depot = dist_resolver([place_b], in_country_depots)[0].place_to
+        # Acquiring distances between the closest filtered depots and our places, choosing the closest ones
+        depots_a = closest_candidates(dptpark.filter_by(place_a.countrycode), place_a)
+        depots_b = closest_candidates(dptpark.filter_by(place_b.countrycode), place_b)
+        context.prefetch([produce(depots_a, [place_a]), produce([place_a], [place_b]), produce([place_b], depots_b)])
+        starting_depot = dist_resolver(depots_a, [place_a])[0].place_from
+        ending_depot = dist_resolver([place_b], depots_b)[0].place_to
 
     except (NoDepots, IndexError):  # That means the meter did not return any reasonable distance
-        # Acquiring distances from our place to all depots ve have, choosing the closest one
+        # Acquiring distances from our place to the closest of all depots ve have, choosing the closest one
         all_depots = dptpark.filter_by(None)
-        starting_depot = dist_resolver(all_depots, [place_a])[0].place_from
-        ending_depot = dist_resolver([place_b], all_depots)[0].place_to
+        depots_a, depots_b = closest_candidates(all_depots, place_a), closest_candidates(all_depots, place_b)
+        context.prefetch([produce(depots_a, [place_a]), produce([place_a], [place_b]), produce([place_b], depots_b)])
+        starting_depot = dist_resolver(depots_a, [place_a])[0].place_from
+        ending_depot = dist_resolver([place_b], depots_b)[0].place_to
     return starting_depot, place_a, place_b, ending_depot
 
 
+def measure_routes(pairs: Sequence[Tuple[Place, Place]], dptpark=DEPOT_PARK,
+                   resolver=DistanceResolvers.resolve_groups, route_cache: Optional[RoutePlanCache] = None
+                   ) -> List[Union[Tuple[Route, float], Exception]]:
+    """
+    plan_route and measure_route for many (A, B) pairs together. Depot candidates of both ends and
+    the A -> B leg of every pair are resolved in one grouped resolve, so the legs shared between the
+    pairs and the legs used for depot selection are looked up once.
+
+    Pairs without in-country depots take the candidates of all the depots at once, like in plan_route.
+    Unlike plan_route, which fails with ZeroDistanceResultsError there, pairs whose in-country depots
+    have no resolved distance go through a second round against all the depots. Pairs that already
+    used all the depots are not resolved again
+    :param pairs: (place_a, place_b) tuples
+    :param dptpark: Depotpark or None for default
+    :param resolver: DistanceResolvers.resolve_groups-like callable
+    :param route_cache: RoutePlanCache to take the plans from and to store them in, None to always measure
+    :return: (route, distance in meters) per pair, or ZeroDistanceResultsError if it has no route
+    """
+    def candidate_legs(place_a: Place, place_b: Place, in_country: bool) -> Tuple[List[Distance], ...]:
+        depots_a = dptpark.filter_by(place_a.countrycode if in_country else None)
+        depots_b = dptpark.filter_by(place_b.countrycode if in_country else None)
+        produce = DistanceResolvers._produce_distances_from_places
+        return (produce(closest_candidates(depots_a, place_a), [place_a]),
+                produce([place_a], [place_b]),
+                produce([place_b], closest_candidates(depots_b, place_b)))
+
+    def resolve_round(indices: List[int], in_country: bool) -> List[int]:
+        """
+        :return: the pairs to retry against all the depots
+        """
+        legs = {}
+        all_depots = set() if in_country else set(indices)
+        for i in indices:
+            try:
+                legs[i] = candidate_legs(*pairs[i], in_country)
+            except NoDepots:
+                legs[i] = candidate_legs(*pairs[i], False)
+                all_depots.add(i)
+        if legs:
+            resolver([group for i in indices for group in legs[i]])
+
+        failed = []
+        for i in indices:
+            inbound, direct, outbound = ([dist for dist in group if dist.resolved] for group in legs[i])
+            if not inbound or not outbound:
+                if i in all_depots:
+                    results[i] = ZeroDistanceResultsError(f'No depots reachable for {pairs[i][0]} - {pairs[i][1]}')
+                else:
+                    failed.append(i)
+            elif not direct:
+                results[i] = ZeroDistanceResultsError(f'No route between {pairs[i][0]} and {pairs[i][1]}')
+            else:
+                inbound, outbound = min(inbound), min(outbound)
+                plan = RoutePlan(inbound.place_from, outbound.place_to,
+                                 (inbound.distance, direct[0].distance, outbound.distance))
+                results[i] = (plan.route(*pairs[i]), plan.distance)
+                if route_cache is not None:
+                    route_cache.put(*pairs[i], plan)
+        return failed
+
+    results: List[Union[Tuple[Route, float], Exception, None]] = [None] * len(pairs)
+    to_measure = []
+    for i, pair in enumerate(pairs):
+        plan = route_cache.get(*pair) if route_cache is not None else None
+        if plan is None:
+            to_measure.append(i)
+        else:
+            results[i] = (plan.route(*pair), plan.distance)
+    resolve_round(resolve_round(to_measure, True), False)
+    return results
+
+
 def calculate(route: Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble],
               vehicle: Vehicle,
               dist_resolver: Callable[[Iterable[LatLngAble], Iterable[LatLngAble]], List[Distance]],
@@ -257,31 +606,74 @@ def calculate(route: Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble],
     :return: (float, float, float) -> distance in meters, price in UAH per km, cost
     """
     starting_depot, ending_depot = cast(Depot, route[0]), cast(Depot, route[3])
-    distance = \
-        dist_resolver([route[0]], [route[1]])[0].distance + \
-        dist_resolver([route[1]], [route[2]])[0].distance + \
-        dist_resolver([route[2]], [route[3]])[0].distance
+    distance = measure_route(route, dist_resolver)
     price = predictor(starting_depot, ending_depot, vehicle, distance)
     cost = distance / 1000 * price  # Convert dist from m to km first as price is per kilometer
     return distance, price, cost
 
 
-def process_request(request: RequestDTO) -> CalculationDTO:
+def measure_route(route: Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble],
+                  dist_resolver: Callable[[Iterable[LatLngAble], Iterable[LatLngAble]], List[Distance]]) -> float:
     """
-    Receives request dto, orchestrates calculation and produces response dto
-    :param request: (RequestDTO)
+    :param route: Tuple of 4 LatLngAble. A route vehicle shold pass to complete an order
+    :param dist_resolver: One of the DistanceResolvers methods. Calculates distance between LatLngAble's
+    :return: length of the route in meters
+    """
+    return sum(measure_legs(route, dist_resolver))
+
+
+def measure_legs(route: Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble],
+                 dist_resolver: Callable[[Iterable[LatLngAble], Iterable[LatLngAble]], List[Distance]]
+                 ) -> Tuple[float, float, float]:
+    """
+    :param route: Tuple of 4 LatLngAble. A route vehicle shold pass to complete an order
+    :param dist_resolver: One of the DistanceResolvers methods. Calculates distance between LatLngAble's
+    :return: lengths of the depot -> A, A -> B and B -> depot legs in meters
+    """
+    return (dist_resolver([route[0]], [route[1]])[0].distance,
+            dist_resolver([route[1]], [route[2]])[0].distance,
+            dist_resolver([route[2]], [route[3]])[0].distance)
+
+
+def plan_and_measure(place_a: Place, place_b: Place, route_cache: Optional[RoutePlanCache] = ROUTE_CACHE
+                     ) -> Tuple[Route, float]:
+    """
+    plan_route and measure_route of one request sharing a DistanceContext. The plan is taken from
+    the route cache when the lane was planned recently, then no distance is resolved at all
+    :param place_a: Place from
+    :param place_b: Place to
+    :param route_cache: RoutePlanCache, None to always plan
+    :return: planned route and its length in meters
+    """
+    plan = route_cache.get(place_a, place_b) if route_cache is not None else None
+    if plan is None:
+        context = DistanceContext()
+        route = plan_route(place_a, place_b, context=context)
+        plan = RoutePlan(cast(Depot, route[0]), cast(Depot, route[3]), measure_legs(route, context.matrix))
+        if route_cache is not None:
+            route_cache.put(place_a, place_b, plan)
+    return plan.route(place_a, place_b), plan.distance
+
+
+def make_calculation_dto(request: RequestDTO,
+                         route: Tuple[LatLngAble, LatLngAble, LatLngAble, LatLngAble],
+                         vehicle: Vehicle, distance: float, price: float, cost: float,
+                         currency: Currency) -> CalculationDTO:
+    """
+    Formats calculation results into the response dto
+    :param request: (RequestDTO) the calculation was requested with
+    :param route: planned route, see plan_route
+    :param vehicle: Vehicle the calculation was made for
+    :param distance: distance in meters
+    :param price: price in UAH per km
+    :param cost: cost in UAH
+    :param currency: Currency to show the price in
     :return: (CalculationDTO)
     """
     place_a = request.origin
     place_b = request.destination
-    vehicle = request.vehicle
-    route = plan_route(place_a, place_b)
     starting_depot, ending_depot = cast(Depot, route[0]), cast(Depot, route[3])
     visible_route = route[1:-1]
-    distance, price, cost = calculate(route, vehicle, DistanceResolvers.matrix, Predictors.ml)
-    currency = Currency.get_preferred(starting_depot.currency, ending_depot.currency)
-    logger.debug(f'distance, price, cost; currency: '
-                 f'{distance}, {price}, {cost}; {currency.iso_code}: {currency.rate()}')
     return CalculationDTO(place_a_name=place_a.name,
                           place_a_name_long=place_a.name_long,
                           place_b_name=place_b.name,
@@ -306,3 +698,112 @@ def process_request(request: RequestDTO) -> CalculationDTO:
                           pfactor_arrival=str(ending_depot.arrival_ratio),
                           pfactor_distance=str(0.0),
                           locale=request.locale)
+
+
+def warm_up() -> None:
+    """
+    Runs the NumPy paths of a request once (depot candidates, pricing) and pages the price table in,
+    so the first requests after start are not slower than the rest. Meant for a background thread
+    """
+    try:
+        depots = DEPOT_PARK.filter_by(None)
+        closest_candidates(depots, depots[0])
+        PRICE_TABLE.warm_up()
+        Predictors.ml_many(depots[0], depots[-1], list(VEHICLES), 100000.0)
+    except Exception as e:
+        logger.error(f'Warm-up failed: {e}')
+
+
+def process_request(request: RequestDTO) -> CalculationDTO:
+    """
+    Receives request dto, orchestrates calculation and produces response dto
+    :param request: (RequestDTO)
+    :return: (CalculationDTO)
+    """
+    place_a = request.origin
+    place_b = request.destination
+    vehicle = request.vehicle
+    route, distance = plan_and_measure(place_a, place_b)
+    starting_depot, ending_depot = cast(Depot, route[0]), cast(Depot, route[3])
+    price = Predictors.ml(starting_depot, ending_depot, vehicle, distance)
+    cost = distance / 1000 * price  # Convert dist from m to km first as price is per kilometer
+    currency = Currency.get_preferred(starting_depot.currency, ending_depot.currency)
+    logger.debug(f'distance, price, cost; currency: '
+                 f'{distance}, {price}, {cost}; {currency.iso_code}: {currency.rate()}')
+    return make_calculation_dto(request, route, vehicle, distance, price, cost, currency)
+
+
+def process_request_all_vehicles(request: RequestDTO, vehicles=VEHICLES) -> List[CalculationDTO]:
+    """
+    Same as process_request, for every vehicle at once. The route is planned and measured once
+    and all the vehicles are priced in one predictor call
+    :param request: (RequestDTO). Its vehicle is ignored
+    :param vehicles: Vehicles to price, all of them by default
+    :return: List of (CalculationDTO), in the order of vehicles
+    """
+    route, distance = plan_and_measure(request.origin, request.destination)
+    starting_depot, ending_depot = cast(Depot, route[0]), cast(Depot, route[3])
+    vehicles = list(vehicles)
+    prices = Predictors.ml_many(starting_depot, ending_depot, vehicles, distance)
+    currency = Currency.get_preferred(starting_depot.currency, ending_depot.currency)
+    logger.debug(f'distance; currency: {distance}; {currency.iso_code}: {currency.rate()}')
+    return [make_calculation_dto(request, route, vehicle, distance, price, distance / 1000 * price, currency)
+            for vehicle, price in zip(vehicles, prices)]
+
+
+def _ml_prices(done: Sequence[Tuple[int, RequestDTO, Tuple[Sequence[LatLngAble], float]]]
+               ) -> List[Union[float, ValueError]]:
+    """
+    Prices of the measured routes per km in one predictor call. If the call fails (a depot or vehicle
+    id the served model was not trained with), the routes are priced one by one, so only the failing
+    ones fail
+    :param done: (index, RequestDTO, (route, distance)) of the measured requests
+    :return: price per km or the ValueError of every route
+    """
+    def price(items):
+        return Predictors.ml_batch([cast(Depot, route[0]) for _, _, (route, _) in items],
+                                   [cast(Depot, route[3]) for _, _, (route, _) in items],
+                                   [request.vehicle for _, request, _ in items],
+                                   [distance for _, _, (_, distance) in items])
+
+    try:
+        return price(done)
+    except ValueError:
+        pass
+    prices = []
+    for item in done:
+        try:
+            prices.extend(price([item]))
+        except ValueError as e:
+            prices.append(e)
+    return prices
+
+
+def process_batch(requests: Sequence[RequestDTO], slice_size: int = settings.BATCH_SLICE_SIZE
+                  ) -> Iterator[Tuple[int, Union[CalculationDTO, Exception]]]:
+    """
+    Same as process_request for many requests. Requests are processed in slices: the routes of
+    a slice are planned and measured together (see measure_routes) and priced in one predictor call.
+    Lanes planned recently are taken from the route cache.
+    Results are yielded as soon as their slice is done
+    :param requests: (RequestDTO)s
+    :param slice_size: number of requests measured together
+    :return: Iterator of (index of the request, CalculationDTO or the Exception it failed with)
+    """
+    for start in range(0, len(requests), slice_size):
+        chunk = requests[start:start + slice_size]
+        measured = measure_routes([(request.origin, request.destination) for request in chunk],
+                                  route_cache=ROUTE_CACHE)
+        done = [(i, request, result) for i, (request, result) in enumerate(zip(chunk, measured), start)
+                if not isinstance(result, Exception)]
+        for i, result in enumerate(measured, start):
+            if isinstance(result, Exception):
+                yield i, result
+
+        for (i, request, (route, distance)), price in zip(done, _ml_prices(done)):
+            if isinstance(price, Exception):
+                yield i, price
+                continue
+            currency = Currency.get_preferred(route[0].currency, route[3].currency)
+            yield i, make_calculation_dto(request, route, request.vehicle, distance, price,
+                                          distance / 1000 * price, currency)
@@ -0,0 +1,155 @@
+import json
+import os
+import numpy
+from app import settings
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from app.lib.calc.distance import Distance
+from app.lib.calc.place import LatLngAble
+from app.lib.calc.loadables.depot import Depot
+from app.lib.utils.cache import to_microdegrees
+from app.lib.utils.logger import logger
+
+
+DEPOT_MATRIX_PATH = Path(settings.DEPOT_MATRIX_LOC)
+
+DepotKey = Tuple[int, int, int]
+
+
+def depot_key(depot: Depot) -> DepotKey:
+    """
+    Identifies a depot together with its position, so a moved depot does not match its old row
+    :param depot: Depot
+    :return: (depot id, lat in microdegrees, lng in microdegrees)
+    """
+    return depot.id, to_microdegrees(depot.lat), to_microdegrees(depot.lng)
+
+
+class DepotMatrix:
+
+    """
+    Dense matrix of road distances in meters between every pair of depots.
+
+    The matrix is stored as a float32 .npy file (memory-mapped on load) with a JSON index next to it
+    that lists the depots (id and coordinates) in row order. Cells without a land route are NaN.
+    Lookups are O(1) by index and only match depots whose coordinates did not change since the build.
+
+    The matrix is built by build() and the app.tools.build_depot_matrix command.
+    Only depots that were added or moved since the previous build are resolved again.
+    """
+
+    def __init__(self, location: Path = DEPOT_MATRIX_PATH):
+        self.location = Path(location)
+        self.index_location = self.location.with_suffix('.json')
+        self.data: Optional[numpy.ndarray] = None
+        self._index: Dict[DepotKey, int] = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def load(self):
+        """
+        Memory-maps the matrix if it was built. Missing files leave the matrix empty
+        :return: self
+        """
+        if not self.location.exists() or not self.index_location.exists():
+            logger.info(f'Depot matrix {self.location} is not built. Depot pairs go through the cache')
+            self.data, self._index = None, {}
+            return self
+        with open(self.index_location, mode='r', encoding='utf-8') as f:
+            depots = json.load(f)['depots']
+        self.data = numpy.load(self.location, mmap_mode='r')
+        self._index = {(item['id'], item['lat'], item['lng']): i for i, item in enumerate(depots)}
+        logger.info(f'Depot matrix loaded: {len(self._index)} depots')
+        return self
+
+    def index_of(self, place: LatLngAble) -> Optional[int]:
+        if not isinstance(place, Depot):
+            return None
+        return self._index.get(depot_key(place))
+
+    def lookup(self, place_from: LatLngAble, place_to: LatLngAble) -> Optional[float]:
+        """
+        :param place_from: origin (only Depots can match)
+        :param place_to: destination (only Depots can match)
+        :return: distance in meters or None if the pair is not in the matrix or has no land route
+        """
+        if self.data is None:
+            return None
+        i, j = self.index_of(place_from), self.index_of(place_to)
+        if i is None or j is None:
+            return None
+        meters = float(self.data[i, j])
+        return None if numpy.isnan(meters) else meters
+
+    def distances(self, depots: Sequence[Depot]) -> numpy.ndarray:
+        """
+        Road distances between every pair of the depots, taken from the matrix with one fancy index
+        :param depots: Depots, in the order of the rows and columns of the result
+        :return: float64 array (len(depots), len(depots)) in meters, NaN where the pair is not in the matrix
+            or has no land route
+        """
+        distances = numpy.full((len(depots), len(depots)), numpy.nan)
+        if self.data is None:
+            return distances
+        rows = numpy.array([self._index.get(depot_key(depot), -1) for depot in depots], dtype=numpy.intp)
+        known = numpy.flatnonzero(rows >= 0)
+        distances[numpy.ix_(known, known)] = self.data[numpy.ix_(rows[known], rows[known])]
+        return distances
+
+    def build(self, depots: Sequence[Depot],
+              resolver: Callable[[Iterable[LatLngAble], Iterable[LatLngAble]], List[Distance]],
+              full: bool = False):
+        """
+        Builds the matrix for the given depots and saves it atomically.
+        Rows and columns of unchanged depots are copied from the current matrix,
+        only pairs touching added or moved depots are passed to the resolver.
+        :param depots: all depots, in the order of the rows
+        :param resolver: DistanceResolvers.matrix-like callable (cache, then API)
+        :param full: resolve every pair regardless of the current matrix
+        :return: self, reloaded from the saved files
+        """
+        size = len(depots)
+        keys = [depot_key(depot) for depot in depots]
+        data = numpy.full((size, size), numpy.nan, dtype=numpy.float32)
+        numpy.fill_diagonal(data, 0.0)
+
+        previous = {} if full or self.data is None else self._index
+        kept = [i for i, key in enumerate(keys) if key in previous]
+        if kept:
+            rows = numpy.array([previous[keys[i]] for i in kept])
+            data[numpy.ix_(kept, kept)] = self.data[numpy.ix_(rows, rows)]
+
+        kept_set = set(kept)
+        changed = [depot for i, depot in enumerate(depots) if i not in kept_set]
+        unchanged = [depots[i] for i in kept]
+        logger.info(f'Depot matrix build: {len(kept)} depots reused, {len(changed)} to resolve')
+
+        if changed:
+            position = {depot.id: i for i, depot in enumerate(depots)}
+            resolved = resolver(changed, depots)
+            if unchanged:
+                resolved = resolved + resolver(unchanged, changed)
+            for dist in resolved:
+                data[position[dist.place_from.id], position[dist.place_to.id]] = dist.distance
+
+        self.save(data, depots)
+        return self.load()
+
+    def save(self, data: numpy.ndarray, depots: Sequence[Depot]) -> None:
+        """
+        Writes the matrix and its index next to the final location, then swaps them in
+        """
+        self.location.parent.mkdir(parents=True, exist_ok=True)
+        tmp_matrix = self.location.with_name(self.location.stem + '.tmp.npy')
+        tmp_index = self.index_location.with_name(self.index_location.stem + '.tmp.json')
+        numpy.save(tmp_matrix, data)
+        with open(tmp_index, mode='w', encoding='utf-8') as f:
+            json.dump({'depots': [{'id': key[0], 'lat': key[1], 'lng': key[2]}
+                                  for key in map(depot_key, depots)]}, f)
+        os.replace(tmp_matrix, self.location)
+        os.replace(tmp_index, self.index_location)
+        logger.info(f'Depot matrix saved: {self.location}')
+
+
+DEPOT_MATRIX = DepotMatrix().load()
@@ -1,3 +1,17 @@
+from typing import Tuple
+
+
+PairKey = Tuple[float, float, float, float]
+
+
+def pair_key(from_lat: float, from_lng: float, to_lat: float, to_lng: float) -> PairKey:
+    """
+    Canonical hashable key of a directional coordinate pair.
+    Two Distances are equal exactly when their keys are equal.
+    :return: coordinates rounded to 6 digits
+    """
+    return round(from_lat, 6), round(from_lng, 6), round(to_lat, 6), round(to_lng, 6)
+
 
 class Distance:
     """
@@ -14,6 +28,7 @@ class Distance:
         __eq__(other): Compares two Distance objects based on their coordinates.
         __lt__(other): Compares two resolved distances numerically.
         __hash__(): Allows Distance to be used in sets, based on lat/lng.
+        key: Canonical coordinate pair key (see pair_key) used by __eq__ and __hash__.
         __repr__(): Returns a human-readable string representation of the Distance.
 
     Exceptions:
@@ -57,23 +72,17 @@ class Distance:
 
         return self._distance < other._distance
 
+    @property
+    def key(self) -> PairKey:
+        return pair_key(self.place_from.lat, self.place_from.lng, self.place_to.lat, self.place_to.lng)
+
     def __eq__(self, other):
         if not isinstance(other, Distance):
             return NotImplemented
-        return all((
-            round(self.place_from.lat, 6) == round(other.place_from.lat, 6),
-            round(self.place_from.lng, 6) == round(other.place_from.lng, 6),
-            round(self.place_to.lat, 6) == round(other.place_to.lat, 6),
-            round(self.place_to.lng, 6) == round(other.place_to.lng, 6)
-        ))
+        return self.key == other.key
 
     def __hash__(self):
-        return hash((
-            round(self.place_from.lat, 6),
-            round(self.place_from.lng, 6),
-            round(self.place_to.lat, 6),
-            round(self.place_to.lng, 6)
-        ))
+        return hash(self.key)
 
     def __repr__(self):
         if self.resolved:
@@ -0,0 +1,48 @@
+import numpy
+from typing import Sequence, Tuple
+from app.lib.calc.place import LatLngAble
+
+
+EARTH_RADIUS = 6371000  # Globe radius in meters
+ROAD_FACTOR = 1.33  # Add 33% to better fit matrix distance so both of them are +- the same
+
+
+def coordinates(places: Sequence[LatLngAble]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    :param places: Sequence of LatLngAbles
+    :return: two float64 arrays: latitudes and longitudes in degrees
+    """
+    lats = numpy.fromiter((place.lat for place in places), dtype=numpy.float64, count=len(places))
+    lngs = numpy.fromiter((place.lng for place in places), dtype=numpy.float64, count=len(places))
+    return lats, lngs
+
+
+def haversine_matrix(lat_from: numpy.ndarray, lng_from: numpy.ndarray,
+                     lat_to: numpy.ndarray, lng_to: numpy.ndarray) -> numpy.ndarray:
+    """
+    Great-circle distances between every origin and every destination in one broadcasted call
+    :param lat_from: origins latitudes in degrees, shape (n,)
+    :param lng_from: origins longitudes in degrees, shape (n,)
+    :param lat_to: destinations latitudes in degrees, shape (m,)
+    :param lng_to: destinations longitudes in degrees, shape (m,)
+    :return: distances in meters, shape (n, m)
+    """
+    phi1 = numpy.radians(numpy.asarray(lat_from, dtype=numpy.float64))[:, None]
+    phi2 = numpy.radians(numpy.asarray(lat_to, dtype=numpy.float64))[None, :]
+    lambda1 = numpy.radians(numpy.asarray(lng_from, dtype=numpy.float64))[:, None]
+    lambda2 = numpy.radians(numpy.asarray(lng_to, dtype=numpy.float64))[None, :]
+
+    # cos() is taken per point (n + m calls), only the differences need the full (n, m) grid
+    a = numpy.sin((phi2 - phi1) / 2) ** 2 + numpy.cos(phi1) * numpy.cos(phi2) * numpy.sin((lambda2 - lambda1) / 2) ** 2
+    c = 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))  # Same as 2 * atan2(sqrt(a), sqrt(1 - a)), cheaper
+    return EARTH_RADIUS * c
+
+
+def road_distance_matrix(places_from: Sequence[LatLngAble], places_to: Sequence[LatLngAble]) -> numpy.ndarray:
+    """
+    Approximated road distances between every origin and every destination (great-circle * ROAD_FACTOR)
+    :param places_from: Sequence of origins
+    :param places_to: Sequence of destinations
+    :return: distances in meters, shape (len(places_from), len(places_to))
+    """
+    return haversine_matrix(*coordinates(places_from), *coordinates(places_to)) * ROAD_FACTOR
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+from app import settings
+from app.lib.calc.loadables.depot import Depot
+from app.lib.calc.place import Place
+from app.lib.utils.cache import make_key, snap_key
+
+
+RouteKey = Tuple[tuple, Optional[str], Optional[str]]
+
+
+class RoutePlan(NamedTuple):
+    """
+    Everything the distance work of a quote produces: the chosen depots and the lengths
+    in meters of the depot -> A, A -> B and B -> depot legs
+    """
+    starting_depot: Depot
+    ending_depot: Depot
+    legs: Tuple[float, float, float]
+
+    def route(self, place_a: Place, place_b: Place) -> Tuple[Depot, Place, Place, Depot]:
+        return self.starting_depot, place_a, place_b, self.ending_depot
+
+    @property
+    def distance(self) -> float:
+        return sum(self.legs)
+
+
+class RoutePlanCache:
+
+    """
+    Bounded in-process LRU map of (origin, destination) to RoutePlan with a TTL.
+
+    A repeated quote, or the same lane with another vehicle, skips plan_route and the leg
+    distances altogether and only needs the predictor. With `snap_meters` origin and destination
+    are snapped to a grid (see cache.snap_key), so places a few meters apart share a plan; it is
+    opt-in, as for the distance cache. Countrycodes are part of the key, they decide which depots are candidates.
+
+    Plans depend on the depots only. The depot park is loaded once per process, so is the cache:
+    a new depotpark file takes a restart, which drops the plans as well.
+
+    Attributes:
+        hits, misses, expired (int): Counters since start (or since reset_stats()).
+    """
+
+    def __init__(self, ttl: float = settings.ROUTE_CACHE_TTL,
+                 max_size: int = settings.ROUTE_CACHE_SIZE,
+                 snap_meters: int = settings.ROUTE_CACHE_SNAP_METERS):
+        """
+        :param ttl: seconds a plan is served for. 0 disables the cache
+        :param max_size: most plans kept, the least recently used are evicted
+        :param snap_meters: grid cell size in meters, 0 keys by exact coordinates
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.snap_meters = snap_meters
+        self._data: OrderedDict[RouteKey, Tuple[float, RoutePlan]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def key(self, place_a: Place, place_b: Place) -> RouteKey:
+        key = make_key(place_a.lat, place_a.lng, place_b.lat, place_b.lng)
+        if self.snap_meters > 0:
+            key = snap_key(key, self.snap_meters)
+        return key, place_a.countrycode, place_b.countrycode
+
+    def get(self, place_a: Place, place_b: Place) -> Optional[RoutePlan]:
+        """
+        :return: the plan of the lane or None if it is not cached or expired
+        """
+        if self.ttl <= 0:
+            return None
+        key = self.key(place_a, place_b)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._data[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, place_a: Place, place_b: Place, plan: RoutePlan) -> None:
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        key = self.key(place_a, place_b)
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, plan)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0}
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.expired = 0
+
+
+ROUTE_CACHE = RoutePlanCache()
@@ -3,6 +3,7 @@ import sqlite3
 from datetime import datetime
 import app.lib.apis.telegramapi2 as tgapi2
 import traceback
+from typing import Iterable, Tuple
 from app.lib.utils.logger import logger
 
 
@@ -83,5 +84,22 @@ class QueryLogger:
             logger.error(f'sqlite3.DatabaseError at QueryLogger\n{traceback.format_exc()}')
             tgapi2.send_developer('sqlite3.DatabaseError at QueryLogger', e)
 
+    def log_calculations(self, rows: Iterable[Tuple[str, str, str]]) -> None:
+        """
+        Logs many queries and responses in one transaction
+        :param rows: (phone_number, query, response) tuples, see log_calculation
+        :return: None
+        """
+        if not self.conn or not self.cursor:
+            raise RuntimeError("QueryLogger must be used within a context manager")
+        today, now = self._today(), self._now()
+        try:
+            self.cursor.executemany(self.INSERT_QUERY, ((today, now, phone_number, query, response)
+                                                        for phone_number, query, response in rows))
+            self.conn.commit()
+        except sqlite3.DatabaseError as e:
+            logger.error(f'sqlite3.DatabaseError at QueryLogger\n{traceback.format_exc()}')
+            tgapi2.send_developer('sqlite3.DatabaseError at QueryLogger', e)
+
 
 QUERY_LOGGER = QueryLogger()
@@ -1,11 +1,138 @@
 
+import atexit
+import math
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from app import settings
 import app.lib.apis.telegramapi2 as tgapi2
-from typing import Optional
+from typing import Optional, Sequence, Tuple, Dict, List
 from app.lib.utils.logger import logger
 
 
+# Coordinates are stored as fixed-precision integers (microdegrees, ~0.11 m at the equator).
+# This matches the 6-digit rounding used by Distance and LatLngAble equality.
+COORD_SCALE = 1_000_000
+METERS_PER_DEGREE = 111320.0
+SCHEMA_VERSION = 2
+
+Key = Tuple[int, int, int, int]
+SnapKey = Tuple[int, int, int, int, int]
+
+
+def to_microdegrees(value: float) -> int:
+    """
+    Converts a coordinate in degrees into an integer number of microdegrees
+    :param value: (float) latitude or longitude in degrees
+    :return: (int) value * 1e6 rounded to the nearest integer
+    """
+    return int(round(value * COORD_SCALE))
+
+
+def make_key(from_lat: float, from_lng: float, to_lat: float, to_lng: float) -> Key:
+    """
+    Makes an integer cache key out of a pair of coordinates
+    :return: (from_lat, from_lng, to_lat, to_lng) in microdegrees
+    """
+    return (to_microdegrees(from_lat), to_microdegrees(from_lng),
+            to_microdegrees(to_lat), to_microdegrees(to_lng))
+
+
+def snap_key(key: Key, cell_meters: int) -> SnapKey:
+    """
+    Snaps both ends of a key to a grid of roughly square cells `cell_meters` wide.
+    Places a few meters apart share a snapped key unless a cell border runs between them.
+    :param key: exact key in microdegrees
+    :param cell_meters: (int) cell size in meters
+    :return: (cell_meters, from row, from column, to row, to column)
+    """
+    step = cell_meters / METERS_PER_DEGREE * COORD_SCALE  # Cell height in microdegrees of latitude
+
+    def snap(lat: int, lng: int) -> Tuple[int, int]:
+        row = round(lat / step)
+        # Meridians converge, so a cell spans more microdegrees of longitude away from the equator
+        lng_step = step / max(math.cos(math.radians(row * step / COORD_SCALE)), 0.01)
+        return row, round(lng / lng_step)
+
+    return (cell_meters, *snap(key[0], key[1]), *snap(key[2], key[3]))
+
+
+class MemoryTier:
+
+    """
+    Bounded in-process LRU map of cache keys to distances.
+
+    Sits in front of the SQLite lookups: a hit here costs a dict access instead of a query.
+    When the tier is full the least recently used key is evicted.
+
+    Attributes:
+        max_size (int): Maximum number of stored keys. 0 disables the tier.
+        hits, misses, evictions (int): Counters since start (or since reset_stats()).
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict[Key, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Key, count: bool = True) -> Optional[float]:
+        """
+        :param count: whether the lookup goes to the hits / misses counters
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return value
+
+    def put(self, key: Key, value: float) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def most_recent(self, limit: int) -> List[Key]:
+        """
+        :param limit: (int) number of keys to return
+        :return: up to `limit` keys, most recently used first
+        """
+        with self._lock:
+            keys = []
+            for key in reversed(self._data):
+                if len(keys) >= limit:
+                    break
+                keys.append(key)
+            return keys
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0}
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.evictions = 0
+
+
 class Cache:
 
     """
@@ -14,57 +141,248 @@ class Cache:
     This class is designed to reduce calls to an external distance API (Google Matrix API) by maintaining
     a local cache of previously queried distances. It supports:
 
+    - An in-process LRU memory tier in front of the disk (see MemoryTier)
     - Efficient lookups of cached distances (cache_look)
-    - Insertion of new distances (cache_it)
+    - Bulk lookups of many coordinate pairs in a single query (cache_look_many)
+    - Insertion of new distances (cache_it), buffered and written behind in batches (flush)
 
-    The expected table schema is:
+    The managed table schema (version 2, see SCHEMA_VERSION and PRAGMA user_version) is:
         CREATE TABLE "Distances" (
-            "from_lat"        REAL NOT NULL,
-            "from_lng"        REAL NOT NULL,
-            "to_lat"          REAL NOT NULL,
-            "to_lng"          REAL NOT NULL,
-            "distance_meters" INTEGER NOT NULL
-        );
+            "from_lat"        INTEGER NOT NULL,  -- microdegrees
+            "from_lng"        INTEGER NOT NULL,
+            "to_lat"          INTEGER NOT NULL,
+            "to_lng"          INTEGER NOT NULL,
+            "distance_meters" INTEGER NOT NULL,
+            PRIMARY KEY ("from_lat", "from_lng", "to_lat", "to_lng")
+        ) WITHOUT ROWID;
+
+    The schema is created on the first start. Legacy files (REAL coordinates, version 0)
+    are converted in place by migrate(), see also app.tools.migrate_cache.
+
+    The auxiliary "Recent" table keeps the memory tier's most recently used keys between
+    restarts. It is written on close() and used to pre-warm the memory tier on the next start.
 
-        CREATE INDEX geo ON Distances (from_lat, from_lng, to_lat, to_lng);
+    Keys may also be snapped (see snap_key): with `snap_meters` set, every distance of at least
+    `snap_min_distance` meters is stored under its snapped key in the "Snapped" table as well.
+    An exact miss then falls back to the snapped key, so two clicks a few meters apart share one
+    API result. Short legs are never answered by a snapped key, their relative error would be too big.
+
+    Writes are buffered: cache_it() puts the value into a pending buffer, which is written to disk
+    in one transaction when it reaches `flush_size` entries, when the oldest entry is older than
+    `flush_interval` seconds (checked by a background thread) and on close(). Pending values are
+    visible to lookups before they reach the disk.
 
     Attributes:
         CACHE_LOCATION (str): Path to the SQLite cache file, taken from `settings.CACHE_LOCATION`.
-        conn (sqlite3.Connection): Active database connection (disk or memory-based).
+        conn (sqlite3.Connection): Active database connection.
         c (sqlite3.Cursor): Cursor object for executing SQL commands.
-        emergency_mode (bool): Flag indicating whether the cache is operating in fallback (memory) mode.
+        memory (MemoryTier): LRU tier consulted before the disk.
+        flush_size (int): Pending writes that trigger a flush. 1 makes every cache_it() write through.
+        flush_interval (float): Max age in seconds of a pending write. 0 disables the background flusher.
+            After a failed flush it is also the delay before the next try.
+        pending_limit (int): Most pending writes kept while flushes fail.
+        snap_meters (int): Snapped key cell size in meters. 0 (the default) disables snapped keys.
+        snap_min_distance (float): Shortest distance in meters a snapped key may answer.
 
     Note:
         - The `Distance` and `Place` types are assumed to be external classes with appropriate attributes.
-        - This class is meant to be used as a singleton, via `cache_instance_factory()`.
+        - This class is meant to be used as a singleton, via the module-level `CACHE`.
     """
 
-    def __init__(self):
+    def __init__(self, location: str = settings.CACHE_LOC,
+                 memory_size: int = settings.CACHE_MEMORY_SIZE,
+                 prewarm_size: int = settings.CACHE_PREWARM_SIZE,
+                 flush_size: int = settings.CACHE_FLUSH_SIZE,
+                 flush_interval: float = settings.CACHE_FLUSH_INTERVAL,
+                 pending_limit: int = settings.CACHE_PENDING_LIMIT,
+                 snap_meters: int = settings.CACHE_SNAP_METERS,
+                 snap_min_distance: float = settings.CACHE_SNAP_MIN_DISTANCE):
 
-        self.CACHE_LOCATION = settings.CACHE_LOC
-        self.disk_connection = sqlite3.connect(self.CACHE_LOCATION, check_same_thread=False)
-        self.memory_connection = None
-        self.emergency_mode = False
-        self.conn = self.disk_connection
+        self.CACHE_LOCATION = location
+        self.conn = sqlite3.connect(self.CACHE_LOCATION, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.c = self.conn.cursor()
-        self.g_api = None
+        self._lock = threading.RLock()  # Guards the connection and the pending buffer
+        self.memory = MemoryTier(memory_size)
+        self.prewarm_size = min(prewarm_size, memory_size)
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self.pending_limit = max(self.flush_size, pending_limit)
+        self.snap_meters = snap_meters
+        self.snap_min_distance = snap_min_distance
+        self._pending: Dict[Key, int] = {}
+        self._pending_snapped: Dict[SnapKey, int] = {}
+        self._pending_since: Optional[float] = None
+        self._retry_at = 0.0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.dropped = 0
+        self.snapped_hits = 0
+        self._closed = False
+        self._stop = threading.Event()
+        self.ensure_schema()
+        self.prewarm()
+
+        self._flusher = None
+        if self.flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='cache-flusher', daemon=True)
+            self._flusher.start()
 
     def close(self):
-        self.conn.close()
+        with self._lock:
+            if self._closed:
+                return
+            self._stop.set()
+            self.flush()
+            try:
+                self.save_recent()
+            except sqlite3.Error:
+                logger.exception('Failed to save recently used cache keys')
+            logger.info(f'Cache stats: {self.stats()}')
+            self.conn.close()
+            self._closed = True
+
+    def stats(self) -> dict:
+        return {'memory': self.memory.stats(),
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors,
+                'dropped': self.dropped,
+                'snapped_hits': self.snapped_hits}
+
+    CREATE_QUERY = """
+        CREATE TABLE IF NOT EXISTS "Distances" (
+            "from_lat"        INTEGER NOT NULL,
+            "from_lng"        INTEGER NOT NULL,
+            "to_lat"          INTEGER NOT NULL,
+            "to_lng"          INTEGER NOT NULL,
+            "distance_meters" INTEGER NOT NULL,
+            PRIMARY KEY ("from_lat", "from_lng", "to_lat", "to_lng")
+        ) WITHOUT ROWID
+    """
+
+    def schema_version(self) -> int:
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _table_exists(self, name: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+        return row is not None
+
+    def ensure_schema(self) -> None:
+        """
+        Creates the Distances table if it does not exist or migrates a legacy one
+        :return: None
+        """
+        if self.schema_version() < SCHEMA_VERSION:
+            if self._table_exists('Distances'):
+                logger.warning(f'Cache {self.CACHE_LOCATION} has legacy schema. Migrating')
+                self.migrate()
+            else:
+                self.conn.execute(self.CREATE_QUERY)
+                self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                self.conn.commit()
+        self.conn.execute(self.CREATE_RECENT_QUERY)
+        self.conn.execute(self.CREATE_SNAPPED_QUERY)
+
+    MIGRATION_BATCH_SIZE = 10000
 
-    SELECT_QUERY = """
-        SELECT distance_meters
-        FROM Distances
-        WHERE (from_lat = ? and from_lng = ?) and (to_lat = ? and to_lng = ?)
+    def migrate(self) -> int:
+        """
+        Converts a legacy Distances table (REAL coordinates, no key) into the managed schema in place.
+        Rows are copied in batches so memory use does not depend on the table size.
+        Duplicate pairs collapse into one row.
+        :return: (int) number of rows in the migrated table
+        """
+        conn = self.conn
+        conn.commit()
+        try:
+            conn.execute('BEGIN')  # DDL is not covered by implicit transactions, so open one explicitly
+            conn.execute('ALTER TABLE "Distances" RENAME TO "Distances_legacy"')
+            conn.execute(self.CREATE_QUERY)
+            reader = conn.cursor()
+            reader.execute('SELECT from_lat, from_lng, to_lat, to_lng, distance_meters FROM "Distances_legacy"')
+            while True:
+                rows = reader.fetchmany(self.MIGRATION_BATCH_SIZE)
+                if not rows:
+                    break
+                conn.executemany(self.INSERT_QUERY,
+                                 [(*make_key(*row[:4]), int(row[4])) for row in rows])
+            conn.execute('DROP TABLE "Distances_legacy"')
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        conn.execute('VACUUM')
+        migrated = conn.execute('SELECT count(*) FROM "Distances"').fetchone()[0]
+        logger.info(f'Cache {self.CACHE_LOCATION} migrated to schema version {SCHEMA_VERSION}: {migrated} rows')
+        return migrated
+
+    CREATE_SNAPPED_QUERY = """
+        CREATE TABLE IF NOT EXISTS "Snapped" (
+            "cell"            INTEGER NOT NULL,  -- cell size in meters, see snap_key()
+            "from_lat"        INTEGER NOT NULL,  -- grid rows and columns
+            "from_lng"        INTEGER NOT NULL,
+            "to_lat"          INTEGER NOT NULL,
+            "to_lng"          INTEGER NOT NULL,
+            "distance_meters" INTEGER NOT NULL,
+            PRIMARY KEY ("cell", "from_lat", "from_lng", "to_lat", "to_lng")
+        ) WITHOUT ROWID
     """
 
+    CREATE_RECENT_QUERY = """
+        CREATE TABLE IF NOT EXISTS "Recent" (
+            "rank"     INTEGER PRIMARY KEY,
+            "from_lat" INTEGER NOT NULL,
+            "from_lng" INTEGER NOT NULL,
+            "to_lat"   INTEGER NOT NULL,
+            "to_lng"   INTEGER NOT NULL
+        )
+    """
+
+    PREWARM_QUERY = """
+        SELECT Recent.from_lat, Recent.from_lng, Recent.to_lat, Recent.to_lng, Distances.distance_meters
+        FROM Recent
+        JOIN Distances
+          ON (Distances.from_lat = Recent.from_lat and Distances.from_lng = Recent.from_lng)
+         and (Distances.to_lat = Recent.to_lat and Distances.to_lng = Recent.to_lng)
+        ORDER BY Recent.rank
+        LIMIT ?
+    """
+
+    def prewarm(self) -> int:
+        """
+        Loads the keys that were most recently used before the last shutdown into the memory tier.
+        Least recent ones go first so the most recent end up at the hot end of the LRU.
+        :return: (int) number of pre-warmed keys
+        """
+        if self.prewarm_size <= 0:
+            return 0
+        with self._lock:
+            rows = self.conn.execute(self.PREWARM_QUERY, (self.prewarm_size,)).fetchall()
+        for row in reversed(rows):
+            self.memory.put(tuple(row[:4]), float(row[4]))
+        logger.info(f'Cache memory tier pre-warmed with {len(rows)} keys')
+        return len(rows)
+
+    def save_recent(self) -> None:
+        """
+        Stores the memory tier's most recently used keys (rank 0 is the most recent) for prewarm()
+        :return: None
+        """
+        keys = [key for key in self.memory.most_recent(self.prewarm_size * 2) if len(key) == 4]
+        keys = keys[:self.prewarm_size]  # Snapped keys share the memory tier but are not pre-warmed
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM "Recent"')
+            self.conn.executemany('INSERT INTO "Recent" VALUES (?, ?, ?, ?, ?)',
+                                  [(rank, *key) for rank, key in enumerate(keys)])
+
     def cache_look(self, from_lat: float, from_lng: float, to_lat: float, to_lng: float) -> Optional[float]:
         """
         Retrieves a cached distance value between two geographic coordinates, if available.
 
-        Queries the local SQLite Distances table for a record matching the given origin and
-        destination coordinates. If a match is found, the stored distance in meters is returned;
+        Looks for a record matching the given origin and destination coordinates (or, for long legs,
+        their snapped key). If a match is found, the stored distance in meters is returned;
         otherwise, returns None.
 
         :param from_lat: (float) From place latitude
@@ -73,14 +391,102 @@ class Cache:
         :param to_lng: (float) To place longitude
         :return: float or None: The cached distance in meters if found, otherwise None
         """
-        self.c.execute(self.SELECT_QUERY, (from_lat, from_lng, to_lat, to_lng))
-        row = self.c.fetchone()
-        if row:
-            return float(row['distance_meters'])
-        return None
+        pair = (from_lat, from_lng, to_lat, to_lng)
+        hits, _ = self.cache_look_many([pair])
+        return hits.get(pair)
+
+    # Each pair takes up to 6 bound parameters. Keep well below SQLITE_MAX_VARIABLE_NUMBER (999 on old builds)
+    BULK_CHUNK_SIZE = 150
+
+    KEY_COLUMNS = ('from_lat', 'from_lng', 'to_lat', 'to_lng')
+    SNAPPED_KEY_COLUMNS = ('cell', 'from_lat', 'from_lng', 'to_lat', 'to_lng')
+
+    BULK_SELECT_QUERY = """
+        WITH wanted(idx, {columns}) AS (VALUES {values})
+        SELECT wanted.idx, {table}.distance_meters
+        FROM wanted
+        JOIN {table} USING ({columns})
+    """
+
+    def _look_tiered(self, items: List[Tuple[tuple, tuple]], pending: dict,
+                     table: str, columns: Tuple[str, ...], count: bool = True) -> Dict[tuple, float]:
+        """
+        Looks the keys up in the memory tier, then in the pending writes, then on disk.
+        Disk hits are promoted to the memory tier.
+        :param items: List of (pair, key) to look for
+        :param pending: pending writes of the table
+        :param table: table name
+        :param columns: key columns of the table, in key order
+        :param count: whether memory tier lookups go to its counters
+        :return: dict of hits {pair: distance in meters}
+        """
+        hits = {}
+        not_in_memory = []
+        for pair, key in items:
+            meters = self.memory.get(key, count)
+            if meters is not None:
+                hits[pair] = meters
+            else:
+                not_in_memory.append((pair, key))
+
+        with self._lock:
+            unbuffered = []
+            for pair, key in not_in_memory:
+                meters = pending.get(key)
+                if meters is not None:
+                    hits[pair] = float(meters)
+                else:
+                    unbuffered.append((pair, key))
+
+            placeholders = '(' + ', '.join('?' * (len(columns) + 1)) + ')'
+            for start in range(0, len(unbuffered), self.BULK_CHUNK_SIZE):
+                chunk = unbuffered[start:start + self.BULK_CHUNK_SIZE]
+                params = []
+                for idx, (_, key) in enumerate(chunk):
+                    params.extend((idx, *key))
+                self.c.execute(self.BULK_SELECT_QUERY.format(columns=', '.join(columns),
+                                                             values=', '.join(placeholders for _ in chunk),
+                                                             table=table), params)
+                for row in self.c.fetchall():
+                    pair, key = chunk[row['idx']]
+                    meters = float(row['distance_meters'])
+                    self.memory.put(key, meters)
+                    hits[pair] = meters
+        return hits
+
+    def cache_look_many(self, pairs: Sequence[Tuple[float, float, float, float]]
+                        ) -> Tuple[Dict[Tuple[float, float, float, float], float],
+                                   List[Tuple[float, float, float, float]]]:
+        """
+        Retrieves cached distances for many coordinate pairs at once.
+
+        Pairs found in the memory tier (or still pending a write) are answered from it. Instead of
+        issuing one SELECT per remaining pair, those are joined against the Distances table as an
+        inline VALUES table, so they are resolved in a single round trip (or a few, if the list is
+        longer than BULK_CHUNK_SIZE). Exact misses are then looked up by their snapped keys.
+
+        :param pairs: Sequence of (from_lat, from_lng, to_lat, to_lng) tuples
+        :return: dict of hits {pair: distance in meters} and list of missed pairs (in input order)
+        """
+        pairs = list(pairs)
+        hits = self._look_tiered([(pair, make_key(*pair)) for pair in pairs],
+                                 self._pending, 'Distances', self.KEY_COLUMNS)
+
+        if self.snap_meters > 0 and len(hits) < len(pairs):
+            missed = [(pair, snap_key(make_key(*pair), self.snap_meters)) for pair in pairs if pair not in hits]
+            # A second probe of the same lookups, the memory tier counted them already. See snapped_hits
+            snapped = self._look_tiered(missed, self._pending_snapped, 'Snapped', self.SNAPPED_KEY_COLUMNS,
+                                        count=False)
+            for pair, meters in snapped.items():
+                if meters >= self.snap_min_distance:
+                    hits[pair] = meters
+                    self.snapped_hits += 1
+
+        misses = [pair for pair in pairs if pair not in hits]
+        return hits, misses
 
     INSERT_QUERY = """
-        INSERT INTO Distances (
+        INSERT OR REPLACE INTO Distances (
             "from_lat",
             "from_lng",
             "to_lat",
@@ -89,11 +495,22 @@ class Cache:
         VALUES (?, ?, ?, ?, ?)
     """
 
+    INSERT_SNAPPED_QUERY = """
+        INSERT OR REPLACE INTO Snapped (
+            "cell",
+            "from_lat",
+            "from_lng",
+            "to_lat",
+            "to_lng",
+            "distance_meters")
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
+
     def cache_it(self, from_lat: float, from_lng: float, to_lat: float, to_lng: float, distance: float) -> None:
         """
-        Inserts a distance record into the cache. In case of errors, logging and do nothing
+        Adds a distance record to the cache. The record is visible to lookups at once
+        and is written to disk with the next flush().
 
-        If a `sqlite3.Error` occurs, it notifies dev team.
         :param from_lat: (float) From place latitude
         :param from_lng: (float) From place longitude
         :param to_lat: (float) To place latitude
@@ -101,12 +518,91 @@ class Cache:
         :param distance: (float) distance between places in meters
         :return: None
         """
-        try:
-            self.c.execute(self.INSERT_QUERY, (from_lat, from_lng, to_lat, to_lng, int(distance)))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            logger.exception('Error adding item to Cache')
-            tgapi2.send_developer('Error adding item to Cache', e)
+        key = make_key(from_lat, from_lng, to_lat, to_lng)
+        meters = int(distance)
+        snapped = None
+        if self.snap_meters > 0 and meters >= self.snap_min_distance:
+            snapped = snap_key(key, self.snap_meters)
+
+        self.memory.put(key, float(meters))
+        if snapped is not None:
+            self.memory.put(snapped, float(meters))
+        with self._lock:
+            if self._closed:
+                logger.warning(f'Cache is closed, {key} is not persisted')
+                return
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending[key] = meters
+            if snapped is not None:
+                self._pending_snapped[snapped] = meters
+            full = len(self._pending) >= self.flush_size and time.monotonic() >= self._retry_at
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes all pending records to disk in a single transaction.
+
+        If a `sqlite3.Error` occurs, the records stay pending for the next flush, no earlier than
+        flush_interval later, and the dev team is notified of the first failure in a row.
+        Beyond pending_limit the oldest pending records are dropped, they stay in the memory tier.
+        :return: (int) number of written records
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = [(*key, meters) for key, meters in self._pending.items()]
+            batch_snapped = [(*key, meters) for key, meters in self._pending_snapped.items()]
+            try:
+                self.c.executemany(self.INSERT_QUERY, batch)
+                self.c.executemany(self.INSERT_SNAPPED_QUERY, batch_snapped)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                error, first = e, self.flush_errors == 0
+                self.flush_errors += 1
+                self._retry_at = time.monotonic() + self.flush_interval
+                self._pending_since = time.monotonic()
+                dropped = self._drop_oldest_pending()
+            else:
+                self._pending = {}
+                self._pending_snapped = {}
+                self._pending_since = None
+                self.flushes += 1
+                self.flush_errors = 0
+                error = None
+        # Out of the lock, lookups do not wait for the notification
+        if error is not None:
+            logger.error(f'Error adding {len(batch)} items to Cache, they are kept for a retry '
+                         f'({dropped} oldest dropped): {error}')
+            if first:
+                tgapi2.send_developer(f'Error adding {len(batch)} items to Cache', error)
+            return 0
+        logger.debug(f'Cache flushed {len(batch)} items')
+        return len(batch)
+
+    def _drop_oldest_pending(self) -> int:
+        """
+        Keeps at most pending_limit pending records, the latest ones. Called with the lock held
+        :return: number of dropped records
+        """
+        dropped = max(0, len(self._pending) - self.pending_limit)
+        for pending in (self._pending, self._pending_snapped):
+            for key in list(pending)[:max(0, len(pending) - self.pending_limit)]:
+                del pending[key]
+        self.dropped += dropped
+        return dropped
+
+    def _flush_periodically(self) -> None:
+        """
+        Background loop flushing pending records once they are older than flush_interval
+        """
+        while not self._stop.wait(self.flush_interval / 2):
+            since = self._pending_since
+            if since is not None and time.monotonic() - since >= self.flush_interval:
+                self.flush()
 
 
 CACHE = Cache()
+atexit.register(CACHE.close)
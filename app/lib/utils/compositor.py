@@ -2,6 +2,7 @@
 from app import settings
 from app.lib.utils.DTOs import CalculationDTO
 from textwrap import dedent
+from typing import List
 from app.lib.calc.place import Place
 from app.lib.calc.place import LatLngAble
 
@@ -138,6 +139,54 @@ def compose_telegram_message_text(intent: str, calculation: CalculationDTO,
     return dedent(fstring).strip()
 
 
+# Telegram messages are limited to 4096 characters, longer batches are summarized
+TELEGRAM_BATCH_LINES = 40
+
+
+def compose_telegram_batch_text(intent: str, calculations: List[CalculationDTO], failed: int,
+                                url: str, ip: str, phone_num: str = None) -> str:
+    """
+    Compose one Telegram message summarizing a batch of calculations
+    :param intent: (str) Intent of the original request ('calc', 'callback' or 'acquire')
+    :param calculations: (CalculationDTO)s of the batch items that were calculated
+    :param failed: (int) number of the batch items that could not be calculated
+    :param url: (str) Source page URL
+    :param ip: (str) Client IP address
+    :param phone_num: (str, optional) number of the client
+    :return: (str) A formatted Telegram message.
+
+    Looks like this:
+        'Пакетный просчет: 2 (ошибок: 0)
+        Page URL: `https://intersmartgroup.com/`
+
+        IP: 159.224.254.148 (http://ip-api.com/line/159.224.254.148)
+
+        Дніпро - Високе, Тент 20: 19 800.00 UAH
+        Київ - Львів, Тент 5: 14 100.00 UAH'
+    """
+    intents = {'calc': 'Пакетный просчет', 'callback': 'Пакетный просчет, клиент нажал Перезвонить',
+               'acquire': 'Пакетный просчет без номера'}
+    intent_text = intents.get(intent, 'Неизвестный интент')
+
+    lines = []
+    for calculation in calculations[:TELEGRAM_BATCH_LINES]:
+        price_value = calculation.price_per_ton if calculation.is_price_per_ton else calculation.price
+        price_tag = 'за тонну' if calculation.is_price_per_ton else ''
+        lines.append(f'{calculation.place_a_name} - {calculation.place_b_name}, {calculation.transport_name}: '
+                     f'{price_value} {calculation.currency} {price_tag}'.strip())
+    if len(calculations) > TELEGRAM_BATCH_LINES:
+        lines.append(f'... и еще {len(calculations) - TELEGRAM_BATCH_LINES}')
+
+    phone = f'Телефон клиента: +{phone_num}' if phone_num else ''
+    header = dedent(f'''
+        {intent_text}: {len(calculations) + failed} (ошибок: {failed})
+        Page URL: `{url}`
+
+        IP: [{ip}](http://ip-api.com/line/{ip})
+    ''').strip()
+    return '\n\n'.join(part for part in (header, '\n'.join(lines), phone) if part)
+
+
 def round_cost(cost: float) -> float:
     """
     Rounds float number depending on ranges:
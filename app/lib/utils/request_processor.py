@@ -1,6 +1,7 @@
 
-from typing import Tuple, Any
+from typing import Tuple, Any, List
 import flask
+from app import settings
 from app.lib.utils import number_tools
 from app.lib.calc.loadables.vehicles import VEHICLES
 from app.lib.utils.DTOs import RequestDTO
@@ -111,7 +112,10 @@ def process(request_raw: flask.Request or Any) -> RequestDTO:
     :raises: ValidationError
     """
     raw, ip = pre(request_raw)
+    return _run_pipeline(raw, ip)
 
+
+def _run_pipeline(raw: dict, ip: str) -> RequestDTO:
     dto = RequestDTO()
     pipeline = (
         intent,
@@ -133,3 +137,36 @@ def process(request_raw: flask.Request or Any) -> RequestDTO:
 
     dto.ip = ip
     return dto
+
+
+def process_batch(request_raw: flask.Request or Any) -> List[RequestDTO]:
+    """
+    Process and validate a batch request into a RequestDTO per item. The fields shared by
+    the items are given once, the items hold the route and the vehicle:
+
+      input_example = {'intent': str,
+                       'phone_number': str,
+                       'locale': str,
+                       'url': str,
+                       'items': [{'from': {...}, 'to': {...}, 'transport_id': int}, ...]}
+
+    See process for the fields. Any invalid item fails the whole batch.
+
+    :param: request_raw: flask.Request object
+    :return: List of RequestDTO objects, in the order of the items
+    :raises: ValidationError
+    """
+    raw, ip = pre(request_raw)
+    items = raw.get('items') if isinstance(raw, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValidationError('Batch items should be a non empty list')
+    if len(items) > settings.BATCH_MAX_ITEMS:
+        raise ValidationError(f'Too many batch items: {len(items)}, max {settings.BATCH_MAX_ITEMS}')
+
+    common = {key: value for key, value in raw.items() if key != 'items'}
+    dtos = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValidationError('Batch item should be an object')
+        dtos.append(_run_pipeline({**common, **item}, ip))
+    return dtos
@@ -27,7 +27,8 @@ ensuree = (
     (settings.CACHE_LOC,          settings.CACHE_RESERVE_LOC),
     (settings.QUERYLOG_DB_LOC,    settings.QUERYLOG_DB_RESERVE_LOC),
     (settings.BLACKLIST_FILE_LOC, settings.BLACKLIST_RESERVE_LOC),
-    (settings.AI_MODEL_LOC,       settings.AI_MODEL_RESERVE_LOC)
+    (settings.AI_MODEL_LOC,       settings.AI_MODEL_RESERVE_LOC),
+    (settings.AI_WEIGHTS_LOC,     settings.AI_WEIGHTS_RESERVE_LOC)  # After the model, so it is not older
 )
 
 
@@ -14,17 +14,19 @@ from flask_cors import CORS
 from app.lib.utils.blacklist import BLACKLIST
 import app.lib.utils.request_processor as request_processor
 import app.lib.calc.calc_itself as calc_itself
-from app.lib.utils.DTOs import CalculationDTO
+from app.lib.utils.DTOs import CalculationDTO, RequestDTO
 from app.lib.utils import number_tools
 from app.lib.utils.number_tools import WrongNumberError
 from app.lib.calc.calc_itself import ZeroDistanceResultsError
 import dataclasses
+import threading
 import app.settings as settings
 
 
 logger.info(f'Running on dev machine: {settings.DEV_MACHINE}')
 app = Flask(__name__)
 CORS = CORS(app)
+threading.Thread(target=calc_itself.warm_up, name='warm-up', daemon=True).start()
 
 
 def __gen_response(http_status: int, json_status: str, details: str = '', workload: dict = None) -> Response:
@@ -129,6 +131,137 @@ def calculate():
     calculation_dto = calc_itself.process_request(request_dto)
     logger.debug('Calculation was succesfully performed. Got Calculation DTO')
 
+    # Steps 3-6: Log the calculation and notify managers
+    __log_and_notify(request_dto, calculation_dto)
+
+    # Step 7: Response to frontend
+    return __gen_response(200, 'WORKLOAD', workload=dataclasses.asdict(calculation_dto))
+
+
+@app.route('/calculate-all-vehicles/', methods=['POST'])
+def calculate_all_vehicles():
+    """
+    Handle POST requests to perform a route calculation for every available vehicle at once.
+
+    Accepts the same input as /calculate/. The route is planned and measured once and every
+    vehicle is priced in one predictor call, so the frontend can switch vehicles without
+    asking again. Only the calculation of the requested vehicle is logged and sent to Telegram.
+
+    :return: A Flask response object containing a JSON payload with the list of calculations
+             (ordered as /get-available-vehicles/) or error details.
+    :rtype: flask.Response
+    """
+
+    request_dto = request_processor.process(request)
+    logger.debug('Acquired request has been processed. Got Request DTO')
+
+    calculation_dtos = calc_itself.process_request_all_vehicles(request_dto)
+    logger.debug(f'Calculation was succesfully performed for {len(calculation_dtos)} vehicles')
+
+    requested = next((dto for dto in calculation_dtos if dto.transport_id == request_dto.vehicle.id), None)
+    if requested is None:
+        logger.warning(f'Vehicle {request_dto.vehicle.id} is not among the calculated vehicles')
+        return __gen_response(400, 'ERROR', details='Invalid input')
+    __log_and_notify(request_dto, requested)
+
+    return __gen_response(200, 'WORKLOAD', workload=[dataclasses.asdict(dto) for dto in calculation_dtos])
+
+
+@app.route('/calculate-batch/', methods=['POST'])
+def calculate_batch():
+    """
+    Handle POST requests to perform route calculations for many (origin, destination, vehicle) items.
+
+    Input is described at request_processor.process_batch. The routes of the items are planned and
+    measured together, so every distance needed across the batch is resolved once, through the cache
+    first and then in as few Matrix API requests as possible.
+
+    The response is streamed as NDJSON, one line per item as soon as it is calculated:
+      {"index": 0, "status": "WORKLOAD", "details": "", "workload": {...CalculationDTO...}}
+      {"index": 1, "status": "ZeroDistanceResultsError", "details": "...", "workload": null}
+    Lines come in completion order, "index" is the position of the item in the request.
+    The batch is logged to the QueryLog in one transaction and summarized in one Telegram message
+    after the last line, or with the items sent so far when the client disconnects.
+
+    :return: A Flask streaming response with the NDJSON lines, or a JSON error response if the input is invalid.
+    :rtype: flask.Response
+    """
+
+    request_dtos = request_processor.process_batch(request)
+    logger.debug(f'Acquired batch request has been processed. Got {len(request_dtos)} Request DTOs')
+
+    def generate():
+        calculated = []
+        failed = 0
+        try:
+            for index, result in calc_itself.process_batch(request_dtos):
+                if isinstance(result, CalculationDTO):
+                    calculated.append((request_dtos[index], result))
+                    line = {'index': index, 'status': 'WORKLOAD', 'details': '',
+                            'workload': dataclasses.asdict(result)}
+                else:
+                    failed += 1
+                    logger.warning(f'Batch item {index} failed: {result!r}')
+                    line = {'index': index, 'status': type(result).__name__, 'details': str(result), 'workload': None}
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+        finally:
+            # Also when the client disconnects midway (GeneratorExit), the distances are paid for anyway
+            if len(calculated) + failed < len(request_dtos):
+                logger.warning(f'Batch stream closed after {len(calculated) + failed} of {len(request_dtos)} items')
+            __log_and_notify_batch(request_dtos[0], calculated, failed)
+
+    resp = Response(generate(), status=200, content_type='application/x-ndjson; charset=utf-8')
+    resp.headers.add('Access-Control-Allow-Origin', '*')
+    return resp
+
+
+def __log_and_notify_batch(request_dto: RequestDTO, calculated: list, failed: int) -> None:
+    """
+    Logs calculated batch items to the QueryLog in one transaction and sends one
+    Telegram summary of the batch to the silent chat
+
+    :param request_dto: any of the batch's RequestDTOs, for the fields shared by the items
+    :param calculated: (RequestDTO, CalculationDTO) pairs of the calculated items
+    :param failed: number of items that could not be calculated
+    """
+
+    rows = []
+    for item_dto, calculation_dto in calculated:
+        tg_msg = compositor.compose_telegram_message_text(
+            intent=item_dto.intent,
+            calculation=calculation_dto,
+            url=item_dto.url,
+            ip=item_dto.ip,
+            phone_num=item_dto.phone_num)
+        rows.append((item_dto.phone_num,
+                     json.dumps(item_dto.to_dict(), ensure_ascii=False),
+                     json.dumps([tg_msg, 'nosms'], ensure_ascii=False)))
+    with QUERY_LOGGER as qlogger:
+        qlogger.log_calculations(rows)
+    logger.debug(f'Query Logger has succesfully logged {len(rows)} batch calculations')
+
+    tg_msg = compositor.compose_telegram_batch_text(
+        intent=request_dto.intent,
+        calculations=[calculation_dto for _, calculation_dto in calculated],
+        failed=failed,
+        url=request_dto.url,
+        ip=request_dto.ip,
+        phone_num=request_dto.phone_num)
+    if BLACKLIST.check(request_dto.ip):
+        tg_msg = '*BLACKLISTED*\n\n'+tg_msg
+    telegramapi2.send_silent(tg_msg)
+    logger.debug('Telegram batch message has been sent to silent chat')
+
+
+def __log_and_notify(request_dto: RequestDTO, calculation_dto: CalculationDTO) -> None:
+    """
+    Logs a calculation to the QueryLog and sends its summary to the silent Telegram chat
+    (marked if the request IP is blacklisted)
+
+    :param request_dto: the processed request
+    :param calculation_dto: the calculation made for it
+    """
+
     # Step 3: Prepare TG message
     tg_msg = compositor.compose_telegram_message_text(
         intent=request_dto.intent,
@@ -152,9 +285,6 @@ def calculate():
     telegramapi2.send_silent(tg_msg)
     logger.debug('Telegram message has been sent to silent chat')
 
-    # Step 7: Response to frontend
-    return __gen_response(200, 'WORKLOAD', workload=dataclasses.asdict(calculation_dto))
-
 
 @app.route('/submit/', methods=['POST'])
 def submit_new():
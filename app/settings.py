@@ -14,6 +14,16 @@ GOOGLE_APIADR = os.getenv('GOOGLE_APIADR', 'https://maps.googleapis.com/maps/api
 GOOGLE_APIKEY_PROD = os.getenv('GOOGLE_APIKEY_PROD')
 GOOGLE_APIKEY_DEV = os.getenv('GOOGLE_APIKEY_DEV')
 GOOGLE_APIKEY = GOOGLE_APIKEY_DEV if DEV_MACHINE else GOOGLE_APIKEY_PROD
+GOOGLE_API_TIMEOUT = float(os.getenv('GOOGLE_API_TIMEOUT', '10'))
+GOOGLE_API_MAX_WORKERS = int(os.getenv('GOOGLE_API_MAX_WORKERS', '8'))
+GOOGLE_API_RETRIES = int(os.getenv('GOOGLE_API_RETRIES', '3'))
+# Pairs requested by one thread are shared with the threads asking for them meanwhile, and for
+# GOOGLE_API_SINGLE_FLIGHT_LINGER seconds after the answer. Joining threads wait up to GOOGLE_API_SINGLE_FLIGHT_WAIT
+GOOGLE_API_SINGLE_FLIGHT_LINGER = float(os.getenv('GOOGLE_API_SINGLE_FLIGHT_LINGER', '5'))
+GOOGLE_API_SINGLE_FLIGHT_WAIT = float(os.getenv('GOOGLE_API_SINGLE_FLIGHT_WAIT', '60'))
+# Matrix requests are planned for the fewest billed elements plus GOOGLE_API_REQUEST_WEIGHT elements per request:
+# two requests are merged into one if that bills fewer extra elements. Never more requests than the cross products
+GOOGLE_API_REQUEST_WEIGHT = float(os.getenv('GOOGLE_API_REQUEST_WEIGHT', '8'))
 
 DEPOTPARK_LOC = os.getenv('DEPOTPARK_LOC', 'storage/depotpark.json')
 STATEPARK_LOC = os.getenv('STATEPARK_LOC', 'storage/statepark.json')
@@ -27,12 +37,55 @@ CURRENCY_RESERVE_LOC = os.getenv('CURRENCY_RESERVE_LOC', 'initial_storage/curren
 
 CACHE_LOC = os.getenv('CACHE_LOC', 'storage/cache.sqlite')
 CACHE_RESERVE_LOC = os.getenv('CACHE_RESERVE_LOC', 'initial_storage/cache.sqlite')
+CACHE_MEMORY_SIZE = int(os.getenv('CACHE_MEMORY_SIZE', '50000'))
+CACHE_PREWARM_SIZE = int(os.getenv('CACHE_PREWARM_SIZE', '10000'))
+CACHE_FLUSH_SIZE = int(os.getenv('CACHE_FLUSH_SIZE', '256'))
+CACHE_FLUSH_INTERVAL = float(os.getenv('CACHE_FLUSH_INTERVAL', '5.0'))
+# Pending writes kept for a retry while flushes fail, the oldest ones beyond it are dropped
+CACHE_PENDING_LIMIT = int(os.getenv('CACHE_PENDING_LIMIT', '50000'))
+# Legs of at least CACHE_SNAP_MIN_DISTANCE meters may be answered by a cached leg whose ends
+# fall into the same CACHE_SNAP_METERS grid cells. Opt-in: answers change a little, 0 disables snapping
+CACHE_SNAP_METERS = int(os.getenv('CACHE_SNAP_METERS', '0'))
+CACHE_SNAP_MIN_DISTANCE = float(os.getenv('CACHE_SNAP_MIN_DISTANCE', '50000'))
+
+# Depots sent to the Matrix API per route end: k straight-line closest plus any depot
+# within DEPOT_CANDIDATES_RADIUS meters of the closest one. 0 sends every depot
+DEPOT_CANDIDATES = int(os.getenv('DEPOT_CANDIDATES', '5'))
+DEPOT_CANDIDATES_RADIUS = float(os.getenv('DEPOT_CANDIDATES_RADIUS', '30000'))
+
+DEPOT_MATRIX_LOC = os.getenv('DEPOT_MATRIX_LOC', 'storage/depot_matrix.npy')
+
+# Planned and measured routes (depots and leg lengths) kept in memory for ROUTE_CACHE_TTL seconds,
+# keyed by origin and destination. Opt-in like CACHE_SNAP_METERS: places in the same ROUTE_CACHE_SNAP_METERS
+# cells share another quote's depots and leg lengths, 0 keys by exact coordinates.
+# Kept per process, a new DEPOTPARK_LOC takes a restart. TTL 0 disables
+ROUTE_CACHE_TTL = float(os.getenv('ROUTE_CACHE_TTL', '86400'))
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', '20000'))
+ROUTE_CACHE_SNAP_METERS = int(os.getenv('ROUTE_CACHE_SNAP_METERS', '0'))
+
+# /calculate-batch/: most items per request, items planned and measured together
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+BATCH_SLICE_SIZE = int(os.getenv('BATCH_SLICE_SIZE', '50'))
 
 QUERYLOG_DB_LOC = os.getenv('QUERYLOG_DB_LOC', 'storage/QueryLog.sqlite')
 QUERYLOG_DB_RESERVE_LOC = os.getenv('QUERYLOG_DB_RESERVE_LOC', 'initial_storage/QueryLog.sqlite')
 
 AI_MODEL_LOC = os.getenv('AI_MODEL_LOC', 'storage/4L1500*30*40*0.01.leakyrelu.keras')
 AI_MODEL_RESERVE_LOC = os.getenv('AI_MODEL_RESERVE_LOC', 'initial_storage/4L1500*30*40*0.01.leakyrelu.keras')
+# Weights of AI_MODEL_LOC exported for the NumPy serving predictor (app.tools.export_model).
+# Serving does not export them, the reserve is exported from AI_MODEL_RESERVE_LOC when the image is built
+AI_WEIGHTS_LOC = os.getenv('AI_WEIGHTS_LOC', 'storage/price_model.npz')
+AI_WEIGHTS_RESERVE_LOC = os.getenv('AI_WEIGHTS_RESERVE_LOC', 'initial_storage/price_model.npz')
+# Model output for every (depot, depot, vehicle), rebuilt when the model or vehicles files change
+AI_PRICE_TABLE_LOC = os.getenv('AI_PRICE_TABLE_LOC', 'storage/price_table.npy')
+AI_PRICE_TABLE_CHECK_INTERVAL = float(os.getenv('AI_PRICE_TABLE_CHECK_INTERVAL', '60'))
+# Retrained models are written as versions into AI_MODEL_VERSIONS_DIR, the pointer file names the served one
+AI_MODEL_VERSIONS_DIR = os.getenv('AI_MODEL_VERSIONS_DIR', 'storage/models')
+AI_MODEL_POINTER_LOC = os.getenv('AI_MODEL_POINTER_LOC', 'storage/price_model.json')
+# Every n-th QueryLog row is held out to validate a retrained model
+AI_RETRAIN_HOLDOUT_EVERY = int(os.getenv('AI_RETRAIN_HOLDOUT_EVERY', '10'))
+# Holdout MAE may grow by this fraction and the retrained model is still published
+AI_RETRAIN_TOLERANCE = float(os.getenv('AI_RETRAIN_TOLERANCE', '0.0'))
 
 BLACKLIST_FILE_LOC = os.getenv('BLACKLIST_FILE_LOC', 'storage/blacklist.txt')
 BLACKLIST_RESERVE_LOC = os.getenv('BLACKLIST_RESERVE_LOC', 'initial_storage/blacklist.txt')
@@ -0,0 +1,36 @@
+"""
+Builds the precomputed depot to depot road distance matrix (see app.lib.calc.depot_matrix).
+
+Distances are resolved through the cache first and the Google Matrix API after that.
+By default only depots that were added or moved since the previous build are resolved.
+
+Usage:
+    python -m app.tools.build_depot_matrix [--full]
+"""
+import argparse
+import time
+import numpy
+from app.lib.calc.calc_itself import DistanceResolvers, DEPOT_PARK
+from app.lib.calc.depot_matrix import DEPOT_MATRIX, DepotMatrix
+from app.lib.utils.cache import CACHE
+from app.lib.utils.logger import logger
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Build the depot to depot distance matrix')
+    parser.add_argument('--full', action='store_true', help='resolve every pair, not only changed depots')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    unbuilt = DepotMatrix()  # Never loaded, so the matrix being built is not consulted by the resolver
+    DEPOT_MATRIX.build(DEPOT_PARK.filter_by(None),
+                       lambda places_from, places_to: DistanceResolvers.matrix(places_from, places_to,
+                                                                               dmatrix_=unbuilt),
+                       full=args.full)
+    CACHE.flush()
+    logger.info(f'Depot matrix built for {len(DEPOT_MATRIX)} depots in {time.perf_counter() - started:.1f} s, '
+                f'{int(numpy.isnan(DEPOT_MATRIX.data).sum())} pairs without a land route')
+
+
+if __name__ == '__main__':
+    main()
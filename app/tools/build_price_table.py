@@ -0,0 +1,19 @@
+"""
+Builds the precomputed price table (see app.lib.ai.price_table): the price model evaluated
+for every (depot, depot, vehicle). The running app rebuilds it by itself when the model or
+vehicles files change, this command does it ahead of time.
+
+Usage:
+    python -m app.tools.build_price_table
+"""
+from app.lib.ai.price_table import PriceTable
+
+
+def main() -> None:
+    table = PriceTable()
+    table.rebuild()
+    table.load()
+
+
+if __name__ == '__main__':
+    main()
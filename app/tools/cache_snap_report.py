@@ -0,0 +1,109 @@
+"""
+Measures the cache hit-rate gain of snapped keys by replaying the QueryLog.
+
+Quotes are replayed in log order against an initially empty cache model. For every quote each
+leg is counted as a hit when an earlier quote had the same key: the exact one, or the snapped one
+if the leg is long enough for the snapping policy of Cache (estimated by straight-line distance * 1.33).
+The depots are not logged, each end is taken to the straight-line closest depot of the depot park.
+
+Usage:
+    python -m app.tools.cache_snap_report [--querylog path] [--cells 100,200,500,1000]
+                                          [--min-distance 50000]
+"""
+import argparse
+import json
+import sqlite3
+import numpy
+from typing import Iterator, List, Sequence, Tuple
+from app import settings
+from app.lib.calc import haversine
+from app.lib.calc.loadables.depot import Depot
+from app.lib.calc.loadables.depotpark import DEPOTPARK
+from app.lib.utils.cache import make_key, snap_key
+
+
+Quote = Tuple[float, float, float, float]
+
+
+def read_quotes(location: str) -> Iterator[Quote]:
+    """
+    :param location: QueryLog sqlite file
+    :return: Iterator of (a_lat, a_lng, b_lat, b_lng) of the logged calculations, in log order
+    """
+    conn = sqlite3.connect(location)
+    try:
+        for (query,) in conn.execute('SELECT "query" FROM "queries" ORDER BY rowid'):
+            try:
+                obj = json.loads(query)
+                origin, destination = obj['origin'], obj['destination']
+                yield float(origin['lat']), float(origin['lng']), float(destination['lat']), float(destination['lng'])
+            except (TypeError, KeyError, ValueError):
+                continue  # Callback submissions and malformed rows carry no coordinates
+    finally:
+        conn.close()
+
+
+def replay(quotes: List[Quote], cells: List[int], min_distance: float, depots: Sequence[Depot]) -> dict:
+    """
+    :param quotes: (a_lat, a_lng, b_lat, b_lng) in log order
+    :param cells: snapping cell sizes in meters
+    :param min_distance: shortest leg in meters a snapped key may answer
+    :param depots: depots the ends are taken to
+    :return: {'quotes': n, 'exact': {...}, cell: {...}} with hit counts per leg type
+    """
+    report = {'quotes': len(quotes), 'exact': {'a_b': 0, 'depot_a': 0, 'b_depot': 0}}
+    report.update({cell: {'a_b': 0, 'depot_a': 0, 'b_depot': 0} for cell in cells})
+    seen = {name: set() for name in report if name != 'quotes'}
+    depot_lats, depot_lngs = haversine.coordinates(depots)
+
+    for a_lat, a_lng, b_lat, b_lng in quotes:
+        straight = haversine.haversine_matrix(numpy.array([a_lat]), numpy.array([a_lng]),
+                                              numpy.array([b_lat]), numpy.array([b_lng]))[0, 0]
+        to_depots = haversine.haversine_matrix(numpy.array([a_lat, b_lat]), numpy.array([a_lng, b_lng]),
+                                               depot_lats, depot_lngs)
+        depot_a, b_depot = to_depots.argmin(axis=1)
+        legs = {'a_b': (make_key(a_lat, a_lng, b_lat, b_lng), straight),
+                'depot_a': (make_key(depot_lats[depot_a], depot_lngs[depot_a], a_lat, a_lng), to_depots[0, depot_a]),
+                'b_depot': (make_key(b_lat, b_lng, depot_lats[b_depot], depot_lngs[b_depot]), to_depots[1, b_depot])}
+
+        for leg, (key, meters) in legs.items():
+            long_enough = meters * haversine.ROAD_FACTOR >= min_distance
+            exact_hit = (leg, key) in seen['exact']
+            report['exact'][leg] += exact_hit
+            seen['exact'].add((leg, key))
+            for cell in cells:
+                snapped = (leg, snap_key(key, cell))
+                report[cell][leg] += exact_hit or (long_enough and snapped in seen[cell])
+                seen[cell].add(snapped)
+    return report
+
+
+def print_report(report: dict) -> None:
+    total = report['quotes']
+    print(f'QueryLog replay: {total} quotes')
+    if not total:
+        return
+    print(f'{"keys":>10} {"A->B":>10} {"depot->A":>10} {"B->depot":>10} {"A->B gain":>10}')
+    base = report['exact']['a_b']
+    for name, hits in report.items():
+        if name == 'quotes':
+            continue
+        label = 'exact' if name == 'exact' else f'{name} m'
+        rates = [f'{hits[leg] / total:>10.1%}' for leg in ('a_b', 'depot_a', 'b_depot')]
+        print(f'{label:>10} {" ".join(rates)} {(hits["a_b"] - base) / total:>+10.1%}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Snapped cache key hit-rate report over a QueryLog replay')
+    parser.add_argument('--querylog', default=settings.QUERYLOG_DB_LOC)
+    parser.add_argument('--cells', default='100,200,500,1000', help='comma separated cell sizes in meters')
+    parser.add_argument('--min-distance', type=float, default=settings.CACHE_SNAP_MIN_DISTANCE,
+                        help='shortest leg in meters a snapped key may answer')
+    args = parser.parse_args()
+
+    cells = [int(cell) for cell in args.cells.split(',')]
+    print_report(replay(list(read_quotes(args.querylog)), cells, args.min_distance, DEPOTPARK.filter_by(None)))
+
+
+if __name__ == '__main__':
+    main()
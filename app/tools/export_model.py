@@ -0,0 +1,24 @@
+"""
+Exports the dense layers' weights of the .keras price model into the .npz file
+used by the NumPy serving predictor (see app.lib.ai.serving). Serving refuses weights older
+than their model and never exports them itself: run this after replacing a .keras file by hand.
+Retrained versions are exported by versions.publish.
+
+Usage:
+    python -m app.tools.export_model [--model path.keras] [--weights path.npz]
+"""
+import argparse
+from app import settings
+from app.lib.ai.encoding import export_weights
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export price model weights for NumPy serving')
+    parser.add_argument('--model', default=settings.AI_MODEL_LOC)
+    parser.add_argument('--weights', default=settings.AI_WEIGHTS_LOC)
+    args = parser.parse_args()
+    export_weights(args.model, args.weights)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+One-shot migration of a legacy distance cache file into the managed schema
+(integer microdegree coordinates, composite primary key, WITHOUT ROWID).
+
+The file is converted in place. Already migrated files are left untouched.
+
+Usage:
+    python -m app.tools.migrate_cache [path/to/cache.sqlite ...]
+
+Without arguments settings.CACHE_LOC is migrated.
+"""
+import argparse
+import time
+from app import settings
+from app.lib.utils.cache import Cache, SCHEMA_VERSION
+from app.lib.utils.logger import logger
+
+
+def migrate_file(location: str) -> None:
+    started = time.perf_counter()
+    cache = Cache(location=location)  # Cache.ensure_schema() migrates on open
+    try:
+        rows = cache.conn.execute('SELECT count(*) FROM "Distances"').fetchone()[0]
+        logger.info(f'{location}: schema version {cache.schema_version()} (expected {SCHEMA_VERSION}), '
+                    f'{rows} rows, took {time.perf_counter() - started:.2f} s')
+    finally:
+        cache.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Migrate distance cache files to the managed schema')
+    parser.add_argument('locations', nargs='*', default=[settings.CACHE_LOC], help='cache.sqlite files')
+    args = parser.parse_args()
+    for location in args.locations:
+        migrate_file(location)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Prices a file of lanes offline: every lane goes through plan_and_measure and the predictor, like
+/calculate/, without any of the QueryLog, Telegram or SMS side effects of app.main.
+
+Input is .csv (header row) or .jsonl, one lane per row/line with the fields
+    from_lat, from_lng, to_lat, to_lng, transport_id[, from_countrycode, to_countrycode, from_name, to_name]
+JSONL lines may also use the /calculate/ shape: {"from": {"lat", "lng", "countrycode", "name_short"}, "to": ..., "transport_id"}
+
+Lanes are priced on a thread pool sharing the route plan and distance caches, and written in input
+order as they complete (.csv or .jsonl by the output extension, JSONL to stdout by default). At most
+`workers * WINDOW_PER_WORKER` lanes are held in memory at once, so files of any size can be priced.
+Throughput and route cache / cache / Matrix API counters are reported at the end.
+
+Usage:
+    python -m app.tools.price_lanes lanes.csv [--output prices.csv] [--workers 8]
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+from app.lib.calc import calc_itself
+from app.lib.calc.calc_itself import Predictors
+from app.lib.calc.loadables.statepark import Currency
+from app.lib.calc.loadables.vehicles import VEHICLES
+from app.lib.calc.place import Place
+from app.lib.calc.route_cache import ROUTE_CACHE
+from app.lib.apis.googleapi import GAPI
+from app.lib.utils.cache import CACHE
+from app.lib.utils.logger import logger
+
+
+WINDOW_PER_WORKER = 4
+
+OUTPUT_FIELDS = ('index', 'from_lat', 'from_lng', 'to_lat', 'to_lng', 'transport_id',
+                 'starting_depot_id', 'ending_depot_id', 'distance_m', 'price_per_km', 'cost',
+                 'currency', 'currency_cost', 'error')
+
+
+def lane_from_row(row: dict) -> dict:
+    """
+    :param row: a flat CSV/JSONL row or a /calculate/-like object
+    :return: {'from': Place, 'to': Place, 'transport_id': int}
+    """
+    if isinstance(row.get('from'), dict):
+        origin, destination = row['from'], row['to']
+        return {'from': Place(float(origin['lat']), float(origin['lng']), origin.get('name_short'),
+                              origin.get('name_long'), origin.get('countrycode')),
+                'to': Place(float(destination['lat']), float(destination['lng']), destination.get('name_short'),
+                            destination.get('name_long'), destination.get('countrycode')),
+                'transport_id': int(row['transport_id'])}
+    return {'from': Place(float(row['from_lat']), float(row['from_lng']), row.get('from_name') or None,
+                          None, row.get('from_countrycode') or None),
+            'to': Place(float(row['to_lat']), float(row['to_lng']), row.get('to_name') or None,
+                        None, row.get('to_countrycode') or None),
+            'transport_id': int(row['transport_id'])}
+
+
+def read_rows(location: Path) -> Iterator[dict]:
+    with open(location, mode='r', encoding='utf-8', newline='') as f:
+        if location.suffix.lower() == '.csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def price_lane(index: int, row: dict) -> dict:
+    """
+    Prices one lane. Errors are reported in the result instead of being raised
+    :return: output record, see OUTPUT_FIELDS
+    """
+    result = dict.fromkeys(OUTPUT_FIELDS)
+    result['index'] = index
+    try:
+        lane = lane_from_row(row)
+        result.update(from_lat=lane['from'].lat, from_lng=lane['from'].lng,
+                      to_lat=lane['to'].lat, to_lng=lane['to'].lng, transport_id=lane['transport_id'])
+        vehicle = VEHICLES.get_by_id(lane['transport_id'])
+        route, distance = calc_itself.plan_and_measure(lane['from'], lane['to'])
+        price = Predictors.ml(route[0], route[3], vehicle, distance)
+        cost = distance / 1000 * price
+        currency = Currency.get_preferred(route[0].currency, route[3].currency)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        return result
+    result.update(starting_depot_id=route[0].id, ending_depot_id=route[3].id,
+                  distance_m=round(distance), price_per_km=round(price, 2), cost=round(cost, 2),
+                  currency=currency.iso_code, currency_cost=round(cost / currency.rate(), 2))
+    return result
+
+
+def price_lanes(rows: Iterator[dict], workers: int) -> Iterator[dict]:
+    """
+    Prices lanes on a thread pool keeping at most workers * WINDOW_PER_WORKER of them in flight
+    :return: Iterator of output records, in input order
+    """
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='price-lanes') as executor:
+        for index, row in enumerate(rows):
+            if len(window) >= workers * WINDOW_PER_WORKER:
+                yield window.popleft().result()
+            window.append(executor.submit(price_lane, index, row))
+        while window:
+            yield window.popleft().result()
+
+
+class Writer:
+
+    def __init__(self, stream: TextIO, as_csv: bool):
+        self.stream = stream
+        self.csv = csv.DictWriter(stream, fieldnames=OUTPUT_FIELDS) if as_csv else None
+        if self.csv:
+            self.csv.writeheader()
+
+    def write(self, record: dict) -> None:
+        if self.csv:
+            self.csv.writerow(record)
+        else:
+            self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def run(source: Path, output: Optional[Path], workers: int) -> dict:
+    """
+    :return: report of the run
+    """
+    started = time.perf_counter()
+    priced = failed = 0
+    stream = open(output, mode='w', encoding='utf-8', newline='') if output else sys.stdout
+    try:
+        writer = Writer(stream, as_csv=output is not None and output.suffix.lower() == '.csv')
+        for record in price_lanes(read_rows(source), workers):
+            writer.write(record)
+            if record['error']:
+                failed += 1
+            else:
+                priced += 1
+    finally:
+        if output:
+            stream.close()
+    CACHE.flush()
+    seconds = time.perf_counter() - started
+    return {'lanes': priced + failed, 'priced': priced, 'failed': failed, 'seconds': round(seconds, 2),
+            'lanes_per_second': round((priced + failed) / seconds, 1) if seconds else 0.0,
+            'route_cache': ROUTE_CACHE.stats(), 'cache': CACHE.stats(), 'matrix_api': GAPI.stats()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Price a file of lanes offline, without notifications')
+    parser.add_argument('lanes', type=Path, help='.csv or .jsonl file of lanes')
+    parser.add_argument('--output', type=Path, default=None, help='.csv or .jsonl file, JSONL to stdout by default')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    report = run(args.lanes, args.output, args.workers)
+    logger.info(f'Priced {report["priced"]} of {report["lanes"]} lanes in {report["seconds"]} s '
+                f'({report["lanes_per_second"]} lanes/s)')
+    print(json.dumps(report, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Fine-tunes the served price model on the QueryLog out of the request path, meant to run as its own
+process (cron, systemd timer) next to the app:
+
+ 1. loads the version the pointer names (settings.AI_MODEL_LOC until a version is published),
+ 2. measures its MAE on the holdout part of the log (every AI_RETRAIN_HOLDOUT_EVERY-th row),
+ 3. fine-tunes it on the rest of the log, streamed (see app.lib.ai.querylog_source),
+ 4. measures the MAE of the tuned model on the same holdout,
+ 5. if it is not worse than before (AI_RETRAIN_TOLERANCE allowing), writes it as a new version
+    (.keras and serving .npz in AI_MODEL_VERSIONS_DIR) and replaces the pointer file.
+
+The pointer file is the signal: every app process checks it with the price table sources
+(AI_PRICE_TABLE_CHECK_INTERVAL), loads the new weights and rebuilds the price table in a
+background thread, then swaps both in. Requests keep being served by the old version until then.
+Old versions are kept, publishing one of them again rolls back.
+
+Usage:
+    python -m app.tools.retrain [--epochs 5] [--batch-size 1500] [--dry-run]
+"""
+import argparse
+import json
+import sys
+import time
+from app import settings
+from app.lib.ai import versions
+from app.lib.ai.model import PricePredictor
+from app.lib.ai.querylog_source import QueryLogSource
+from app.lib.calc.loadables.depotpark import DEPOTPARK
+from app.lib.utils.logger import logger
+
+
+def run(querylog_loc: str = settings.QUERYLOG_DB_LOC,
+        epochs: int = 5,
+        batch_size: int = 1500,
+        holdout_every: int = settings.AI_RETRAIN_HOLDOUT_EVERY,
+        tolerance: float = settings.AI_RETRAIN_TOLERANCE,
+        pointer_loc: str = settings.AI_MODEL_POINTER_LOC,
+        versions_dir: str = settings.AI_MODEL_VERSIONS_DIR,
+        dry_run: bool = False) -> dict:
+    """
+    :return: report of the run, 'published' tells whether the new version is served now
+    """
+    started = time.perf_counter()
+    current = versions.read_pointer(pointer_loc)
+    base_loc = current['model'] if current else settings.AI_MODEL_LOC
+    predictor = PricePredictor(base_loc)
+    depots = DEPOTPARK.filter_by(None)
+    sizes = {'depots_qty': predictor.depots_qty, 'vehicles_qty': predictor.vehicles_qty}
+    train = QueryLogSource(depots, querylog_loc, part='train', holdout_every=holdout_every, **sizes)
+    holdout = QueryLogSource(depots, querylog_loc, part='holdout', holdout_every=holdout_every, **sizes)
+
+    baseline_mae = predictor.evaluate(holdout, batch_size)
+    predictor.fine_tune(train, epochs, batch_size)
+    candidate_mae = predictor.evaluate(holdout, batch_size)
+
+    report = {'base': current['version'] if current else base_loc,
+              'train_rows': train.count(), 'holdout_rows': holdout.count(), 'skipped_rows': train.skipped,
+              'baseline_mae': round(baseline_mae, 4), 'candidate_mae': round(candidate_mae, 4),
+              'published': False, 'version': None}
+    if candidate_mae > baseline_mae * (1 + tolerance):
+        logger.warning(f'Retrained model rejected: holdout MAE {candidate_mae:.4f} > {baseline_mae:.4f}')
+    elif not dry_run:
+        version, model_loc, weights_loc = versions.new_version(versions_dir)
+        predictor.save(model_loc, weights_loc)
+        versions.publish(version, model_loc, weights_loc, pointer_loc, base=report['base'],
+                         holdout_mae=report['candidate_mae'], baseline_mae=report['baseline_mae'])
+        report.update(published=True, version=version)
+        logger.info(f'Price model {version} published: holdout MAE {baseline_mae:.4f} -> {candidate_mae:.4f}')
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fine-tune the price model on the QueryLog and publish it')
+    parser.add_argument('--querylog', default=settings.QUERYLOG_DB_LOC)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=1500)
+    parser.add_argument('--holdout-every', type=int, default=settings.AI_RETRAIN_HOLDOUT_EVERY)
+    parser.add_argument('--tolerance', type=float, default=settings.AI_RETRAIN_TOLERANCE)
+    parser.add_argument('--dry-run', action='store_true', help='validate only, do not publish')
+    args = parser.parse_args()
+
+    report = run(args.querylog, args.epochs, args.batch_size, args.holdout_every, args.tolerance,
+                 dry_run=args.dry_run)
+    print(json.dumps(report, indent=2), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import time
+import numpy
+import pytest
+from app.lib.calc.calc_itself import DistanceResolvers
+from app.lib.calc.loadables.depotpark import DEPOTPARK
+
+
+def best_of(func, repeats=20):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+@pytest.mark.benchmark
+def test_depot_haversine_array_vs_scalar():
+    depots = DEPOTPARK.filter_by(None)
+
+    vectorized, meters = best_of(lambda: DistanceResolvers.haversine_array(depots, depots))
+    scalar, expected = best_of(lambda: [[DistanceResolvers._haversine_step(a, b) for b in depots] for a in depots],
+                               repeats=1)
+
+    assert meters.shape == (len(depots), len(depots))
+    assert numpy.allclose(meters, expected, rtol=1e-9, atol=1e-6)
+    print(f'\n{len(depots)}x{len(depots)}: scalar {scalar * 1000:.2f} ms, array {vectorized * 1000:.3f} ms, '
+          f'x{scalar / vectorized:.0f}')
@@ -0,0 +1,67 @@
+import math
+import random
+import time
+import pytest
+from app.lib.apis import matrix_planner
+from app.lib.calc.place import Place
+
+
+def legacy_plan(groups):
+    """The planning resolve_distance_groups used before: every group as its whole origins x destinations
+    cross product, chunked by 25 when it fits 100 elements, by 10 otherwise
+    :return: (requests, elements)"""
+    requests = elements = 0
+    for group in groups:
+        origins = {matrix_planner.place_key(o) for o, _ in group}
+        destinations = {matrix_planner.place_key(d) for _, d in group}
+        chunk_size = 25 if len(origins) * len(destinations) <= 100 else 10
+        requests += math.ceil(len(origins) / chunk_size) * math.ceil(len(destinations) / chunk_size)
+        elements += len(origins) * len(destinations)
+    return requests, elements
+
+
+def planned(groups):
+    requests = matrix_planner.plan(groups)
+    return len(requests), sum(len(o) * len(d) for o, d in requests)
+
+
+def random_place(rnd):
+    return Place(round(rnd.uniform(44.5, 52.0), 6), round(rnd.uniform(22.5, 40.0), 6))
+
+
+def route_groups(rnd, depots, routes, candidates=5):
+    """Groups of measure_routes: depots -> A, A -> B and B -> depots, three per route"""
+    def closest(place):
+        return sorted(depots, key=lambda d: (d.lat - place.lat) ** 2 + (d.lng - place.lng) ** 2)[:candidates]
+    groups = []
+    for _ in range(routes):
+        place_a, place_b = random_place(rnd), random_place(rnd)
+        groups.append([(depot, place_a) for depot in closest(place_a)])
+        groups.append([(place_a, place_b)])
+        groups.append([(place_b, depot) for depot in closest(place_b)])
+    return groups
+
+
+def scenarios():
+    rnd = random.Random(42)
+    depots = [random_place(rnd) for _ in range(182)]
+    origins, destinations = depots[:40], depots[40:80]
+    place = random_place(rnd)
+    return {'fallback 182x1': [[(depot, place) for depot in depots]],
+            'single route': route_groups(rnd, depots, 1),
+            '50 routes': route_groups(rnd, depots, 50),
+            'sparse 300 of 40x40': [rnd.sample([(o, d) for o in origins for d in destinations], 300)]}
+
+
+@pytest.mark.benchmark
+def test_planner_is_never_worse_than_cross_products():
+    for name, groups in scenarios().items():
+        legacy_requests, legacy_elements = legacy_plan(groups)
+        started = time.perf_counter()
+        requests, elements = planned(groups)
+        seconds = time.perf_counter() - started
+        print(f'\n{name}: requests {legacy_requests} -> {requests}, elements {legacy_elements} -> {elements}, '
+              f'planned in {seconds * 1000:.1f} ms')
+        assert requests <= legacy_requests
+        weight = matrix_planner.settings.GOOGLE_API_REQUEST_WEIGHT
+        assert weight * requests + elements <= weight * legacy_requests + legacy_elements
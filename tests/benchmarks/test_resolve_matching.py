@@ -0,0 +1,61 @@
+import time
+import pytest
+from app.lib.apis.googleapi import API
+from app.lib.calc.distance import Distance
+from app.lib.calc.place import Place
+
+
+def linear_match(unresolved, api_response, origins, destinations):
+    """The matching resolve_distances used before: Distance objects per element, list.index and list.remove"""
+    acquired = []
+    for i, row in enumerate(api_response['rows']):
+        for j, element in enumerate(row['elements']):
+            acquired.append(Distance(Place(origins[i].lat, origins[i].lng),
+                                     Place(destinations[j].lat, destinations[j].lng),
+                                     element['distance']['value']))
+    resolved = []
+    for candidate in unresolved.copy():
+        try:
+            index = acquired.index(candidate)
+            candidate.distance = acquired[index].distance
+            resolved.append(candidate)
+            unresolved.remove(candidate)
+        except ValueError:
+            pass
+    return resolved, unresolved
+
+
+def hashed_match(unresolved, api_response, origins, destinations):
+    return API._match(unresolved, API._parse_api_response(api_response, origins, destinations))
+
+
+def case(n_origins, n_destinations):
+    origins = [Place(45.0 + i * 0.0137, 10.0 + i * 0.0071) for i in range(n_origins)]
+    destinations = [Place(50.0 + j * 0.0113, 20.0 - j * 0.0093) for j in range(n_destinations)]
+    api_response = {'status': 'OK',
+                    'rows': [{'elements': [{'status': 'OK', 'distance': {'value': 1000 + i + j}}
+                                           for j in range(n_destinations)]}
+                             for i in range(n_origins)]}
+    unresolved = [Distance(o, d) for o in origins for d in destinations]
+    return unresolved, api_response, origins, destinations
+
+
+def best_of(matcher, n_origins, n_destinations, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        unresolved, api_response, origins, destinations = case(n_origins, n_destinations)
+        started = time.perf_counter()
+        resolved, left = matcher(unresolved, api_response, origins, destinations)
+        timings.append(time.perf_counter() - started)
+        assert len(resolved) == n_origins * n_destinations and not left
+    return min(timings)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('n_origins,n_destinations', [(182, 1), (25, 25)])
+def test_hashed_matching_beats_linear_scan(n_origins, n_destinations):
+    linear = best_of(linear_match, n_origins, n_destinations)
+    hashed = best_of(hashed_match, n_origins, n_destinations)
+    print(f'\n{n_origins}x{n_destinations}: linear {linear * 1000:.2f} ms, hashed {hashed * 1000:.2f} ms, '
+          f'x{linear / hashed:.0f}')
+    assert hashed < linear
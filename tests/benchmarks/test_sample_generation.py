@@ -0,0 +1,20 @@
+import time
+import numpy
+import pytest
+from app.lib.ai.samples import SampleSpace
+from app.lib.calc.loadables.depotpark import DEPOTPARK
+from app.lib.calc.loadables.vehicles import VEHICLES
+
+
+@pytest.mark.benchmark
+def test_epoch_generation_time():
+    space = SampleSpace(DEPOTPARK.filter_by(None), VEHICLES.as_list)
+    rng = numpy.random.default_rng(0)
+
+    started = time.perf_counter()
+    for _ in range(30):  # One epoch of the default BatchGenerator: 30 batches of 1500
+        x, y = space.sample(1500, rng)
+    elapsed = time.perf_counter() - started
+
+    assert x.shape == (1500, 371) and numpy.isfinite(y).all()
+    print(f'\n30 x 1500 samples: {elapsed * 1000:.1f} ms, {30 * 1500 / elapsed:,.0f} samples/s')
@@ -0,0 +1,277 @@
+import sqlite3
+import time
+import pytest
+from unittest.mock import Mock
+from app.lib.utils import cache as cache_module
+from app.lib.utils.cache import Cache, MemoryTier, SCHEMA_VERSION, make_key, snap_key
+
+
+LEGACY_SCHEMA = """
+    CREATE TABLE "Distances" (
+        "from_lat"        REAL NOT NULL,
+        "from_lng"        REAL NOT NULL,
+        "to_lat"          REAL NOT NULL,
+        "to_lng"          REAL NOT NULL,
+        "distance_meters" INTEGER NOT NULL
+    );
+
+    CREATE INDEX geo ON Distances (from_lat, from_lng, to_lat, to_lng);
+"""
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0)
+    yield cache_
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_cache_it_and_look(cache):
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000.4)
+    assert cache.cache_look(50.0, 30.0, 49.0, 32.0) == 190000.0
+    assert cache.cache_look(49.0, 32.0, 50.0, 30.0) is None
+
+
+@pytest.mark.unit
+def test_cache_look_many_hits_and_misses(cache):
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache.cache_it(48.1, 11.5, 52.4, 13.2, 585000)
+
+    pairs = [(50.0, 30.0, 49.0, 32.0), (1.0, 2.0, 3.0, 4.0), (48.1, 11.5, 52.4, 13.2)]
+    hits, misses = cache.cache_look_many(pairs)
+
+    assert hits == {(50.0, 30.0, 49.0, 32.0): 190000.0, (48.1, 11.5, 52.4, 13.2): 585000.0}
+    assert misses == [(1.0, 2.0, 3.0, 4.0)]
+
+
+@pytest.mark.unit
+def test_cache_look_many_spans_chunks(cache):
+    pairs = [(float(i), 0.0, 0.0, float(i)) for i in range(Cache.BULK_CHUNK_SIZE * 2 + 7)]
+    for pair in pairs[::2]:
+        cache.cache_it(*pair, 1000)
+
+    hits, misses = cache.cache_look_many(pairs)
+
+    assert set(hits) == set(pairs[::2])
+    assert misses == pairs[1::2]
+
+
+@pytest.mark.unit
+def test_cache_look_many_empty(cache):
+    assert cache.cache_look_many([]) == ({}, [])
+
+
+@pytest.mark.unit
+def test_cache_it_overwrites_same_pair(cache):
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache.cache_it(50.0000001, 30.0, 49.0, 32.0, 191000)  # Same pair at microdegree precision
+    assert cache.cache_look(50.0, 30.0, 49.0, 32.0) == 191000.0
+    cache.flush()
+    assert cache.conn.execute('SELECT count(*) FROM Distances').fetchone()[0] == 1
+
+
+@pytest.mark.unit
+def test_legacy_cache_is_migrated(tmp_path):
+    location = str(tmp_path / 'legacy.sqlite')
+    conn = sqlite3.connect(location)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO Distances VALUES (?, ?, ?, ?, ?)', [
+        (52.4604285, 13.2736697, 51.5132744, 7.4652797, 490000),
+        (52.4604285, 13.2736697, 51.5132744, 7.4652797, 490000),  # Legacy files may hold duplicates
+        (49.227717, 31.852233, 50.5089112, 26.2566443, 520000),
+    ])
+    conn.commit()
+    conn.close()
+
+    cache_ = Cache(location=location)
+
+    assert cache_.schema_version() == SCHEMA_VERSION
+    assert cache_.conn.execute('SELECT count(*) FROM Distances').fetchone()[0] == 2
+    assert cache_.cache_look(52.4604285, 13.2736697, 51.5132744, 7.4652797) == 490000.0
+    assert cache_.cache_look(49.227717, 31.852233, 50.5089112, 26.2566443) == 520000.0
+    assert not cache_._table_exists('Distances_legacy')
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_memory_tier_lru_eviction():
+    tier = MemoryTier(max_size=2)
+    tier.put((1, 1, 1, 1), 1.0)
+    tier.put((2, 2, 2, 2), 2.0)
+    assert tier.get((1, 1, 1, 1)) == 1.0  # (1, ...) becomes the most recent
+    tier.put((3, 3, 3, 3), 3.0)  # Evicts (2, ...)
+
+    assert tier.get((2, 2, 2, 2)) is None
+    assert tier.get((3, 3, 3, 3)) == 3.0
+    assert tier.most_recent(5) == [(3, 3, 3, 3), (1, 1, 1, 1)]
+    assert tier.stats()['hits'] == 2
+    assert tier.stats()['misses'] == 1
+    assert tier.stats()['evictions'] == 1
+
+
+@pytest.mark.unit
+def test_cache_look_served_from_memory(cache):
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache.flush()
+    cache.conn.execute('DELETE FROM Distances')
+
+    assert cache.cache_look(50.0, 30.0, 49.0, 32.0) == 190000.0
+    hits, misses = cache.cache_look_many([(50.0, 30.0, 49.0, 32.0)])
+    assert hits == {(50.0, 30.0, 49.0, 32.0): 190000.0}
+    assert cache.memory.hits == 2
+
+
+@pytest.mark.unit
+def test_disk_hits_are_promoted_to_memory(cache):
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache.flush()
+    cache.memory = MemoryTier(max_size=10)
+
+    cache.cache_look_many([(50.0, 30.0, 49.0, 32.0)])
+
+    assert len(cache.memory) == 1
+    assert cache.memory.get(make_key(50.0, 30.0, 49.0, 32.0)) == 190000.0
+
+
+@pytest.mark.unit
+def test_memory_tier_prewarmed_from_recent(tmp_path):
+    location = str(tmp_path / 'cache.sqlite')
+    cache_ = Cache(location=location)
+    cache_.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache_.cache_it(48.1, 11.5, 52.4, 13.2, 585000)
+    cache_.close()
+
+    cache_ = Cache(location=location, prewarm_size=1)
+
+    assert len(cache_.memory) == 1
+    assert cache_.memory.get(make_key(48.1, 11.5, 52.4, 13.2)) == 585000.0  # The most recent one
+    cache_.close()
+
+
+def disk_rows(cache_):
+    return cache_.conn.execute('SELECT count(*) FROM Distances').fetchone()[0]
+
+
+@pytest.mark.unit
+def test_pending_writes_are_visible_before_flush(cache):
+    cache.memory = MemoryTier(max_size=0)  # Make sure the answer does not come from the memory tier
+    cache.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+
+    assert disk_rows(cache) == 0
+    assert cache.cache_look(50.0, 30.0, 49.0, 32.0) == 190000.0
+    assert cache.cache_look_many([(50.0, 30.0, 49.0, 32.0)]) == ({(50.0, 30.0, 49.0, 32.0): 190000.0}, [])
+
+
+@pytest.mark.unit
+def test_writes_are_batched_by_size(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_size=100, flush_interval=0)
+    for i in range(182):
+        cache_.cache_it(float(i), 0.0, 0.0, float(i), 1000)
+
+    assert cache_.flushes == 1
+    assert disk_rows(cache_) == 100
+    assert cache_.flush() == 82
+    assert disk_rows(cache_) == 182
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_close_persists_pending_writes(tmp_path):
+    location = str(tmp_path / 'cache.sqlite')
+    cache_ = Cache(location=location, flush_interval=0)
+    cache_.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    cache_.close()
+
+    cache_ = Cache(location=location, memory_size=0, flush_interval=0)
+    assert cache_.cache_look(50.0, 30.0, 49.0, 32.0) == 190000.0
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_failed_flush_keeps_records_for_a_retry(tmp_path, monkeypatch):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_size=4, flush_interval=0, pending_limit=6)
+    notified = []
+    monkeypatch.setattr(cache_module.tgapi2, 'send_developer',
+                        lambda *args: notified.append(cache_._lock._is_owned()))
+    cursor = cache_.c
+    cache_.c = Mock(executemany=Mock(side_effect=sqlite3.OperationalError('database is locked')))
+    for i in range(8):
+        cache_.cache_it(float(i), 0.0, 0.0, float(i), 1000)
+
+    assert cache_.flush() == 0
+    assert notified == [False]  # Once, out of the lock
+    assert cache_.stats()['pending'] == 6
+    assert cache_.dropped == 2
+
+    cache_.c = cursor
+    assert cache_.flush() == 6
+    assert disk_rows(cache_) == 6
+    assert cache_.cache_look(7.0, 0.0, 0.0, 7.0) == 1000.0
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_background_flush_by_age(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0.05)
+    cache_.cache_it(50.0, 30.0, 49.0, 32.0, 190000)
+    for _ in range(100):
+        if cache_.flushes:
+            break
+        time.sleep(0.01)
+
+    assert disk_rows(cache_) == 1
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_snap_key_groups_close_points():
+    a = make_key(49.227717, 31.852233, 50.5089112, 26.2566443)
+    b = make_key(49.227737, 31.852263, 50.5089012, 26.2566243)  # A few meters away
+    far = make_key(49.237717, 31.852233, 50.5089112, 26.2566443)  # ~1 km away
+    assert snap_key(a, 200) == snap_key(b, 200)
+    assert snap_key(a, 200) != snap_key(far, 200)
+
+
+@pytest.mark.unit
+def test_snapped_hit_for_long_legs_only(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0,
+                   snap_meters=200, snap_min_distance=50000)
+    cache_.cache_it(49.227717, 31.852233, 50.5089112, 26.2566443, 520000)
+    cache_.cache_it(49.227717, 31.852233, 49.3781683, 32.0557625, 30000)
+    cache_.flush()
+    cache_.memory = MemoryTier(max_size=0)  # Answers should come from disk
+
+    assert cache_.cache_look(49.227737, 31.852263, 50.5089012, 26.2566243) == 520000.0
+    assert cache_.cache_look(49.227737, 31.852263, 49.3781583, 32.0557525) is None  # Too short to snap
+    assert cache_.snapped_hits == 1
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_snapped_probe_is_not_counted_by_memory_tier(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0,
+                   snap_meters=200, snap_min_distance=50000)
+    cache_.cache_it(49.227717, 31.852233, 50.5089112, 26.2566443, 520000)
+
+    assert cache_.cache_look(49.227737, 31.852263, 50.5089012, 26.2566243) == 520000.0  # Snapped hit
+    assert cache_.cache_look(10.0, 10.0, 11.0, 11.0) is None
+
+    assert (cache_.memory.hits, cache_.memory.misses) == (0, 2)
+    assert cache_.snapped_hits == 1
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_snapping_is_opt_in(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0)
+    assert cache_.snap_meters == 0
+    cache_.close()
+
+
+@pytest.mark.unit
+def test_snapping_disabled(tmp_path):
+    cache_ = Cache(location=str(tmp_path / 'cache.sqlite'), flush_interval=0, snap_meters=0)
+    cache_.cache_it(49.227717, 31.852233, 50.5089112, 26.2566443, 520000)
+    assert cache_.cache_look(49.227737, 31.852263, 50.5089012, 26.2566243) is None
+    cache_.close()
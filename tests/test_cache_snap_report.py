@@ -0,0 +1,14 @@
+import pytest
+from app.tools.cache_snap_report import replay
+
+
+@pytest.mark.unit
+def test_short_depot_legs_are_not_snapped(depot_1, depot_2):
+    # Two quotes 40 m apart at both ends: Vinnytsia (5 km from its depot) -> Odesa (next to its depot)
+    quotes = [(49.2000, 28.4800, 46.4824, 30.7610), (49.2003, 28.4803, 46.4827, 30.7613)]
+
+    report = replay(quotes, [1000], 50000, [depot_1, depot_2])
+
+    assert report['exact'] == {'a_b': 0, 'depot_a': 0, 'b_depot': 0}
+    assert report[1000] == {'a_b': 1, 'depot_a': 0, 'b_depot': 0}
+    assert replay(quotes, [1000], 0, [depot_1, depot_2])[1000] == {'a_b': 1, 'depot_a': 1, 'b_depot': 1}
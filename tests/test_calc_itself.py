@@ -1,12 +1,25 @@
 
+import threading
 import pytest
-import unittest
 from unittest.mock import Mock
 from app.lib.calc.place import Place
 from app.lib.calc.loadables.depot import Depot
 from app.lib.calc.loadables.vehicles import Vehicle
+from app.lib.calc.loadables.depotpark import NoDepots
 from app.lib.utils.DTOs import RequestDTO
-from app.lib.calc.calc_itself import plan_route, calculate, process_request
+from app.lib.calc.calc_itself import plan_route, calculate, process_request, closest_candidates
+from app.lib.calc.calc_itself import process_request_all_vehicles, Predictors, measure_routes, process_batch
+from app.lib.calc.calc_itself import ZeroDistanceResultsError, DistanceContext, measure_route
+from app.lib.calc.route_cache import ROUTE_CACHE, RoutePlanCache
+from app.lib.calc.calc_itself import DistanceResolvers, measure_legs
+from app.lib.apis.googleapi import API
+
+
+@pytest.fixture(autouse=True)
+def empty_route_cache():
+    ROUTE_CACHE.clear()
+    yield
+    ROUTE_CACHE.clear()
 
 
 @pytest.fixture
@@ -61,19 +74,115 @@ def depot_park(depot):
     return mock_park
 
 
+class GroupResolver:
+    """Resolves every Distance to `meters` of its origin unless the pair is listed as having no route"""
+
+    def __init__(self, no_route=()):
+        self.no_route = set(no_route)
+        self.calls = []
+
+    def __call__(self, groups):
+        self.calls.append(groups)
+        for group in groups:
+            for dist in group:
+                if (dist.place_from.name, dist.place_to.name) not in self.no_route:
+                    dist.distance = 1000.0 * (1 + len(dist.place_from.name or ''))
+
+
+class FixedResolver(GroupResolver):
+    """Resolves every Distance to the same `meters`"""
+
+    def __init__(self, meters):
+        super().__init__()
+        self.meters = meters
+
+    def __call__(self, groups):
+        self.calls.append(groups)
+        for group in groups:
+            for dist in group:
+                dist.distance = self.meters
+
+
 @pytest.mark.unit
 def test_plan_route_success(place_a, place_b, depot_park):
-    mock_dist = Mock()
-    mock_dist.place_from = depot_park.filter_by("UA")[0]
-    mock_dist.place_to = depot_park.filter_by("UA")[0]
+    resolver = GroupResolver()
 
-    matrix_mock = Mock(return_value=[mock_dist])
-
-    with unittest.mock.patch("app.lib.calc.calc_itself.DistanceResolvers.matrix", matrix_mock):
-        result = plan_route(place_a, place_b, dptpark=depot_park)
+    result = plan_route(place_a, place_b, dptpark=depot_park, context=DistanceContext(resolver))
 
     assert len(result) == 4
     assert result[0] == depot_park.filter_by("UA")[0]
+    assert len(resolver.calls) == 1  # Depot candidates of both ends and A -> B together
+    assert len(resolver.calls[0]) == 3
+
+
+@pytest.mark.unit
+def test_route_legs_are_resolved_once_per_request(place_a, place_b, depot_park, depot):
+    resolver = GroupResolver()
+    context = DistanceContext(resolver)
+
+    route = plan_route(place_a, place_b, dptpark=depot_park, context=context)
+    distance = measure_route(route, context.matrix)
+
+    assert len(resolver.calls) == 1
+    assert distance == 1000.0 * (1 + len(depot.name)) + 1000.0 * 5 + 1000.0 * 9
+
+
+class BarrierSession:
+    """
+    Answers every Matrix API request with 1000 m per element once `parties` requests are in flight
+    together. Requests made one after another break the barrier after `timeout` seconds instead
+    """
+
+    def __init__(self, parties, timeout=5.0):
+        self.barrier = threading.Barrier(parties, timeout=timeout)
+        self.calls = 0
+        self.broken = False
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.calls += 1
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            self.broken = True
+        response = Mock()
+        response.json.return_value = {
+            'status': 'OK',
+            'rows': [{'elements': [{'status': 'OK', 'distance': {'value': 1000}}
+                                   for _ in params['destinations'].split('|')]}
+                     for _ in params['origins'].split('|')]}
+        return response
+
+
+@pytest.mark.unit
+def test_route_stages_take_one_round_trip(place_a, place_b, depot_park):
+    api = API()
+    api.session = BarrierSession(parties=1)
+    cache = Mock()
+    cache.cache_look_many.side_effect = lambda pairs: ({}, list(pairs))
+    dmatrix = Mock()
+    dmatrix.lookup.return_value = None
+    context = DistanceContext(lambda groups: DistanceResolvers.resolve_groups(groups, cache, api, dmatrix))
+
+    route = plan_route(place_a, place_b, dptpark=depot_park, context=context)
+    legs = measure_legs(route, context.matrix)
+
+    assert legs == (1000, 1000, 1000)
+    assert api.session.calls == 1  # Origin depot, A -> B and destination depot share a 3 x 3 request
+    assert not api.session.broken
+
+
+@pytest.mark.unit
+def test_context_does_not_retry_unresolvable_legs(place_a, place_b):
+    resolver = GroupResolver(no_route={('Kyiv', 'Cherkasy')})
+    context = DistanceContext(resolver)
+
+    for _ in range(2):
+        with pytest.raises(ZeroDistanceResultsError):
+            context.matrix([place_a], [place_b])
+    assert len(resolver.calls) == 1
+    assert context.matrix([place_b], [place_a])[0].distance == 1000.0 * 9
 
 
 @pytest.mark.unit
@@ -101,13 +210,10 @@ def test_process_request_basic(monkeypatch, place_a, place_b, depot, vehicle):
     request = RequestDTO(origin=place_a, destination=place_b, vehicle=vehicle, locale="uk_UA")
 
     # Monkeypatch plan_route
-    monkeypatch.setattr("app.lib.calc.calc_itself.plan_route", lambda a, b: (depot, a, b, depot))
+    monkeypatch.setattr("app.lib.calc.calc_itself.plan_route", lambda a, b, context=None: (depot, a, b, depot))
 
     # Patch dist resolver
-    mock_dist = Mock()
-    mock_dist.distance = 100000
-
-    monkeypatch.setattr("app.lib.calc.calc_itself.DistanceResolvers.matrix", lambda f, t: [mock_dist])
+    monkeypatch.setattr("app.lib.calc.calc_itself.DistanceResolvers.resolve_groups", FixedResolver(100000))
     monkeypatch.setattr("app.lib.calc.calc_itself.Predictors.ml", lambda d1, d2, v, d: 20.0)
 
     currency_mock = Mock()
@@ -125,3 +231,135 @@ def test_process_request_basic(monkeypatch, place_a, place_b, depot, vehicle):
 
     assert isinstance(result.price, str)
     assert float(result.price_per_km) > 0
+
+
+@pytest.mark.unit
+def test_process_request_all_vehicles(monkeypatch, place_a, place_b, depot, vehicle, vehicle_1, vehicle_2):
+    request = RequestDTO(origin=place_a, destination=place_b, vehicle=vehicle, locale="uk_UA")
+    monkeypatch.setattr("app.lib.calc.calc_itself.plan_route", lambda a, b, context=None: (depot, a, b, depot))
+
+    resolver = FixedResolver(100000)
+    monkeypatch.setattr("app.lib.calc.calc_itself.DistanceResolvers.resolve_groups", resolver)
+
+    model = Mock()
+    model.predict_many.side_effect = lambda f, t, v: [10.0 * (vehicle_id + 1) for vehicle_id in v]
+    ml_many = Predictors.ml_many
+    monkeypatch.setattr("app.lib.calc.calc_itself.Predictors.ml_many",
+                        lambda d1, d2, v, d: ml_many(d1, d2, v, d, ml_model=model))
+
+    currency_mock = Mock()
+    currency_mock.rate.return_value = 1.0
+    monkeypatch.setattr("app.lib.calc.calc_itself.Currency.get_preferred", lambda a, b: currency_mock)
+
+    results = process_request_all_vehicles(request, vehicles=[vehicle_1, vehicle_2, vehicle])
+
+    assert len(resolver.calls) == 3  # The route is measured once
+    model.predict_many.assert_called_once()
+    assert [r.transport_id for r in results] == [0, 1, 6]
+    assert [r.price_per_km for r in results] == ['10.0', '20.0', '70.0']
+    assert {r.distance for r in results} == {'300.0'}
+
+    request = RequestDTO(origin=place_a, destination=place_b, vehicle=vehicle_1, locale="uk_UA")
+    results = process_request_all_vehicles(request, vehicles=[vehicle_2])
+
+    assert len(resolver.calls) == 3  # Planned route is taken from the route cache
+    assert results[0].distance == '300.0'
+
+
+@pytest.mark.unit
+def test_process_batch_fails_only_items_the_model_does_not_know(monkeypatch, place_a, place_b, depot, vehicle,
+                                                                 vehicle_1):
+    requests = [RequestDTO(origin=place_a, destination=place_b, vehicle=v, locale="uk_UA")
+                for v in (vehicle, vehicle_1)]
+    monkeypatch.setattr("app.lib.calc.calc_itself.measure_routes",
+                        lambda pairs, route_cache=None: [((depot, a, b, depot), 100000.0) for a, b in pairs])
+
+    def ml_batch(starting_depots, ending_depots, vehicles, distances):
+        if any(v.id == 6 for v in vehicles):
+            raise ValueError('Price model knows vehicle ids below 6')
+        return [20.0] * len(vehicles)
+
+    monkeypatch.setattr("app.lib.calc.calc_itself.Predictors.ml_batch", ml_batch)
+
+    results = dict(process_batch(requests))
+
+    assert isinstance(results[0], ValueError)
+    assert float(results[1].price_per_km) == 20.0
+
+
+@pytest.mark.unit
+def test_measure_routes_resolves_all_pairs_together(place_a, place_b, depot_park, depot):
+    resolver = GroupResolver()
+
+    results = measure_routes([(place_a, place_b), (place_b, place_a)], dptpark=depot_park, resolver=resolver)
+
+    assert len(resolver.calls) == 1  # Depot candidates and A -> B legs of both pairs in one resolve
+    assert len(resolver.calls[0]) == 6
+    route, distance = results[0]
+    assert route == (depot, place_a, place_b, depot)
+    assert distance == 1000.0 * (1 + len(depot.name)) + 1000.0 * 5 + 1000.0 * 9  # depot->A, A->B, B->depot
+
+
+@pytest.mark.unit
+def test_measure_routes_uses_route_cache(place_a, place_b, depot_park):
+    route_cache = RoutePlanCache(ttl=60)
+    resolver = GroupResolver()
+
+    first = measure_routes([(place_a, place_b)], dptpark=depot_park, resolver=resolver, route_cache=route_cache)
+    second = measure_routes([(place_a, place_b), (place_b, place_a)], dptpark=depot_park, resolver=resolver,
+                            route_cache=route_cache)
+
+    assert second[0] == first[0]
+    assert len(resolver.calls) == 2
+    assert len(resolver.calls[1]) == 3  # Only the pair missing from the cache is measured
+    assert route_cache.stats()['hits'] == 1
+
+
+@pytest.mark.unit
+def test_measure_routes_reports_unreachable_pairs(place_a, place_b, depot_park):
+    resolver = GroupResolver(no_route={('Kyiv', 'Cherkasy')})
+
+    results = measure_routes([(place_a, place_b), (place_b, place_a)], dptpark=depot_park, resolver=resolver)
+
+    assert isinstance(results[0], ZeroDistanceResultsError)
+    assert not isinstance(results[1], Exception)
+
+
+@pytest.mark.unit
+def test_measure_routes_does_not_resolve_all_depots_twice(place_a, place_b, depot):
+    def filter_by(cc):
+        if cc not in ("UA", None):
+            raise NoDepots(cc)
+        return [depot]
+
+    park = Mock()
+    park.filter_by.side_effect = filter_by
+    abroad = Place(lat=52.2, lng=21.0, name="Warsaw", countrycode="PL")
+    resolver = GroupResolver(no_route={(depot.name, "Warsaw"), ("Cherkasy", depot.name)})
+
+    results = measure_routes([(abroad, place_a), (place_a, place_b)], dptpark=park, resolver=resolver)
+
+    assert isinstance(results[0], ZeroDistanceResultsError)  # Used all the depots in the first round already
+    assert isinstance(results[1], ZeroDistanceResultsError)
+    assert len(resolver.calls) == 2
+    assert len(resolver.calls[1]) == 3  # Only the in-country pair is retried against all the depots
+
+
+@pytest.mark.unit
+def test_closest_candidates_keeps_k_nearest(place_a):
+    depots = [Place(lat=50.0 + i, lng=30.0, name=str(i)) for i in (5, 1, 3, 0.1, 2)]
+    candidates = closest_candidates(depots, place_a, k=2, radius=0)
+    assert [c.name for c in candidates] == ['0.1', '1']
+
+
+@pytest.mark.unit
+def test_closest_candidates_extends_within_radius(place_a):
+    depots = [Place(lat=50.0 + i, lng=30.0, name=str(i)) for i in (0.1, 0.2, 0.3, 3)]
+    candidates = closest_candidates(depots, place_a, k=1, radius=25000)  # 0.1 deg of latitude is ~11 km
+    assert [c.name for c in candidates] == ['0.1', '0.2', '0.3']
+
+
+@pytest.mark.unit
+def test_closest_candidates_disabled(place_a):
+    depots = [Place(lat=50.0 + i, lng=30.0) for i in range(10)]
+    assert closest_candidates(depots, place_a, k=0) == depots
@@ -0,0 +1,68 @@
+import pytest
+from app.lib.calc.depot_matrix import DepotMatrix
+from app.lib.calc.distance import Distance
+from app.lib.calc.loadables.depot import Depot
+
+
+@pytest.fixture
+def depot_3():
+    return Depot(lat=50.4500336, lng=30.5241361, name='Київ', state_iso='UA', depot_id=7)
+
+
+class FakeResolver:
+    """Resolves every pair to 1000 m per index step and records what was asked"""
+
+    def __init__(self):
+        self.asked = []
+
+    def __call__(self, places_from, places_to):
+        result = []
+        for plc_from in places_from:
+            for plc_to in places_to:
+                if plc_from != plc_to:
+                    self.asked.append((plc_from.id, plc_to.id))
+                    result.append(Distance(plc_from, plc_to, 1000.0 * (plc_from.id + plc_to.id)))
+        return result
+
+
+@pytest.mark.unit
+def test_build_and_lookup(tmp_path, depot_1, depot_2, depot_3, place_1):
+    matrix = DepotMatrix(tmp_path / 'depot_matrix.npy').build([depot_1, depot_2, depot_3], FakeResolver())
+
+    assert len(matrix) == 3
+    assert matrix.lookup(depot_2, depot_3) == 31000.0
+    assert matrix.lookup(depot_1, depot_1) == 0.0
+    assert matrix.lookup(depot_1, place_1) is None  # Not a depot
+
+
+@pytest.mark.unit
+def test_loaded_from_disk(tmp_path, depot_1, depot_2):
+    DepotMatrix(tmp_path / 'depot_matrix.npy').build([depot_1, depot_2], FakeResolver())
+    matrix = DepotMatrix(tmp_path / 'depot_matrix.npy').load()
+    assert matrix.lookup(depot_1, depot_2) == 24000.0
+
+
+@pytest.mark.unit
+def test_rebuild_resolves_only_changed_depots(tmp_path, depot_1, depot_2, depot_3):
+    matrix = DepotMatrix(tmp_path / 'depot_matrix.npy').build([depot_1, depot_2], FakeResolver())
+
+    depot_2.lat += 0.01  # Moved
+    resolver = FakeResolver()
+    matrix.build([depot_1, depot_2, depot_3], resolver)
+
+    assert all(24 in pair or 7 in pair for pair in resolver.asked)
+    assert (0, 24) in resolver.asked and (0, 7) in resolver.asked
+    assert matrix.lookup(depot_3, depot_1) == 7000.0
+
+
+@pytest.mark.unit
+def test_moved_depot_does_not_match_stale_matrix(tmp_path, depot_1, depot_2):
+    matrix = DepotMatrix(tmp_path / 'depot_matrix.npy').build([depot_1, depot_2], FakeResolver())
+    depot_2.lng += 0.5
+    assert matrix.lookup(depot_1, depot_2) is None
+
+
+@pytest.mark.unit
+def test_unbuilt_matrix_resolves_nothing(tmp_path, depot_1, depot_2):
+    matrix = DepotMatrix(tmp_path / 'missing.npy').load()
+    assert matrix.lookup(depot_1, depot_2) is None
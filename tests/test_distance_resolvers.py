@@ -1,5 +1,7 @@
 import pytest
+import numpy
 from app.lib.calc.calc_itself import DistanceResolvers, ZeroDistanceResultsError
+from app.lib.calc import haversine
 from app.lib.calc.distance import Distance
 
 
@@ -13,9 +15,17 @@ def dummy_api(mocker):
     return mocker.Mock()
 
 
+def cache_returns(cache, meters):
+    """Makes a mocked cache answer every bulk lookup with the same value (or miss everything on None)"""
+    if meters is None:
+        cache.cache_look_many.side_effect = lambda pairs: ({}, list(pairs))
+    else:
+        cache.cache_look_many.side_effect = lambda pairs: ({pair: meters for pair in pairs}, [])
+
+
 @pytest.mark.unit
 def test_matrix_basic_resolution(place_1, place_2, dummy_cache, dummy_api):
-    dummy_cache.cache_look.return_value = 490000
+    cache_returns(dummy_cache, 490000)
     dummy_api.resolve_distances.return_value = ([], [])  # Nothing left for API
 
     result = DistanceResolvers.matrix([place_1], [place_2], cache_=dummy_cache, gapi_=dummy_api)
@@ -28,7 +38,7 @@ def test_matrix_basic_resolution(place_1, place_2, dummy_cache, dummy_api):
 
 @pytest.mark.unit
 def test_matrix_resolves_with_api_fallback(place_1, place_2, dummy_cache, dummy_api):
-    dummy_cache.cache_look.return_value = None
+    cache_returns(dummy_cache, None)
 
     dist = Distance(place_1, place_2, 490000)
     dummy_api.resolve_distances.return_value = ([dist], [])
@@ -42,7 +52,7 @@ def test_matrix_resolves_with_api_fallback(place_1, place_2, dummy_cache, dummy_
 
 @pytest.mark.unit
 def test_matrix_raises_when_unresolved(place_1, place_2, dummy_cache, dummy_api):
-    dummy_cache.cache_look.return_value = None
+    cache_returns(dummy_cache, None)
     dummy_api.resolve_distances.return_value = ([], [Distance(place_1, place_2)])
 
     with pytest.raises(ZeroDistanceResultsError):
@@ -54,6 +64,7 @@ def test_matrix_raises_when_unresolved(place_1, place_2, dummy_cache, dummy_api)
 
 @pytest.mark.unit
 def test_matrix_empty_inputs(dummy_cache, dummy_api):
+    cache_returns(dummy_cache, None)
     dummy_api.resolve_distances.return_value = ([], [])
     with pytest.raises(ZeroDistanceResultsError):
         result = DistanceResolvers.matrix([], [], cache_=dummy_cache, gapi_=dummy_api)
@@ -68,7 +79,7 @@ def test_matrix_identical_place_is_skipped(place_1, dummy_cache, dummy_api):
 
 @pytest.mark.unit
 def test_matrix_duplicate_inputs_are_handled(place_1, place_2, dummy_cache, dummy_api):
-    dummy_cache.cache_look.return_value = 500
+    cache_returns(dummy_cache, 500)
     dummy_api.resolve_distances.return_value = ([], [])
     result = DistanceResolvers.matrix([place_1, place_1], [place_2, place_2], cache_=dummy_cache, gapi_=dummy_api)
 
@@ -76,3 +87,78 @@ def test_matrix_duplicate_inputs_are_handled(place_1, place_2, dummy_cache, dumm
     assert len(result) == 4
     for d in result:
         assert d.distance == 500
+
+
+@pytest.mark.unit
+def test_cache_is_queried_once_per_matrix(place_1, place_2, place_3, dummy_cache, dummy_api):
+    cache_returns(dummy_cache, 1000)
+    dummy_api.resolve_distances.return_value = ([], [])
+    DistanceResolvers.matrix([place_1, place_2], [place_3], cache_=dummy_cache, gapi_=dummy_api)
+    assert dummy_cache.cache_look_many.call_count == 1
+    assert len(dummy_cache.cache_look_many.call_args.args[0]) == 2
+
+
+@pytest.mark.unit
+def test_haversine_matrix_matches_scalar(place_1, place_2, place_3):
+    places = [place_1, place_2, place_3]
+    lats, lngs = haversine.coordinates(places)
+    result = haversine.haversine_matrix(lats, lngs, lats, lngs)
+
+    assert result.shape == (3, 3)
+    for i, plc_from in enumerate(places):
+        for j, plc_to in enumerate(places):
+            expected = DistanceResolvers._haversine_step(plc_from, plc_to) / 1.33
+            assert numpy.isclose(result[i, j], expected, rtol=1e-9, atol=1e-6)
+
+
+def api_resolves(api, meters):
+    """Makes a mocked API resolve every requested Distance of every group with the same value"""
+    def resolve(groups):
+        dists = [dist for group in groups for dist in group]
+        for dist in dists:
+            dist.distance = meters
+        return dists, []
+    api.resolve_distance_groups.side_effect = resolve
+
+
+@pytest.mark.unit
+def test_resolve_groups_requests_every_pair_once(place_1, place_2, place_3, dummy_cache, dummy_api):
+    cache_returns(dummy_cache, None)
+    api_resolves(dummy_api, 1000)
+    groups = [[Distance(place_1, place_2), Distance(place_3, place_2)],
+              [Distance(place_1, place_2)],  # Duplicate of the first group's pair
+              [Distance(place_2, place_3)]]
+
+    resolved, unresolved = DistanceResolvers.resolve_groups(groups, cache_=dummy_cache, gapi_=dummy_api)
+
+    assert len(resolved) == 4
+    assert unresolved == []
+    assert all(dist.distance == 1000 for group in groups for dist in group)
+    requested = dummy_api.resolve_distance_groups.call_args[0][0]
+    assert [len(group) for group in requested] == [2, 1]  # The duplicate is not requested again
+    assert dummy_cache.cache_look_many.call_count == 1
+    assert dummy_cache.cache_it.call_count == 3
+
+
+@pytest.mark.unit
+def test_resolve_groups_skips_api_on_cache_hits(place_1, place_2, dummy_cache, dummy_api):
+    cache_returns(dummy_cache, 490000)
+    api_resolves(dummy_api, 1000)
+
+    resolved, unresolved = DistanceResolvers.resolve_groups([[Distance(place_1, place_2)]],
+                                                            cache_=dummy_cache, gapi_=dummy_api)
+
+    assert [dist.distance for dist in resolved] == [490000]
+    dummy_api.resolve_distance_groups.assert_not_called()
+
+
+@pytest.mark.unit
+def test_haversine_resolver_matches_scalar(place_1, place_2, place_3):
+    places = [place_1, place_2, place_3]
+    result = DistanceResolvers.haversine(places, places)
+
+    assert len(result) == 6  # A place to itself is skipped
+    assert result == sorted(result)
+    for dist in result:
+        expected = DistanceResolvers._haversine_step(dist.place_from, dist.place_to)
+        assert numpy.isclose(dist.distance, expected, rtol=1e-9)
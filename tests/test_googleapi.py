@@ -0,0 +1,181 @@
+import threading
+import pytest
+from unittest.mock import Mock
+from app.lib.apis.googleapi import API, AdaptiveLimit, GoogleApiRequestError
+from app.lib.calc.distance import Distance
+from app.lib.calc.place import Place
+
+
+def matrix_response(origins_param: str, destinations_param: str, status: str = 'OK') -> dict:
+    """Builds a Distance Matrix response where every element is 1000 m"""
+    rows = [{'elements': [{'status': 'OK', 'distance': {'value': 1000}}
+                          for _ in destinations_param.split('|')]}
+            for _ in origins_param.split('|')]
+    return {'status': status, 'rows': rows}
+
+
+class FakeSession:
+    """Answers like the Matrix API and records the peak number of concurrent requests"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.barrier = threading.Event()
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            status = self.statuses.pop(0) if self.statuses else 'OK'
+        self.barrier.wait(0.05)  # Give the other chunk requests a chance to overlap
+        with self.lock:
+            self.in_flight -= 1
+        response = Mock()
+        response.json.return_value = matrix_response(params['origins'], params['destinations'], status)
+        return response
+
+
+@pytest.fixture
+def api(monkeypatch):
+    monkeypatch.setattr('app.lib.apis.googleapi.time.sleep', lambda _: None)
+    return API()
+
+
+def distances(n_origins: int, n_destinations: int):
+    return [Distance(Place(45.0 + i * 0.1, 10.0), Place(50.0, 20.0 + j * 0.1))
+            for i in range(n_origins) for j in range(n_destinations)]
+
+
+@pytest.mark.unit
+def test_chunks_are_requested_concurrently(api):
+    api.session = FakeSession()
+    resolved, unresolved = api.resolve_distances(distances(30, 4))  # 120 elements -> 2 chunks of 15 x 4
+
+    assert len(resolved) == 120
+    assert unresolved == []
+    assert api.session.calls == 2
+    assert api.session.peak > 1
+    assert api.stats()['requests'] == 2
+
+
+@pytest.mark.unit
+def test_over_query_limit_backs_off_and_retries(api):
+    api.session = FakeSession(statuses=['OVER_QUERY_LIMIT'])
+    resolved, unresolved = api.resolve_distances(distances(1, 3))
+
+    assert len(resolved) == 3
+    assert api.session.calls == 2
+    assert api.stats()['over_query_limit'] == 1
+
+
+@pytest.mark.unit
+def test_over_query_limit_gives_up(api):
+    api.session = FakeSession(statuses=['OVER_QUERY_LIMIT'] * (api.retries + 1))
+    with pytest.raises(GoogleApiRequestError):
+        api.resolve_distances(distances(1, 3))
+
+
+@pytest.mark.unit
+def test_adaptive_limit_aimd():
+    limit = AdaptiveLimit(8)
+    limit.back_off()
+    limit.back_off()
+    assert limit.limit == 2
+    limit.success()
+    assert limit.limit == 3
+    for _ in range(10):
+        limit.success()
+    assert limit.limit == 8
+
+
+@pytest.mark.unit
+def test_groups_are_not_crossed(api):
+    api.session = FakeSession()
+    inbound = [Distance(Place(45.0 + i * 0.1, 10.0), Place(50.0, 20.0)) for i in range(10)]
+    unrelated = [Distance(Place(40.0, 5.0), Place(41.0 + j * 0.1, 6.0)) for j in range(10)]
+
+    resolved, unresolved = api.resolve_distance_groups([inbound, unrelated])
+
+    assert len(resolved) == 20
+    assert api.session.calls == 2
+    assert api.stats()['elements'] == 20  # 10x1 + 1x10 instead of the 11x11 cross product
+
+
+@pytest.mark.unit
+def test_small_groups_share_a_request(api):
+    api.session = FakeSession()
+    inbound = [Distance(Place(45.0 + i * 0.1, 10.0), Place(50.0, 20.0)) for i in range(3)]
+    direct = [Distance(Place(50.0, 20.0), Place(41.0, 6.0))]
+
+    resolved, unresolved = api.resolve_distance_groups([inbound, direct])
+
+    assert len(resolved) == 4
+    assert api.session.calls == 1  # 4 x 2 bills 4 elements more, cheaper than a request
+
+
+@pytest.mark.unit
+def test_concurrent_identical_requests_are_coalesced(api):
+    api.session = FakeSession()
+    start = threading.Barrier(4)
+    results = []
+
+    def quote():
+        start.wait()
+        results.append(api.resolve_distances(distances(2, 3)))
+
+    threads = [threading.Thread(target=quote) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [(len(resolved), len(unresolved)) for resolved, unresolved in results] == [(6, 0)] * 4
+    assert api.session.calls == 1
+    assert api.stats()['elements'] == 6  # No duplicated elements
+    assert api.stats()['coalesced'] == 18
+
+
+@pytest.mark.unit
+def test_overlapping_requests_share_the_pairs_in_flight(api):
+    api.session = FakeSession()
+    led, _ = api.flights.claim([dist.key for dist in distances(1, 2)])  # Another thread is requesting them
+
+    def land():
+        threading.Event().wait(0.05)  # time.sleep is patched out by the fixture
+        api.flights.land(led, {key: 5000 for key in led})
+
+    threading.Thread(target=land).start()
+    resolved, unresolved = api.resolve_distances(distances(1, 3))
+
+    assert len(resolved) == 3
+    assert sorted(dist.distance for dist in resolved) == [1000, 5000, 5000]
+    assert api.stats()['elements'] == 1  # Only the pair nobody was requesting
+
+
+@pytest.mark.unit
+def test_landed_pairs_linger(api):
+    api.session = FakeSession()
+    api.resolve_distances(distances(1, 3))
+    api.resolve_distances(distances(1, 3))
+    assert api.session.calls == 1
+
+    api.flights.linger = 0
+    api.resolve_distances(distances(1, 3))
+    api.resolve_distances(distances(1, 3))
+    assert api.session.calls == 3
+
+
+@pytest.mark.unit
+def test_failed_flights_are_not_remembered(api):
+    api.session = FakeSession(statuses=['REQUEST_DENIED'])
+    with pytest.raises(GoogleApiRequestError):
+        api.resolve_distances(distances(1, 3))
+    assert len(api.flights) == 0
+
+    resolved, _ = api.resolve_distances(distances(1, 3))
+    assert len(resolved) == 3
+    assert api.session.calls == 2
@@ -0,0 +1,102 @@
+import random
+import pytest
+from app.lib.apis import matrix_planner
+from app.lib.apis.matrix_planner import plan, shape, place_key
+from app.lib.calc.place import Place
+
+
+def places(n, lat=45.0, lng=10.0):
+    return [Place(lat + i * 0.01, lng + i * 0.02) for i in range(n)]
+
+
+def check(requests, pairs):
+    """Every request is within the limits and every needed pair is requested"""
+    requested = set()
+    for origins, destinations in requests:
+        assert 0 < len(origins) <= matrix_planner.MAX_ORIGINS
+        assert 0 < len(destinations) <= matrix_planner.MAX_DESTINATIONS
+        assert len(origins) * len(destinations) <= matrix_planner.MAX_ELEMENTS
+        requested.update((place_key(o), place_key(d)) for o in origins for d in destinations)
+    assert {(place_key(o), place_key(d)) for o, d in pairs} <= requested
+
+
+def elements(requests):
+    return sum(len(o) * len(d) for o, d in requests)
+
+
+@pytest.mark.unit
+def test_column_fallback_takes_eight_requests():
+    depots, place = places(182), Place(50.0, 30.0)
+    pairs = [(depot, place) for depot in depots]
+
+    requests = plan([pairs])
+
+    check(requests, pairs)
+    assert len(requests) == 8
+    assert elements(requests) == 182
+    assert {len(origins) for origins, _ in requests} == {22, 23}  # Evenly split
+
+
+@pytest.mark.unit
+def test_dense_block_shape():
+    assert shape(30, 4) == (2, 1)
+    assert shape(1, 182) == (1, 8)
+    assert shape(25, 25) == (7, 1)
+    pairs = [(o, d) for o in places(30) for d in places(4, lat=50.0)]
+    assert len(plan([pairs])) == 2
+
+
+@pytest.mark.unit
+def test_route_legs_share_requests():
+    depots_a, depots_b = places(5), places(5, lat=48.0)
+    place_a, place_b = Place(46.0, 11.0), Place(49.0, 12.0)
+    groups = [[(d, place_a) for d in depots_a], [(place_a, place_b)], [(place_b, d) for d in depots_b]]
+
+    requests = plan(groups)
+
+    check(requests, [pair for group in groups for pair in group])
+    assert len(requests) == 2  # The A -> B leg rides along with a depot group for 6 more elements
+    assert len(plan(groups, weight=0)) == 3  # Nothing is worth an extra element
+
+
+@pytest.mark.unit
+def test_unrelated_groups_are_not_crossed():
+    group_a = [(o, Place(50.0, 30.0)) for o in places(10)]
+    group_b = [(Place(40.0, 5.0), d) for d in places(10, lat=48.0)]
+
+    requests = plan([group_a, group_b])
+
+    check(requests, group_a + group_b)
+    assert (len(requests), elements(requests)) == (2, 20)
+
+
+@pytest.mark.unit
+def test_sparse_pairs_bill_less_in_no_more_requests():
+    rnd = random.Random(0)
+    origins, destinations = places(40), places(40, lat=50.0)
+    pairs = rnd.sample([(o, d) for o in origins for d in destinations], 300)
+    pairs += pairs[:20]  # Duplicates are requested once
+
+    requests = plan([pairs])
+
+    check(requests, pairs)
+    assert len(requests) <= 16  # The 40 x 40 cross product takes 16
+    assert elements(requests) < 40 * 40
+
+
+@pytest.mark.unit
+def test_never_more_requests_than_cross_products():
+    rnd = random.Random(1)
+    pool = places(60)
+    for _ in range(20):
+        groups = [[(rnd.choice(pool), rnd.choice(pool)) for _ in range(rnd.randint(1, 40))]
+                  for _ in range(rnd.randint(1, 6))]
+        crossed = 0
+        for group in groups:
+            rows, columns = shape(len({place_key(o) for o, _ in group}), len({place_key(d) for _, d in group}))
+            crossed += rows * columns
+
+        requests = plan(groups)
+
+        check(requests, [pair for group in groups for pair in group])
+        assert len(requests) <= crossed
@@ -0,0 +1,52 @@
+import json
+import random
+import time
+import pytest
+from app.tools import price_lanes
+
+
+@pytest.mark.unit
+def test_lane_from_flat_and_nested_rows():
+    flat = price_lanes.lane_from_row({'from_lat': '49.227717', 'from_lng': '31.852233', 'from_countrycode': 'UA',
+                                      'to_lat': '50.5089112', 'to_lng': '26.2566443', 'to_countrycode': '',
+                                      'transport_id': '1'})
+    nested = price_lanes.lane_from_row({'from': {'lat': 49.227717, 'lng': 31.852233, 'countrycode': 'UA'},
+                                        'to': {'lat': 50.5089112, 'lng': 26.2566443},
+                                        'transport_id': 1})
+    for lane in (flat, nested):
+        assert (lane['from'].lat, lane['from'].countrycode) == (49.227717, 'UA')
+        assert (lane['to'].lng, lane['to'].countrycode) == (26.2566443, None)
+        assert lane['transport_id'] == 1
+
+
+@pytest.mark.unit
+def test_lanes_are_written_in_input_order_with_bounded_window(monkeypatch):
+    def fake_price_lane(index, row):
+        time.sleep(random.random() / 1000)  # Complete out of order
+        return {'index': index, 'error': None}
+
+    monkeypatch.setattr(price_lanes, 'price_lane', fake_price_lane)
+    read = []
+
+    def rows():
+        for i in range(200):
+            read.append(i)
+            yield {}
+
+    indices = []
+    for record in price_lanes.price_lanes(rows(), workers=2):
+        assert len(read) - record['index'] <= 2 * price_lanes.WINDOW_PER_WORKER + 1  # Input is read lazily
+        indices.append(record['index'])
+    assert indices == list(range(200))
+
+
+@pytest.mark.unit
+def test_failed_lane_is_reported(tmp_path):
+    source = tmp_path / 'lanes.jsonl'
+    source.write_text(json.dumps({'from_lat': 'x', 'from_lng': 0, 'to_lat': 0, 'to_lng': 0, 'transport_id': 0}) + '\n')
+    output = tmp_path / 'prices.csv'
+
+    report = price_lanes.run(source, output, workers=1)
+
+    assert (report['lanes'], report['failed']) == (1, 1)
+    assert 'ValueError' in output.read_text()
@@ -1,4 +1,7 @@
+import math
+import numpy
 import pytest
+from types import SimpleNamespace
 from unittest.mock import Mock
 from math import isclose
 from app.lib.calc.calc_itself import Predictors
@@ -48,3 +51,46 @@ def test_ml_prediction_uses_model(mock_model, depot_1, depot_2, vehicle_1):
     price = Predictors.ml(depot_1, depot_2, vehicle_1, _distance=123456, ml_model=mock_model)
     mock_model.predict.assert_called_once_with(depot_1.id, depot_2.id, vehicle_1.id)
     assert price == 47.0
+
+
+# -------- Tests: array conventional method --------
+@pytest.mark.unit
+def test_distance_ratio_many_equals_scalar():
+    rnd = numpy.random.default_rng(0)
+    distances = numpy.concatenate([rnd.uniform(0, 3_000_000, 20000), rnd.integers(0, 3_000_000, 20000),
+                                   [0.0, 1.0, 50000.0, 1e9]])
+
+    ratios = Predictors._distance_ratio_many(distances)
+
+    assert ratios.tolist() == [Predictors._distance_ratio(float(dist)) for dist in distances]
+
+
+@pytest.mark.unit
+def test_distance_ratio_many_scalar_tie():
+    # Distance whose ratio is 1.2345 before rounding, solved from _distance_ratio
+    tie = (math.exp(0.9 / (1.2345 - 0.7) - 0.15) - 0.87) / 0.009 * 1000.0
+
+    ratio = Predictors._distance_ratio_many(tie)
+
+    assert numpy.ndim(ratio) == 0
+    assert ratio == Predictors._distance_ratio(tie)
+    assert Predictors._distance_ratio_many([tie]).tolist() == [Predictors._distance_ratio(tie)]
+
+
+@pytest.mark.unit
+def test_conventional_many_equals_scalar(depot_1, depot_2, vehicle_1):
+    rnd = numpy.random.default_rng(1)
+    n = 5000
+    depots_from = [SimpleNamespace(departure_ratio=float(r)) for r in rnd.choice([0.7, 0.85, 0.95, 1.0, 1.2], n)]
+    depots_to = [SimpleNamespace(arrival_ratio=float(r)) for r in rnd.choice([0.7, 0.85, 1.0, 1.1, 1.2], n)]
+    vehicles = [SimpleNamespace(price=float(p)) for p in rnd.choice([32.0, 37.5, 45.0, 52.3], n)]
+    distances = rnd.uniform(1000, 2_500_000, n)
+
+    prices = Predictors.conventional_many([d.departure_ratio for d in depots_from],
+                                          [d.arrival_ratio for d in depots_to],
+                                          [v.price for v in vehicles], distances)
+
+    expected = [Predictors.conventional(*case) for case in zip(depots_from, depots_to, vehicles, distances.tolist())]
+    assert prices.tolist() == expected
+    assert Predictors.conventional_many([depot_1.departure_ratio], [depot_2.arrival_ratio], [vehicle_1.price],
+                                        [10_000])[0] == Predictors.conventional(depot_1, depot_2, vehicle_1, 10_000)
@@ -0,0 +1,122 @@
+import os
+import numpy
+import pytest
+from unittest.mock import Mock
+from app.lib.ai import versions
+from app.lib.ai.price_table import PriceTable
+from app.lib.ai.serving import NumpyPricePredictor
+
+
+DEPOTS, VEHICLES = 3, 2
+
+
+def write_weights(path, seed=0):
+    rnd = numpy.random.default_rng(seed)
+    numpy.savez(path,
+                kernel_0=rnd.normal(size=(2 * DEPOTS + VEHICLES, 4)).astype(numpy.float32),
+                bias_0=rnd.normal(size=4).astype(numpy.float32),
+                kernel_1=rnd.normal(size=(4, 1)).astype(numpy.float32),
+                bias_1=rnd.normal(size=1).astype(numpy.float32),
+                activations=numpy.array(['leaky_relu', 'linear']),
+                depots_qty=numpy.array(DEPOTS), vehicles_qty=numpy.array(VEHICLES))
+
+
+def one_hot(dpt_from_id, dpt_to_id, vehicle_id):
+    x = numpy.zeros((1, 2 * DEPOTS + VEHICLES), dtype=numpy.float32)
+    x[0, [dpt_from_id, DEPOTS + dpt_to_id, 2 * DEPOTS + vehicle_id]] = 1.0
+    return x
+
+
+@pytest.fixture
+def table(tmp_path):
+    write_weights(tmp_path / 'weights.npz')
+    (tmp_path / 'vehicles.json').write_text('{}')
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'),
+                                    model_loc=str(tmp_path / 'missing.keras'))
+    return PriceTable(predictor, location=tmp_path / 'table.npy', vehicles_loc=str(tmp_path / 'vehicles.json'),
+                      depots_qty=DEPOTS, vehicles_qty=VEHICLES, check_interval=0).load()
+
+
+@pytest.mark.unit
+def test_table_matches_model(table):
+    assert table.data.shape == (DEPOTS, DEPOTS, VEHICLES)
+    for f in range(DEPOTS):
+        for t in range(DEPOTS):
+            for v in range(VEHICLES):
+                expected = table.predictor.forward(one_hot(f, t, v))[0][0]
+                assert numpy.isclose(table.predict(f, t, v), expected, rtol=1e-5)
+
+
+@pytest.mark.unit
+def test_table_is_reused_when_sources_did_not_change(table):
+    built = os.stat(table.location).st_mtime_ns
+    table.load()
+    assert not table.is_stale()
+    assert os.stat(table.location).st_mtime_ns == built
+
+
+@pytest.mark.unit
+def test_table_rebuilt_when_weights_change(table, tmp_path):
+    before = table.predict(1, 2, 1)
+    write_weights(tmp_path / 'weights.npz', seed=1)
+    assert table.is_stale()
+
+    table.refresh(wait=True)
+
+    assert not table.is_stale()
+    assert table.predict(1, 2, 1) != before
+    assert numpy.isclose(table.predict(1, 2, 1), table.predictor.forward(one_hot(1, 2, 1))[0][0], rtol=1e-5)
+
+
+@pytest.mark.unit
+def test_table_rebuilt_when_vehicles_change(table, tmp_path):
+    (tmp_path / 'vehicles.json').write_text('{"vehicles": []}')
+    assert table.is_stale()
+    table.refresh(wait=True)
+    assert not table.is_stale()
+
+
+@pytest.mark.unit
+def test_predict_many_falls_back_outside_of_table(table):
+    prices = table.predict_many([0, 2, 1], [1, 2, 0], [1, 0, 1])
+    assert numpy.allclose(prices, [table.predict(0, 1, 1), table.predict(2, 2, 0), table.predict(1, 0, 1)])
+
+    table.check_interval = float('inf')  # The mock has no files to check
+    table.predictor = Mock()
+    table.predictor.predict_many.return_value = numpy.array([5.0])
+    prices = table.predict_many([0, DEPOTS], [1, 0], [1, 0])
+    assert prices[1] == 5.0
+    assert table.predictor.predict_many.call_args[0][0].tolist() == [DEPOTS]
+
+
+@pytest.mark.unit
+def test_published_version_is_swapped_in(tmp_path):
+    write_weights(tmp_path / 'weights.npz')
+    (tmp_path / 'vehicles.json').write_text('{}')
+    pointer_loc = str(tmp_path / 'price_model.json')
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'),
+                                    model_loc=str(tmp_path / 'missing.keras'), pointer_loc=pointer_loc)
+    table = PriceTable(predictor, location=tmp_path / 'table.npy', vehicles_loc=str(tmp_path / 'vehicles.json'),
+                       depots_qty=DEPOTS, vehicles_qty=VEHICLES, check_interval=0).load()
+    before = table.predict(1, 2, 1)
+    assert predictor.version is None
+
+    write_weights(tmp_path / 'v2.npz', seed=1)
+    versions.publish('v2', str(tmp_path / 'v2.keras'), str(tmp_path / 'v2.npz'), pointer_loc)
+    assert table.is_stale()
+    old_data = table.data
+    table.refresh(wait=True)
+
+    assert predictor.version == 'v2'
+    assert predictor.weights_loc == str(tmp_path / 'v2.npz')
+    assert table.data is not old_data
+    assert table.predict(1, 2, 1) != before
+    assert numpy.isclose(table.predict(1, 2, 1), predictor.forward(one_hot(1, 2, 1))[0][0], rtol=1e-5)
+    assert not table.is_stale()
+
+
+@pytest.mark.unit
+def test_warm_up_runs_the_predictor(table):
+    table.predictor = Mock()
+    table.warm_up()
+    table.predictor.warm_up.assert_called_once()
@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import threading
+import numpy
+import pytest
+from app.lib.ai.querylog_source import QueryLogSource, parse_row
+
+
+def calculate_row(lat_from, lng_from, lat_to, lng_to, vehicle, price_per_km, rate):
+    query = {'origin': {'lat': lat_from, 'lng': lng_from, 'countrycode': 'UA'},
+             'destination': {'lat': lat_to, 'lng': lng_to, 'countrycode': 'UA'},
+             'vehicle': vehicle}
+    message = f'Ціна: 1000 ({price_per_km} за км)\nCurrency: {rate}'
+    return json.dumps(query), json.dumps([message, 'nosms'])
+
+
+def submit_row(lat_from, lng_from, lat_to, lng_to, transport_id, price_per_km, rate):
+    query = {'map_link': f'https://www.google.com/maps/dir/{lat_from},{lng_from}/{lat_to},{lng_to}/',
+             'transport_id': transport_id, 'price_per_km': price_per_km, 'currency_rate': rate}
+    return json.dumps(query), json.dumps('ok')
+
+
+@pytest.fixture
+def querylog(tmp_path):
+    location = tmp_path / 'QueryLog.sqlite'
+    conn = sqlite3.connect(location)
+    conn.execute('CREATE TABLE "queries" ("date" TEXT, "time" TEXT, "number" TEXT, "query" TEXT, "response" TEXT)')
+    rows = [calculate_row(49.24, 28.51, 46.48, 30.76, 1, 1.25, 40.0),   # Vinnytsia -> Odesa
+            ('not json', 'nosms'),
+            submit_row(46.48, 30.76, 49.24, 28.51, 6, 2.0, 1.0),      # Odesa -> Vinnytsia
+            calculate_row(49.24, 28.51, 46.48, 30.76, 99, 1.0, 1.0)]  # unknown vehicle
+    rows += [calculate_row(49.24, 28.51, 49.25, 28.52, 2, 1.0, 1.0)] * 3
+    conn.executemany('INSERT INTO "queries" VALUES ("", "", "", ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    return str(location)
+
+
+@pytest.mark.unit
+def test_parse_row_reads_both_kinds():
+    assert parse_row(*calculate_row(49.24, 28.51, 46.48, 30.76, 1, 1.25, 40.0)) == \
+        (49.24, 28.51, 'UA', 46.48, 30.76, 'UA', 1, 50.0)
+    assert parse_row(*submit_row(46.48, 30.76, 49.24, 28.51, 6, 2.0, 1.5)) == \
+        (46.48, 30.76, None, 49.24, 28.51, None, 6, 3.0)
+
+
+@pytest.mark.unit
+def test_parse_row_skips_malformed():
+    assert parse_row('not json', 'nosms') is None
+    assert parse_row(json.dumps({'origin': {}}), 'nosms') is None
+    assert parse_row(calculate_row(1, 2, 3, 4, 1, 1.0, 1.0)[0], json.dumps(['no price here', 'nosms'])) is None
+    assert parse_row(json.dumps({'map_link': 'https://maps/'}), '') is None
+
+
+@pytest.mark.unit
+def test_rows_are_streamed_in_chunks(querylog, depot_1, depot_2):
+    source = QueryLogSource([depot_1, depot_2], querylog, chunk_size=2)
+    assert source.count() == 7
+    assert [len(chunk) for chunk in source.rows()] == [2, 2, 2, 1]
+
+    chunks = list(source.arrays())
+    x, y = numpy.concatenate([x for x, _ in chunks]), numpy.concatenate([y for _, y in chunks])
+
+    assert source.skipped == 2
+    assert x.shape == (5, 371) and x.dtype == numpy.float32
+    assert y.tolist() == [50.0, 2.0, 1.0, 1.0, 1.0]
+    assert (numpy.flatnonzero(x[0]) - [0, 182, 364]).tolist() == [0, 24, 1]
+    assert (numpy.flatnonzero(x[1]) - [0, 182, 364]).tolist() == [24, 0, 6]
+
+
+@pytest.mark.unit
+def test_batches_are_resliced(querylog, depot_1, depot_2):
+    source = QueryLogSource([depot_1, depot_2], querylog, chunk_size=3)
+    assert [len(y) for _, y in source.batches(2)] == [2, 2, 1]
+
+    repeated = source.batches(2, repeat=True)
+    assert [len(next(repeated)[1]) for _ in range(6)] == [2, 2, 1, 2, 2, 1]
+
+
+@pytest.mark.unit
+def test_holdout_split_is_disjoint(querylog, depot_1, depot_2):
+    train = QueryLogSource([depot_1, depot_2], querylog, part='train', holdout_every=3)
+    holdout = QueryLogSource([depot_1, depot_2], querylog, part='holdout', holdout_every=3)
+
+    assert (train.count(), holdout.count()) == (5, 2)
+    assert [len(chunk) for chunk in holdout.rows()] == [2]
+    assert sum(len(y) for _, y in train.arrays()) + sum(len(y) for _, y in holdout.arrays()) == 5
+    with pytest.raises(ValueError):
+        QueryLogSource([depot_1, depot_2], querylog, part='validation')
+
+
+@pytest.mark.unit
+def test_inputs_fit_the_model_fields(querylog, depot_1, depot_2):
+    # A model trained before depot 24 and vehicle 6 were added
+    source = QueryLogSource([depot_1, depot_2], querylog, depots_qty=20, vehicles_qty=6)
+
+    x = numpy.concatenate([x for x, _ in source.arrays()])
+
+    assert source.skipped == 3
+    assert x.shape == (4, 46)
+    assert (numpy.flatnonzero(x[0]) - [0, 20, 40]).tolist() == [0, 0, 1]  # Odesa falls back to Vinnytsia
+
+
+@pytest.mark.unit
+def test_rows_can_be_closed_from_another_thread(querylog, depot_1, depot_2):
+    rows = QueryLogSource([depot_1, depot_2], querylog, chunk_size=3).rows()
+    next(rows)
+    errors = []
+
+    def close():
+        try:
+            rows.close()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=close)
+    thread.start()
+    thread.join()
+    assert errors == []
@@ -123,3 +123,38 @@ def test_process_good_phone(flask_request_calculate, remote_addr, num):
 
     flask_request.data['phone_number'] = num
     request_processor.process(flask_request)
+
+
+def batch_request(flask_request_calculate, n):
+    common = {key: flask_request_calculate[key] for key in ('intent', 'phone_number', 'locale', 'url')}
+    items = [{key: flask_request_calculate[key] for key in ('from', 'to')} for _ in range(n)]
+    for i, item in enumerate(items):
+        item['transport_id'] = i % 7
+    return {**common, 'items': items}
+
+
+@pytest.mark.unit
+def test_process_batch_normal(flask_request_calculate, remote_addr, dto_request_calculate):
+    flask_request = FakeFlaskRequest(batch_request(flask_request_calculate, 3), remote_addr)
+
+    dtos = request_processor.process_batch(flask_request)
+
+    assert [dto.vehicle.id for dto in dtos] == [0, 1, 2]
+    assert dtos[1] == dto_request_calculate
+
+
+@pytest.mark.unit
+def test_process_batch_bad_item_fails_batch(flask_request_calculate, remote_addr):
+    data = batch_request(flask_request_calculate, 3)
+    data['items'][2]['transport_id'] = 'test'
+    with pytest.raises(ValidationError):
+        request_processor.process_batch(FakeFlaskRequest(data, remote_addr))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('items', [None, [], 'items', [1]])
+def test_process_batch_bad_items(flask_request_calculate, remote_addr, items):
+    data = batch_request(flask_request_calculate, 1)
+    data['items'] = items
+    with pytest.raises(ValidationError):
+        request_processor.process_batch(FakeFlaskRequest(data, remote_addr))
@@ -0,0 +1,86 @@
+import pytest
+from app.lib.calc.place import Place
+from app.lib.calc.route_cache import RoutePlanCache, RoutePlan
+
+
+@pytest.fixture
+def plan(depot_1, depot_2):
+    return RoutePlan(depot_1, depot_2, (1000.0, 2000.0, 3000.0))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('app.lib.calc.route_cache.time.monotonic', lambda: now[0])
+    return now
+
+
+def make_cache(**kwargs):
+    kwargs = {'ttl': 60, 'max_size': 10, 'snap_meters': 200, **kwargs}
+    return RoutePlanCache(**kwargs)
+
+
+@pytest.mark.unit
+def test_hits_and_misses_are_counted(plan, place_1, place_2):
+    cache = make_cache()
+    assert cache.get(place_1, place_2) is None
+    cache.put(place_1, place_2, plan)
+
+    assert cache.get(place_1, place_2) == plan
+    assert cache.get(place_2, place_1) is None  # Direction matters
+    assert plan.route(place_1, place_2) == (plan.starting_depot, place_1, place_2, plan.ending_depot)
+    assert plan.distance == 6000.0
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 2, 0.3333)
+
+
+@pytest.mark.unit
+def test_nearby_places_share_a_plan(plan, place_1, place_2):
+    cache = make_cache()
+    cache.put(place_1, place_2, plan)
+
+    assert cache.get(Place(place_1.lat + 0.00001, place_1.lng), place_2) == plan  # ~1 m away
+    assert cache.get(Place(place_1.lat + 0.01, place_1.lng), place_2) is None  # ~1 km away
+    assert cache.get(Place(place_1.lat, place_1.lng, countrycode='DE'), place_2) is None
+
+
+@pytest.mark.unit
+def test_snapping_is_opt_in(plan, place_1, place_2):
+    cache = RoutePlanCache(ttl=60)
+    cache.put(place_1, place_2, plan)
+
+    assert cache.snap_meters == 0
+    assert cache.get(Place(place_1.lat + 0.00001, place_1.lng), place_2) is None
+
+
+@pytest.mark.unit
+def test_plans_expire(plan, place_1, place_2, clock):
+    cache = make_cache()
+    cache.put(place_1, place_2, plan)
+    clock[0] += 59
+    assert cache.get(place_1, place_2) == plan
+    clock[0] += 2
+    assert cache.get(place_1, place_2) is None
+    assert cache.stats()['expired'] == 1
+    assert len(cache) == 0
+
+
+@pytest.mark.unit
+def test_least_recently_used_plans_are_evicted(plan, place_1, place_2, place_3):
+    cache = make_cache(max_size=2)
+    cache.put(place_1, place_2, plan)
+    cache.put(place_2, place_3, plan)
+    cache.get(place_1, place_2)
+    cache.put(place_3, place_1, plan)
+
+    assert cache.get(place_2, place_3) is None
+    assert cache.get(place_1, place_2) == plan
+    assert cache.get(place_3, place_1) == plan
+
+
+@pytest.mark.unit
+def test_zero_ttl_disables(plan, place_1, place_2):
+    cache = make_cache(ttl=0)
+    cache.put(place_1, place_2, plan)
+    assert cache.get(place_1, place_2) is None
+    assert len(cache) == 0
@@ -0,0 +1,60 @@
+import numpy
+import pytest
+from app.lib.ai.samples import SampleSpace, depot_distances
+from app.lib.calc.depot_matrix import DepotMatrix
+from app.lib.calc.calc_itself import DistanceResolvers, Predictors
+
+
+@pytest.mark.unit
+def test_samples_are_priced_like_conventional(depot_1, depot_2, vehicle_1, vehicle_2):
+    depots, vehicles = [depot_1, depot_2], [vehicle_1, vehicle_2]
+    space = SampleSpace(depots, vehicles, depot_matrix=None)
+
+    x, y = space.sample(200, numpy.random.default_rng(0))
+
+    assert x.shape == (200, 371)
+    assert y.shape == (200,)
+    for row, price in zip(x, y):
+        dpt_from, dpt_to, vehicle = numpy.flatnonzero(row) - numpy.array([0, 182, 364])
+        depot_from = next(d for d in depots if d.id == dpt_from)
+        depot_to = next(d for d in depots if d.id == dpt_to)
+        vehicle_ = next(v for v in vehicles if v.id == vehicle)
+        distance = DistanceResolvers.haversine_array([depot_from], [depot_to])[0, 0]
+        assert price == numpy.float32(Predictors.conventional(depot_from, depot_to, vehicle_, float(distance)))
+
+
+@pytest.mark.unit
+def test_samples_are_reproducible_with_seeded_rng(depot_1, depot_2, vehicle_1):
+    space = SampleSpace([depot_1, depot_2], [vehicle_1])
+    x1, y1 = space.sample(50, numpy.random.default_rng((7, 3)))
+    x2, y2 = space.sample(50, numpy.random.default_rng((7, 3)))
+    assert numpy.array_equal(x1, x2) and numpy.array_equal(y1, y2)
+
+
+@pytest.mark.unit
+def test_depot_matrix_distances_with_haversine_fallback(tmp_path, depot_1, depot_2):
+    matrix = DepotMatrix(tmp_path / 'depot_matrix.npy')
+    road = numpy.array([[0.0, 123000.0], [numpy.nan, 0.0]], dtype=numpy.float32)  # No land route back
+    matrix.save(road, [depot_1, depot_2])
+    matrix.load()
+
+    distances = depot_distances([depot_2, depot_1], matrix)
+
+    haversine = DistanceResolvers.haversine_array([depot_2, depot_1], [depot_2, depot_1])
+    assert distances[1, 0] == 123000.0
+    assert distances[0, 1] == haversine[0, 1]
+    assert distances[0, 0] == distances[1, 1] == 0.0
+    assert SampleSpace([depot_1, depot_2], [], depot_matrix=matrix).distances[0, 1] == 123000.0
+
+
+@pytest.mark.unit
+def test_samples_fit_the_model_fields(depot_1, depot_2, vehicle_1, vehicle_2):
+    # A model trained before depot 24 and vehicle 1 were added
+    distances = numpy.array([[0.0, 400000.0], [400000.0, 0.0]])
+    space = SampleSpace([depot_2, depot_1], [vehicle_1, vehicle_2], distances=distances, depots_qty=20, vehicles_qty=1)
+
+    x, y = space.sample(20, numpy.random.default_rng(0))
+
+    assert x.shape == (20, 41)
+    assert (x[:, [0, 20, 40]] == 1.0).all()
+    assert space.distances.tolist() == [[0.0]]
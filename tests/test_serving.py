@@ -0,0 +1,201 @@
+import os
+import subprocess
+import sys
+import numpy
+import pytest
+from pathlib import Path
+from unittest.mock import Mock
+from app.lib.ai import encoding, versions
+from app.lib.ai.encoding import vectorize_input, export_weights, encode, encode_indices, field_sizes
+from app.lib.ai.encoding import DEPOTS_QTY, VEHICLES_QTY
+from app.lib.ai.serving import NumpyPricePredictor, LEAKY_RELU_SLOPE
+
+
+def write_weights(path, seed=0):
+    rnd = numpy.random.default_rng(seed)
+    shapes = [(371, 8), (8, 4), (4, 2), (2, 1)]
+    arrays = {}
+    for i, shape in enumerate(shapes):
+        arrays[f'kernel_{i}'] = rnd.normal(size=shape).astype(numpy.float32)
+        arrays[f'bias_{i}'] = rnd.normal(size=shape[1]).astype(numpy.float32)
+    arrays['activations'] = numpy.array(['leaky_relu', 'leaky_relu', 'leaky_relu', 'linear'])
+    numpy.savez(path, **arrays)
+    return arrays
+
+
+def reference_forward(arrays, x):
+    h = numpy.asarray(x, dtype=numpy.float64)
+    for i in range(4):
+        h = h @ arrays[f'kernel_{i}'].astype(numpy.float64) + arrays[f'bias_{i}']
+        if i < 3:
+            h = numpy.where(h >= 0, h, h * LEAKY_RELU_SLOPE)
+    return h
+
+
+@pytest.mark.unit
+def test_numpy_predictor_matches_reference(tmp_path):
+    arrays = write_weights(tmp_path / 'weights.npz')
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'))
+
+    for ids in [(0, 24, 1), (181, 0, 6), (57, 57, 3)]:
+        expected = reference_forward(arrays, [vectorize_input(*ids)])[0][0]
+        assert numpy.isclose(predictor.predict(*ids), expected, rtol=1e-5)
+
+
+@pytest.mark.unit
+def test_vectorize_input():
+    x = vectorize_input(3, 5, 6)
+    assert len(x) == 371
+    assert sum(x) == 3.0
+    assert x[3] == x[182 + 5] == x[364 + 6] == 1.0
+
+
+@pytest.mark.unit
+def test_sizes_come_from_loadables():
+    assert (DEPOTS_QTY, VEHICLES_QTY) == (182, 7)
+
+
+@pytest.mark.unit
+def test_encode_matches_vectorize_input():
+    ids = ([3, 181, 0], [5, 0, 181], [6, 0, 2])
+    x = encode(*ids)
+    assert x.shape == (3, 371)
+    assert x.dtype == numpy.float32
+    for row, triple in zip(x, zip(*ids)):
+        assert row.tolist() == vectorize_input(*triple)
+    assert encode_indices(*ids).tolist() == [[3, 187, 370], [181, 182, 364], [0, 363, 366]]
+
+
+@pytest.mark.unit
+def test_predict_many_matches_predict(tmp_path):
+    arrays = write_weights(tmp_path / 'weights.npz')
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'))
+    from_ids, to_ids, vehicle_ids = [0, 181, 57, 12], [24, 0, 57, 100], [1, 6, 3, 0]
+
+    prices = predictor.predict_many(from_ids, to_ids, vehicle_ids)
+
+    expected = reference_forward(arrays, encode(from_ids, to_ids, vehicle_ids))[:, 0]
+    assert prices.shape == (4,)
+    assert numpy.allclose(prices, expected, rtol=1e-5)
+    assert numpy.allclose(predictor.forward(encode(from_ids, to_ids, vehicle_ids))[:, 0], prices, rtol=1e-5)
+
+
+@pytest.mark.unit
+def test_field_sizes_come_from_the_weights(tmp_path):
+    rnd = numpy.random.default_rng(0)
+    numpy.savez(tmp_path / 'small.npz', kernel_0=rnd.normal(size=(8, 1)).astype(numpy.float32),
+                bias_0=numpy.zeros(1, dtype=numpy.float32), activations=numpy.array(['linear']),
+                depots_qty=numpy.array(3), vehicles_qty=numpy.array(2))
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'small.npz'))
+    kernel = numpy.load(tmp_path / 'small.npz')['kernel_0'][:, 0]
+
+    assert (predictor.depots_qty, predictor.vehicles_qty) == (3, 2)
+    assert numpy.isclose(predictor.predict(2, 1, 1), kernel[2] + kernel[3 + 1] + kernel[6 + 1], rtol=1e-5)
+    with pytest.raises(ValueError):
+        predictor.predict(3, 0, 0)
+    with pytest.raises(ValueError):
+        predictor.predict(0, 0, 2)
+
+
+@pytest.mark.unit
+def test_weights_not_matching_the_fields_are_refused(tmp_path):
+    write_weights(tmp_path / 'weights.npz')
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'))
+    rnd = numpy.random.default_rng(0)
+    numpy.savez(tmp_path / 'wider.npz', kernel_0=rnd.normal(size=(373, 1)).astype(numpy.float32),
+                bias_0=numpy.zeros(1, dtype=numpy.float32), activations=numpy.array(['linear']))
+
+    with pytest.raises(ValueError):
+        predictor.load(str(tmp_path / 'wider.npz'))
+    assert predictor.layers[0][0].shape == (371, 8)  # Still serving the weights it had
+
+
+@pytest.mark.unit
+def test_reload_refuses_stale_weights(tmp_path, monkeypatch):
+    monkeypatch.setattr(encoding, 'export_weights', Mock(side_effect=AssertionError('serving must not export')))
+    write_weights(tmp_path / 'weights.npz')
+    (tmp_path / 'model.keras').write_bytes(b'')
+    os.utime(tmp_path / 'model.keras', ns=(0, 0))
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'), model_loc=str(tmp_path / 'model.keras'))
+    before = predictor.predict(1, 2, 3)
+
+    write_weights(tmp_path / 'weights.npz', seed=1)
+    saved = os.stat(tmp_path / 'weights.npz').st_mtime_ns + 10 ** 9
+    os.utime(tmp_path / 'model.keras', ns=(saved, saved))  # Saved after the weights were exported
+    predictor.reload()
+    assert predictor.predict(1, 2, 3) == before
+
+    os.utime(tmp_path / 'model.keras', ns=(0, 0))
+    predictor.reload()
+    assert predictor.predict(1, 2, 3) != before
+
+
+@pytest.mark.unit
+def test_missing_weights_are_not_exported_by_serving(tmp_path, monkeypatch):
+    monkeypatch.setattr(encoding, 'export_weights', Mock(side_effect=AssertionError('serving must not export')))
+    with pytest.raises(FileNotFoundError):
+        NumpyPricePredictor(weights_loc=str(tmp_path / 'missing.npz'), model_loc=str(tmp_path / 'model.keras'))
+
+
+@pytest.mark.unit
+def test_export_tool_imports_without_weights(tmp_path):
+    # A fresh process: the first weights are exported before any exist, serving must not be imported
+    env = dict(os.environ, AI_WEIGHTS_LOC=str(tmp_path / 'missing.npz'), AI_MODEL_POINTER_LOC=str(tmp_path / 'none.json'))
+    code = "import sys, app.tools.export_model; assert 'app.lib.ai.serving' not in sys.modules"
+    result = subprocess.run([sys.executable, '-c', code], env=env, cwd=Path(__file__).parents[1],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.unit
+def test_publish_exports_outdated_weights(tmp_path, monkeypatch):
+    export = Mock()
+    monkeypatch.setattr(encoding, 'export_weights', export)
+    (tmp_path / 'v1.keras').write_bytes(b'')
+    pointer_loc = str(tmp_path / 'price_model.json')
+
+    versions.publish('v1', str(tmp_path / 'v1.keras'), str(tmp_path / 'v1.npz'), pointer_loc)
+    export.assert_called_once_with(str(tmp_path / 'v1.keras'), str(tmp_path / 'v1.npz'))
+
+    write_weights(tmp_path / 'v1.npz')
+    os.utime(tmp_path / 'v1.keras', ns=(0, 0))
+    versions.publish('v1', str(tmp_path / 'v1.keras'), str(tmp_path / 'v1.npz'), pointer_loc)
+    assert export.call_count == 1
+
+
+@pytest.mark.unit
+def test_keras_and_numpy_outputs_match(tmp_path):
+    keras = pytest.importorskip('keras')
+    model = keras.models.Sequential([
+        keras.Input(shape=(371,)),
+        keras.layers.Dense(8, activation='leaky_relu'),
+        keras.layers.Dense(4, activation='leaky_relu'),
+        keras.layers.Dense(2, activation='leaky_relu'),
+        keras.layers.Dense(1, activation='linear'),
+    ])
+    model.save(tmp_path / 'model.keras')
+    export_weights(str(tmp_path / 'model.keras'), str(tmp_path / 'weights.npz'))
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'))
+
+    x = numpy.array([vectorize_input(i, 181 - i, i % 7) for i in range(0, 182, 13)], dtype=numpy.float32)
+    assert numpy.allclose(predictor.forward(x), model.predict(x, verbose=0), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.unit
+def test_field_sizes_of_a_model_width():
+    assert field_sizes(371) == (182, 7)
+    assert field_sizes(2 * 150 + 7) == (150, 7)
+    with pytest.raises(ValueError):
+        field_sizes(372)
+
+
+@pytest.mark.unit
+def test_export_keeps_the_sizes_of_an_older_model(tmp_path):
+    keras = pytest.importorskip('keras')
+    model = keras.models.Sequential([keras.Input(shape=(2 * 150 + 7,)), keras.layers.Dense(1, activation='linear')])
+    model.save(tmp_path / 'model.keras')
+
+    export_weights(str(tmp_path / 'model.keras'), str(tmp_path / 'weights.npz'))
+
+    predictor = NumpyPricePredictor(weights_loc=str(tmp_path / 'weights.npz'))
+    assert (predictor.depots_qty, predictor.vehicles_qty) == (150, 7)
@@ -0,0 +1,32 @@
+import pytest
+from app.lib.ai import versions
+
+
+@pytest.mark.unit
+def test_publish_replaces_pointer(tmp_path):
+    pointer_loc = str(tmp_path / 'price_model.json')
+    assert versions.read_pointer(pointer_loc) is None
+
+    versions.publish('v1', 'v1.keras', 'v1.npz', pointer_loc)
+    pointer = versions.publish('v2', 'v2.keras', 'v2.npz', pointer_loc, holdout_mae=1.5)
+
+    assert versions.read_pointer(pointer_loc) == pointer
+    assert pointer == {'version': 'v2', 'model': 'v2.keras', 'weights': 'v2.npz', 'holdout_mae': 1.5}
+    assert [p.name for p in tmp_path.iterdir()] == ['price_model.json']
+
+
+@pytest.mark.unit
+def test_malformed_pointer_is_ignored(tmp_path):
+    pointer_loc = tmp_path / 'price_model.json'
+    pointer_loc.write_text('{"version": "v1"')
+    assert versions.read_pointer(str(pointer_loc)) is None
+    pointer_loc.write_text('{"version": "v1"}')
+    assert versions.read_pointer(str(pointer_loc)) is None
+
+
+@pytest.mark.unit
+def test_new_version_paths(tmp_path):
+    version, model_loc, weights_loc = versions.new_version(str(tmp_path / 'models'))
+    assert model_loc == str(tmp_path / 'models' / f'{version}.keras')
+    assert weights_loc == str(tmp_path / 'models' / f'{version}.npz')
+    assert (tmp_path / 'models').is_dir()